@@ -267,11 +267,17 @@ CACHES = {
         'LOCATION': get_redis_address(),
     }
 }
+# Redis keeping contest scoreboards ranked and serialized as participations change, see compete.scoreboard.
+# None serializes the scoreboard from the database on every cache miss instead
+BKDNOJ_SCOREBOARD_REDIS = get_redis_address()
 
 ## ==================================== Celery 
 CELERY_BROKER_URL = get_redis_address()
 CELERY_BROKER_URL_SECRET = CELERY_BROKER_URL
 result_backend = CELERY_BROKER_URL
+# Processes recomputing a contest's standings when Celery runs tasks eagerly (CELERY_TASK_ALWAYS_EAGER);
+# otherwise the work is spread over the Celery workers
+BKDNOJ_STANDING_RECOMPUTE_WORKERS = 4
 
 ## ==================================== Site settings
 DEFAULT_USER_TIME_ZONE = 'Asia/Ho_Chi_Minh'
@@ -346,6 +352,10 @@ EVENT_DAEMON_GET = 'ws://localhost:9996/'
 EVENT_DAEMON_POLL = '/channels/'
 EVENT_DAEMON_KEY = None
 EVENT_DAEMON_AMQP_EXCHANGE = 'bkdnoj-events'
+# Events are posted from a background queue; past this many pending events, new ones are dropped
+EVENT_DAEMON_QUEUE_SIZE = 10000
+# Maximum number of events sent to the event daemon in one batch
+EVENT_DAEMON_BATCH_SIZE = 100
 EVENT_DAEMON_SUBMISSION_KEY = '6Sdmkx^%pk@GsifDfXcwX*Y7LRF%RGT8vmFpSxFBT$fwS7trc8raWfN#CSfQuKApx&$B#Gh2L7p%W!Ww'
 ## -------------------------------------------------- Unused ^
 
@@ -364,6 +374,64 @@ BRIDGED_JUDGE_PROXIES = None
 
 BRIDGED_DJANGO_ADDRESS = [('localhost', 9998)]
 BRIDGED_DJANGO_CONNECT = None
+# Persistent connections each Django/Celery process keeps to the bridge; 0 opens a new connection per request
+BRIDGED_DJANGO_POOL_SIZE = 2
+# Seconds to wait for the bridge to reply on a persistent connection
+BRIDGED_DJANGO_TIMEOUT = 30
+
+# Size of the worker pool running packet handlers (and their ORM calls) in `runbridged --async`
+BRIDGED_ASYNC_WORKERS = 8
+# Database connections shared by all bridge handlers, and seconds a handler waits for one before giving up.
+# 0 gives every handler thread a connection of its own
+BRIDGED_DB_POOL_SIZE = 8
+BRIDGED_DB_POOL_TIMEOUT = 30
+# Seconds a pooled connection is kept open before it is reopened; None keeps it until an error occurs on it
+BRIDGED_DB_POOL_MAX_AGE = None
+
+# Buffered test case results are written once this many rows are pending, or after this many seconds
+BRIDGED_TEST_CASE_FLUSH_ROWS = 500
+BRIDGED_TEST_CASE_FLUSH_INTERVAL = 0.5
+# Seconds between the single UPDATE writing the ping and load of every connected judge
+BRIDGED_HEARTBEAT_INTERVAL = 10
+# Threads running expired judge deadlines (requeueing a silent judge's work, sending pings), so a slow one
+# doesn't delay the others
+BRIDGED_WATCHDOG_WORKERS = 4
+
+# File recording the bridge queue, so unfinished submissions are requeued after a restart instead of marked IE.
+# Set to None to disable. With FSYNC the journal also survives a machine crash, at one disk sync per entry
+BRIDGED_QUEUE_JOURNAL = os.path.join(BASE_DIR, 'bridge-queue.journal')
+BRIDGED_QUEUE_JOURNAL_FSYNC = False
+
+# Relative shares of judging capacity for a whole contest, a user in a contest, and a user outside of contests
+BRIDGED_FAIR_SHARE_WEIGHTS = {'contest': 16, 'contest-user': 4, 'user': 1}
+# Seconds a queued rejudge waits before it is moved up a priority; None disables aging
+BRIDGED_QUEUE_AGING_INTERVAL = 300
+
+# Number of recently graded problems remembered per judge. A new submission goes to a judge that graded its problem
+# recently (warm test data) if that judge's occupancy plus load per slot is within TOLERANCE of the least busy judge
+BRIDGED_LOCALITY_SIZE = 32
+BRIDGED_LOCALITY_TOLERANCE = 0.5
+
+# Packet codecs the bridge accepts from judges and Django clients that offer them, most preferred first.
+# 'json' uses orjson when installed; 'msgpack' needs the msgpack package. Peers that offer nothing keep plain JSON
+BRIDGED_CODECS = ['msgpack', 'json']
+# Packets smaller than this many bytes are sent uncompressed to peers that negotiated a codec
+BRIDGED_COMPRESSION_THRESHOLD = 1024
+
+# Local address serving bridge metrics over HTTP at /metrics (Prometheus text, or ?format=json); None disables it.
+# The same data is returned for a 'get-metrics' packet, see judger.judgeapi.get_bridge_metrics
+BRIDGED_METRICS_ADDRESS = ('localhost', 9997)
+
+# Bridges started with `runbridged --shard N` run as entry N of this list and share one submission queue through
+# the database (PostgreSQL only). Each serves its own judges; Django may send submissions to any of them, e.g.
+# BRIDGED_SHARDS = [
+#     {'judge': [('0.0.0.0', 9999)], 'django': [('localhost', 9998)], 'metrics': ('localhost', 9997)},
+#     {'judge': [('0.0.0.0', 9989)], 'django': [('localhost', 9988)], 'metrics': ('localhost', 9987)},
+# ]
+# 'connect' overrides the address other shards use to reach a shard's Django port
+BRIDGED_SHARDS = []
+# Seconds between a shard's checks for shared queue entries its free judges can take
+BRIDGED_SHARD_POLL_INTERVAL = 0.2
 
 ## --------------------------------------------------
 #from .celery import app as celery_app
@@ -9,6 +9,9 @@ class abstractclassmethod(classmethod):
 
 
 class BaseContestFormat(metaclass=ABCMeta):
+    # Participations recomputed per query (and per UPDATE) by update_participations
+    BULK_CHUNK_SIZE = 500
+
     @abstractmethod
     def __init__(self, contest, config):
         self.config = config
@@ -46,6 +49,29 @@ class BaseContestFormat(metaclass=ABCMeta):
         """
         raise NotImplementedError()
 
+    def update_participations(self, participations):
+        """
+        Updates many ContestParticipation objects of this contest, as update_participation does for one.
+        Formats that can score participations from one query over all of their submissions should override this.
+
+        :param participations: An iterable of ContestParticipation objects.
+        :return: None
+        """
+        for participation in participations:
+            self.update_participation(participation)
+
+    def apply_submission(self, participation, contest_submission):
+        """
+        Updates a ContestParticipation object after one of its submissions was graded for the first time.
+        Formats that can apply a single submission to the stored format_data should override this; by default
+        the whole participation is recomputed with update_participation.
+
+        :param participation: A ContestParticipation object.
+        :param contest_submission: The ContestSubmission that was just graded.
+        :return: None
+        """
+        self.update_participation(participation)
+
     @abstractmethod
     def display_user_problem(self, participation, contest_problem):
         """
@@ -1,8 +1,8 @@
+from collections import defaultdict
 from datetime import timedelta
 
 from django.core.exceptions import ValidationError
-from django.db import connection
-from django.db.models import Max
+from django.db.models import Count, Min, Q
 from django.template.defaultfilters import floatformat
 from django.urls import reverse
 from django.utils.html import format_html
@@ -12,7 +12,6 @@ from django.utils.translation import gettext as ungettext
 
 from .default import DefaultContestFormat
 from .registry import register_contest_format
-from helpers.timezone import from_database_time
 from helpers.timedelta import nice_repr
 
 
@@ -46,7 +45,16 @@ class ICPCContestFormat(DefaultContestFormat):
         self.config.update(config or {})
         self.contest = contest
 
-    def update_participation(self, participation):
+    # Fields of a ContestSubmission, with its Submission, that results are computed from
+    SUBMISSION_FIELDS = ('problem_id', 'points', 'submission__date', 'submission__result', 'id')
+    RESULT_FIELDS = ['score', 'cumtime', 'tiebreaker', 'format_data',
+                     'frozen_score', 'frozen_cumtime', 'frozen_tiebreaker', 'frozen_format_data', 'frozen_time']
+
+    def _compute_participation(self, participation, rows):
+        """
+        Sets a participation's results from all of its (problem_id, points, date, result, id) submission rows,
+        without touching the database.
+        """
         cumtime = 0
         last = 0
         penalty = 0
@@ -59,112 +67,97 @@ class ICPCContestFormat(DefaultContestFormat):
         frozen_penalty = 0
         frozen_score = 0
         frozen_time = participation.contest.frozen_time
+        is_frozen = participation.is_frozen
+
+        by_problem = defaultdict(list)
+        for problem_id, points, date, result, id in rows:
+            by_problem[problem_id].append((points, date, result, id))
 
         frozen_format_data = {}
 
-        with connection.cursor() as cursor:
-            cursor.execute("""
-                SELECT MAX(cs.points) as points, (
-                    SELECT MIN(csub.date)
-                        FROM compete_contestsubmission ccs LEFT OUTER JOIN
-                             submission_submission csub ON (csub.id = ccs.submission_id)
-                        WHERE ccs.problem_id = cp.id
-                            AND ccs.participation_id = %s AND ccs.points = MAX(cs.points)
-                ) AS time, cp.id AS prob
-                FROM compete_contestproblem cp INNER JOIN
-                     compete_contestsubmission cs ON
-                        (cs.problem_id = cp.id AND cs.participation_id = %s)
-                     LEFT OUTER JOIN
-                     submission_submission sub ON (sub.id = cs.submission_id)
-                GROUP BY cp.id
-            """, (participation.id, participation.id))
-
-            for points, time, prob in cursor.fetchall():
-                time = from_database_time(time)
-                dt_seconds = (time - participation.start).total_seconds()
-                dt = int(dt_seconds // 60)
-                # Frozen and sub_time after frozen
-                is_frozen_sub = (participation.is_frozen and time >= frozen_time)
-
-                sub_time = dt_seconds
-
-                frozen_sub_time = sub_time
-                frozen_points = 0
-                frozen_tries = 0
-                _tries = None
-
-                # Compute penalty
-                if self.config['penalty']:
-                    # An IE can have a submission result of 'None'
-                    subs = participation.submissions.exclude(submission__result__isnull=True) \
-                                                    .exclude(submission__result__in=['IE', 'CE']) \
-                                                    .filter(problem_id=prob)
-
-                    if points: ## Acceptted
-                        # Submissions after the first AC does not count toward number of tries
-                        tries = subs.filter(submission__date__lte=time).count()
-                        _tries = tries
-                        penalty += (tries - 1) * self.config['penalty']
-
-                        if not is_frozen_sub: ## AC BEFORE FROZEN
-                            # frozen_XX == XX
-                            frozen_penalty += (tries - 1) * self.config['penalty']
-                            frozen_tries = tries
-                            # frozen_sub_time = sub_time # Already set
-                        else:
-                            ## AC_AFTER FROZEN
-                            # Tries should be number of attempts
-                            tries = subs.count()
-                            if tries > 0:
-                                frozen_tries = subs.filter(submission__date__lt=frozen_time).count()
-
-                                # We should always display latest sub time to hide the fact that this participant
-                                # has solved this problem if they were to sub more after AC
-                                frozen_sub_time = subs.aggregate(time=Max('submission__date'))['time']
-                                frozen_sub_time = from_database_time(frozen_sub_time)
-                                # number of minutes from start to last submission
-                                frozen_sub_time = (frozen_sub_time - participation.start).total_seconds()
+        for prob, subs in by_problem.items():
+            points = max(sub[0] for sub in subs)
+            # The first submission with the best score
+            time = min(sub[1] for sub in subs if sub[0] == points)
+            dt_seconds = (time - participation.start).total_seconds()
+            dt = int(dt_seconds // 60)
+            # Frozen and sub_time after frozen
+            is_frozen_sub = (is_frozen and time >= frozen_time)
+
+            sub_time = dt_seconds
+
+            frozen_sub_time = sub_time
+            frozen_points = 0
+            frozen_tries = 0
+            _tries = None
+
+            # Compute penalty
+            if self.config['penalty']:
+                # An IE can have a submission result of 'None'
+                counted = [date for _, date, result, _ in subs if result is not None and result not in ('IE', 'CE')]
+
+                if points: ## Acceptted
+                    # Submissions after the first AC does not count toward number of tries
+                    tries = sum(date <= time for date in counted)
+                    _tries = tries
+                    penalty += (tries - 1) * self.config['penalty']
+
+                    if not is_frozen_sub: ## AC BEFORE FROZEN
+                        # frozen_XX == XX
+                        frozen_penalty += (tries - 1) * self.config['penalty']
+                        frozen_tries = tries
+                        # frozen_sub_time = sub_time # Already set
                     else:
-                        # Not acceptted in anyway, points == frozen_points == 0
-                        tries = subs.count()
+                        ## AC_AFTER FROZEN
+                        # Tries should be number of attempts
+                        tries = len(counted)
                         if tries > 0:
-                            frozen_tries = subs.filter(submission__date__lt=frozen_time).count()
-
-                            sub_time = subs.aggregate(time=Max('submission__date'))['time']
-                            sub_time = from_database_time(sub_time)
-                            # sub_time = int((sub_time - participation.start).total_seconds() // 60)
-                            sub_time = sub_time - participation.start
-                            sub_time = sub_time.total_seconds()
-                            frozen_sub_time = sub_time
-                        else:
-                            is_frozen_sub = False
+                            frozen_tries = sum(date < frozen_time for date in counted)
+
+                            # We should always display latest sub time to hide the fact that this participant
+                            # has solved this problem if they were to sub more after AC
+                            frozen_sub_time = (max(counted) - participation.start).total_seconds()
                 else:
-                    tries = 0
-
-                if points:
-                    cumtime += dt
-                    last = max(last, dt)
-                    score += points
-
-                    if not is_frozen_sub:
-                        frozen_points = points
-                        frozen_cumtime += dt
-                        frozen_last = max(frozen_last, dt)
-                        frozen_score += points
-
-                format_data[str(prob)] = {
-                    'sub_time': sub_time, ## Submission time
-                    'points': points, ## AC or Not
-                    'tries': _tries if _tries is not None else tries, ## Tries
-                }
-                frozen_format_data[str(prob)] = {
-                    'sub_time': frozen_sub_time,
-                    'points': frozen_points, ## AC or Not before Frozen
-                    'tries': frozen_tries, ## Tries
-
-                    'tries_after_frozen': tries-frozen_tries, ## Tries before frozen
-                    # 'is_frozen': is_frozen_sub, ## If participant submit after frozen
-                }
+                    # Not acceptted in anyway, points == frozen_points == 0
+                    tries = len(counted)
+                    if tries > 0:
+                        frozen_tries = sum(date < frozen_time for date in counted)
+
+                        sub_time = (max(counted) - participation.start).total_seconds()
+                        frozen_sub_time = sub_time
+                    else:
+                        is_frozen_sub = False
+            else:
+                tries = 0
+
+            if points:
+                cumtime += dt
+                last = max(last, dt)
+                score += points
+
+                if not is_frozen_sub:
+                    frozen_points = points
+                    frozen_cumtime += dt
+                    frozen_last = max(frozen_last, dt)
+                    frozen_score += points
+
+            # The latest graded submission, so that apply_submission can tell it was already counted
+            graded = [(date, id) for _, date, result, id in subs if result is not None]
+
+            format_data[str(prob)] = {
+                'sub_time': sub_time, ## Submission time
+                'points': points, ## AC or Not
+                'tries': _tries if _tries is not None else tries, ## Tries
+                'last_submission': max(graded)[1] if graded else None, ## ContestSubmission id
+            }
+            frozen_format_data[str(prob)] = {
+                'sub_time': frozen_sub_time,
+                'points': frozen_points, ## AC or Not before Frozen
+                'tries': frozen_tries, ## Tries
+
+                'tries_after_frozen': tries-frozen_tries, ## Tries before frozen
+                # 'is_frozen': is_frozen_sub, ## If participant submit after frozen
+            }
 
         participation.cumtime = cumtime + penalty
         participation.score = round(score, self.contest.points_precision)
@@ -177,8 +170,128 @@ class ICPCContestFormat(DefaultContestFormat):
         participation.frozen_format_data = frozen_format_data
         participation.frozen_time = frozen_time
 
+    def update_participation(self, participation):
+        self._compute_participation(participation, participation.submissions.values_list(*self.SUBMISSION_FIELDS))
         participation.save()
 
+    def update_participations(self, participations):
+        """
+        Recomputes many participations of this contest from one query over all of their submissions,
+        and writes them back with bulk_update.
+        """
+        from compete.models import ContestParticipation, ContestSubmission
+
+        participations = list(participations)
+        for participation in participations:
+            participation.contest = self.contest
+        by_id = {participation.id: participation for participation in participations}
+
+        rows = defaultdict(list)
+        for participation_id, *row in ContestSubmission.objects.filter(participation_id__in=list(by_id)) \
+                .values_list('participation_id', *self.SUBMISSION_FIELDS).iterator():
+            rows[participation_id].append(row)
+
+        for participation in participations:
+            self._compute_participation(participation, rows.pop(participation.id, ()))
+        ContestParticipation.objects.bulk_update(participations, self.RESULT_FIELDS, batch_size=self.BULK_CHUNK_SIZE)
+
+    def apply_submission(self, participation, contest_submission):
+        """
+        Applies one newly graded submission to the stored format_data and frozen_format_data, with a single
+        query for the submission's problem instead of several for every problem.
+
+        Falls back to update_participation when the stored data can't tell the outcome: results written for
+        another frozen time, an earlier submission graded after a later one, a submission graded again
+        (a requeue or an internal error), or a higher partial score on a problem that already had points.
+        """
+        frozen_time = participation.contest.frozen_time
+        if participation.format_data is None or participation.frozen_format_data is None or \
+                participation.frozen_time != frozen_time:
+            return self.update_participation(participation)
+
+        key = str(contest_submission.problem_id)
+        entry = participation.format_data.get(key) or {'sub_time': None, 'points': 0, 'tries': 0}
+        last = entry.get('last_submission')
+        if last == contest_submission.id:
+            return self.update_participation(participation)
+
+        submission = contest_submission.submission
+        # The last counted submission is later even if it has been requeued since.
+        others = participation.submissions.filter(problem_id=contest_submission.problem_id) \
+            .exclude(id=contest_submission.id) \
+            .aggregate(first=Min('submission__date'),
+                       later=Count('id', filter=Q(submission__date__gte=submission.date) &
+                                   (Q(submission__result__isnull=False) | Q(id=last))))
+        if others['later']:
+            return self.update_participation(participation)
+
+        penalty = self.config['penalty']
+        frozen_entry = participation.frozen_format_data.get(key) or \
+            {'sub_time': None, 'points': 0, 'tries': 0, 'tries_after_frozen': 0}
+
+        points = contest_submission.points
+        sub_time = (submission.date - participation.start).total_seconds()
+        counted = int(bool(penalty) and submission.result not in (None, 'IE', 'CE'))
+        before_frozen = submission.date < frozen_time
+        if submission.result is not None:
+            last = contest_submission.id
+
+        if entry['points']:
+            if points > entry['points'] or sub_time <= entry['sub_time']:
+                return self.update_participation(participation)
+            participation.format_data = dict(participation.format_data, **{key: dict(entry, last_submission=last)})
+            if frozen_entry['points'] or not counted:
+                # Solved before the freeze: later attempts change nothing else.
+                participation.save(update_fields=['format_data', 'modified'])
+                return
+            # Solved after the freeze: the frozen view shows one more attempt, at this time.
+            frozen_entry = dict(frozen_entry, sub_time=sub_time,
+                                tries_after_frozen=frozen_entry['tries_after_frozen'] + 1)
+            participation.frozen_format_data = dict(participation.frozen_format_data, **{key: frozen_entry})
+            participation.save(update_fields=['format_data', 'frozen_format_data', 'modified'])
+            return
+
+        if penalty and points and not counted:
+            return self.update_participation(participation)
+
+        tries = entry['tries'] + counted
+        frozen_tries = frozen_entry['tries'] + (counted and before_frozen)
+        if points:
+            dt = int(sub_time // 60)
+            is_frozen_sub = participation.is_frozen and not before_frozen
+
+            participation.cumtime += dt + (tries - 1) * penalty
+            participation.score = round(participation.score + points, self.contest.points_precision)
+            participation.tiebreaker = max(participation.tiebreaker, dt)
+            if is_frozen_sub:
+                frozen_entry = {'sub_time': sub_time, 'points': 0, 'tries': frozen_tries,
+                                'tries_after_frozen': tries - frozen_tries}
+            else:
+                participation.frozen_cumtime += dt + (tries - 1) * penalty
+                participation.frozen_score = round(participation.frozen_score + points,
+                                                   self.contest.points_precision)
+                participation.frozen_tiebreaker = max(participation.frozen_tiebreaker, dt)
+                frozen_entry = {'sub_time': sub_time, 'points': points, 'tries': tries, 'tries_after_frozen': 0}
+        else:
+            if tries:
+                # Time of the last counted attempt
+                sub_time = sub_time if counted else entry['sub_time']
+            else:
+                # Time of the first submission of any kind
+                first = others['first']
+                if first is not None and first < submission.date:
+                    sub_time = (first - participation.start).total_seconds()
+            frozen_entry = {'sub_time': sub_time, 'points': points, 'tries': frozen_tries,
+                            'tries_after_frozen': tries - frozen_tries}
+        entry = {'sub_time': sub_time, 'points': points, 'tries': tries, 'last_submission': last}
+
+        participation.format_data = dict(participation.format_data, **{key: entry})
+        participation.frozen_format_data = dict(participation.frozen_format_data, **{key: frozen_entry})
+        participation.save(update_fields=[
+            'cumtime', 'score', 'tiebreaker', 'format_data',
+            'frozen_cumtime', 'frozen_score', 'frozen_tiebreaker', 'frozen_format_data', 'modified',
+        ])
+
     def display_user_problem(self, participation, contest_problem):
         raise NotImplementedError
 
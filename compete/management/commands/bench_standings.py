@@ -0,0 +1,132 @@
+import random
+import time
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from compete.models import Contest, ContestParticipation, ContestProblem, ContestSubmission
+from judger.models import Language
+from problem.models import Problem
+from submission.models import Submission
+from userprofile.models import UserProfile
+
+LANGUAGE_KEY = 'BENCH'
+RESULTS = ['AC', 'WA', 'WA', 'TLE', 'RTE', 'CE', 'IE']
+
+
+class Command(BaseCommand):
+    help = 'benchmark recomputing the standings of a synthetic ICPC contest, one participation at a time ' \
+           'and in bulk, against a throwaway copy of the configured database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--participants', type=int, default=2000, help='number of participants')
+        parser.add_argument('--problems', type=int, default=13, help='number of contest problems')
+        parser.add_argument('--submissions', type=int, default=12, help='average submissions per participant')
+        parser.add_argument('--keepdb', action='store_true', help='keep the test database between runs')
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=options['verbosity'], autoclobber=True,
+                                           keepdb=options['keepdb'])
+        try:
+            self.run(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=options['verbosity'],
+                                                keepdb=options['keepdb'])
+
+    def create_fixtures(self, options):
+        language, _ = Language.objects.get_or_create(key=LANGUAGE_KEY, defaults={
+            'name': 'Benchmark', 'common_name': 'Benchmark', 'ace': 'text', 'pygments': 'text', 'extension': 'txt',
+        })
+
+        now = timezone.now()
+        contest = Contest.objects.create(
+            key='benchstandings', name='Standings benchmark', format_name='icpc',
+            start_time=now - timedelta(hours=5), end_time=now + timedelta(minutes=1),
+            enable_frozen=True, frozen_time=now - timedelta(hours=1),
+        )
+        codes = ['BENCH_%03d' % i for i in range(options['problems'])]
+        Problem.objects.bulk_create([Problem(shortname=code, title=code) for code in codes])
+        problems = list(Problem.objects.filter(shortname__in=codes))
+        ContestProblem.objects.bulk_create([
+            ContestProblem(contest=contest, problem=problem, points=1, partial=False, order=i)
+            for i, problem in enumerate(problems)
+        ])
+        contest_problems = list(contest.contest_problems.all())
+
+        User = get_user_model()
+        names = ['bench%d' % i for i in range(options['participants'])]
+        User.objects.bulk_create([User(username=name) for name in names])
+        UserProfile.objects.bulk_create([
+            UserProfile(user=user, username_display_override=user.username)
+            for user in User.objects.filter(username__in=names)
+        ])
+        profiles = UserProfile.objects.filter(user__username__in=names)
+        ContestParticipation.objects.bulk_create([
+            ContestParticipation(contest=contest, user=profile, real_start=contest.start_time) for profile in profiles
+        ])
+        participations = list(contest.users.all())
+
+        span = (contest.end_time - contest.start_time).total_seconds()
+        rows = []
+        for participation in participations:
+            for _ in range(random.randint(0, options['submissions'] * 2)):
+                rows.append((participation, random.choice(contest_problems), random.choice(RESULTS),
+                             contest.start_time + timedelta(seconds=random.uniform(0, span))))
+        submissions = Submission.objects.bulk_create([
+            Submission(user_id=participation.user_id, problem_id=problem.problem_id, language=language,
+                       status='D', result=result, contest_object=contest)
+            for participation, problem, result, _ in rows
+        ])
+        # `date` is set on creation, so the spread out times are written afterwards.
+        for submission, (_, _, _, date) in zip(submissions, rows):
+            submission.date = date
+        Submission.objects.bulk_update(submissions, ['date'], batch_size=1000)
+        ContestSubmission.objects.bulk_create([
+            ContestSubmission(submission=submission, problem=problem, participation=participation,
+                              points=1 if result == 'AC' else 0)
+            for submission, (participation, problem, result, _) in zip(submissions, rows)
+        ], batch_size=1000)
+        return contest, len(rows)
+
+    def _snapshot(self, contest):
+        return {
+            participation.id: [getattr(participation, field) for field in contest.format.RESULT_FIELDS]
+            for participation in contest.users.all()
+        }
+
+    def run(self, options):
+        contest, count = self.create_fixtures(options)
+        format = contest.format
+        participations = list(contest.users.all())
+        self.stdout.write('Contest with %d participant(s), %d problem(s) and %d submission(s)' % (
+            len(participations), options['problems'], count))
+
+        with CaptureQueriesContext(connection) as queries, transaction.atomic():
+            start = time.perf_counter()
+            for participation in participations:
+                format.update_participation(participation)
+            elapsed = time.perf_counter() - start
+        self.stdout.write('One at a time: %8.2fs  %8d queries' % (elapsed, len(queries)))
+        expected = self._snapshot(contest)
+
+        ContestParticipation.objects.filter(contest=contest).update(score=0, cumtime=0, format_data=None)
+        participations = list(contest.users.order_by('id'))
+        with CaptureQueriesContext(connection) as queries, transaction.atomic():
+            start = time.perf_counter()
+            # The same chunking as compete.tasks.recompute_standing
+            for i in range(0, len(participations), format.BULK_CHUNK_SIZE):
+                format.update_participations(participations[i:i + format.BULK_CHUNK_SIZE])
+            elapsed = time.perf_counter() - start
+        self.stdout.write('Bulk:          %8.2fs  %8d queries' % (elapsed, len(queries)))
+
+        mismatched = [id for id, fields in self._snapshot(contest).items() if fields != expected[id]]
+        if mismatched:
+            self.stderr.write('%d participation(s) differ between the two, e.g. %s' % (
+                len(mismatched), mismatched[:10]))
+        else:
+            self.stdout.write('Both produced the same standings')
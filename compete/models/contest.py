@@ -616,6 +616,8 @@ class Contest(models.Model):
         for view_mode in ['full', 'froze']:
             cache_key = f"contest-{self.key}-scoreboard-{view_mode}"
             keys.append(cache_key)
+        # Problems and organizations of the materialized scoreboard; its rows are kept up to date by themselves
+        keys.append(f"contest-{self.key}-scoreboard-meta")
         cache.delete_many(keys)
 
     ## cache_keys
@@ -629,6 +631,8 @@ class Contest(models.Model):
         for view_mode in ['full', 'froze']:
             cache_key = f"contest-{self.key}-scoreboard-{view_mode}"
             keys.append(cache_key)
+        # Problems and organizations of the materialized scoreboard; its rows are kept up to date by themselves
+        keys.append(f"contest-{self.key}-scoreboard-meta")
         cache.delete_many(keys)
 
     ## Django model methods
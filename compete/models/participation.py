@@ -79,6 +79,17 @@ class ContestParticipation(models.Model):
                 self.save(update_fields=['score', 'cumtime', 'tiebreaker', 'frozen_score', 'frozen_cumtime', 'frozen_tiebreaker'])
     recompute_results.alters_data = True
 
+    def apply_submission(self, contest_submission):
+        if self.is_disqualified:
+            self.recompute_results()
+            return
+        with transaction.atomic():
+            # Formats may update the stored results in place, so two submissions graded at once must take turns.
+            participation = ContestParticipation.objects.select_for_update().get(id=self.id)
+            participation.contest = self.contest
+            self.contest.format.apply_submission(participation, contest_submission)
+    apply_submission.alters_data = True
+
     def set_disqualified(self, disqualified):
         self.is_disqualified = disqualified
         self.recompute_results()
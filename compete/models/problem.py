@@ -63,7 +63,7 @@ class ContestProblem(models.Model):
     def label(self):
         return self.contest.get_label_for_problem(self.order)
 
-    def expensive_recompute_stats(self, force_update=False):
+    def expensive_recompute_stats(self, force_update=False, clear_cache=True):
         contest = self.contest
         liveparts = contest.users.filter(virtual=0).values_list('user_id', flat=True)
         queryset = self.submissions.prefetch_related('submission', 'submission_user').\
@@ -89,7 +89,14 @@ class ContestProblem(models.Model):
                 self.frozen_attempted_count = totals
                 self.frozen_solved_count = solves
 
-        self.save()
+        if clear_cache:
+            self.save()
+        else:
+            # The caller recomputes several problems and clears the scoreboard cache once itself.
+            ContestProblem.objects.filter(id=self.id).update(
+                attempted_count=self.attempted_count, solved_count=self.solved_count,
+                frozen_attempted_count=self.frozen_attempted_count, frozen_solved_count=self.frozen_solved_count,
+            )
 
     def clean(self):
         try:
@@ -99,7 +106,7 @@ class ContestProblem(models.Model):
 
     def save(self, *args, **kwargs):
         self.clean()
-        rs = super().save(args, kwargs)
+        rs = super().save(*args, **kwargs)
         self.contest.clear_scoreboard_cache()
         return rs
 
@@ -0,0 +1,402 @@
+"""
+Contest scoreboards materialized in Redis.
+
+Every live participation of a contest is kept, for each scoreboard view ('full' and 'froze'), as
+a member of a sorted set ranking it by (score, cumtime, tiebreaker, user) and as its serialized
+standing row. Rows are rewritten whenever a participation is saved, so a scoreboard request reads
+one page of ready rows instead of serializing the whole contest.
+
+A scoreboard is built from the database the first time it is read, by one request at a time.
+Rows carry the participation's `modified` time, and an older row never replaces a newer one.
+
+Each view has a version that grows with every row that changes, so clients can ask for the rows
+changed since the version they have (Scoreboard.delta), and unchanged polls can be answered with
+304 Not Modified.
+"""
+import json
+import logging
+import time
+
+import redis
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from rest_framework.serializers import DateTimeField
+from rest_framework.utils.encoders import JSONEncoder
+
+from compete.models import ContestParticipation
+from compete.serializers import ContestStandingFrozenSerializer, ContestStandingSerializer
+from organization.models import Organization
+from organization.serializers import OrganizationBasicSerializer
+
+logger = logging.getLogger(__name__)
+
+MODES = {
+    'full': (ContestStandingSerializer, 'score', 'cumtime', 'tiebreaker'),
+    'froze': (ContestStandingFrozenSerializer, 'frozen_score', 'frozen_cumtime', 'frozen_tiebreaker'),
+}
+
+# Seconds a scoreboard is kept after its last change; an expired one is rebuilt on its next read
+SCOREBOARD_TTL = 7 * 24 * 60 * 60
+# Seconds one request may spend building a scoreboard before another may try
+BUILD_LOCK_TIMEOUT = 60
+
+# Every change of a scoreboard view bumps its version, a counter that starts at the time (in microseconds) the
+# view was first written, so it keeps growing even if the view is dropped and built again. The version of a
+# row's last change is kept in `changes`, and that of a removed participation's user in `removed`.
+_BUMP = '''
+local function bump(version_key, start_key, start)
+    if redis.call('EXISTS', version_key) == 0 then
+        redis.call('SET', version_key, start)
+        redis.call('SET', start_key, start)
+    end
+    return redis.call('INCR', version_key)
+end
+'''
+
+# KEYS: rank, members, rows, modified, version, start, changes, removed
+# ARGV: participation id, score, member, row, modified time, start version, user
+_REPLACE = _BUMP + '''
+local modified = redis.call('HGET', KEYS[4], ARGV[1])
+if modified and tonumber(modified) > tonumber(ARGV[5]) then
+    return 0
+end
+redis.call('HSET', KEYS[4], ARGV[1], ARGV[5])
+local old = redis.call('HGET', KEYS[2], ARGV[1])
+if old == ARGV[3] and redis.call('HGET', KEYS[3], ARGV[1]) == ARGV[4] then
+    return 0
+end
+if old then
+    redis.call('ZREM', KEYS[1], old)
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[3])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[4])
+local version = bump(KEYS[5], KEYS[6], ARGV[6])
+redis.call('ZADD', KEYS[7], version, ARGV[1])
+redis.call('ZREM', KEYS[8], ARGV[7])
+return 1
+'''
+
+# KEYS: rank, members, rows, modified, version, start, changes, removed
+# ARGV: participation id, start version
+_REMOVE = _BUMP + '''
+local old = redis.call('HGET', KEYS[2], ARGV[1])
+if not old then
+    return 0
+end
+local user = cjson.decode(redis.call('HGET', KEYS[3], ARGV[1]))['user']
+redis.call('ZREM', KEYS[1], old)
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('HDEL', KEYS[4], ARGV[1])
+local version = bump(KEYS[5], KEYS[6], ARGV[2])
+redis.call('ZREM', KEYS[7], ARGV[1])
+redis.call('ZADD', KEYS[8], version, user)
+return 1
+'''
+
+# Appends the rows of participation ids to result, in batches, as unpack() is limited to a few thousand values.
+_APPEND_ROWS = '''
+local function append_rows(result, rows_key, ids)
+    for first = 1, #ids, 1000 do
+        local batch = {}
+        for i = first, math.min(first + 999, #ids) do
+            batch[#batch + 1] = ids[i]
+        end
+        for _, row in ipairs(redis.call('HMGET', rows_key, unpack(batch))) do
+            result[#result + 1] = row
+        end
+    end
+end
+'''
+
+# KEYS: rank, rows, version
+# ARGV: start, stop
+# Returns the number of rows, the version, then the rows of the page.
+_PAGE = _APPEND_ROWS + '''
+local members = redis.call('ZRANGE', KEYS[1], ARGV[1], ARGV[2])
+local ids = {}
+for i, member in ipairs(members) do
+    ids[i] = string.match(member, ':(%d+)$')
+end
+local result = {redis.call('ZCARD', KEYS[1]), redis.call('GET', KEYS[3]) or '0'}
+append_rows(result, KEYS[2], ids)
+return result
+'''
+
+# KEYS: rank, rows, version, start, changes, removed
+# ARGV: since
+# Returns the number of rows, the version, the start version, the number of changed rows,
+# then the changed rows and the users removed since then.
+_DELTA = _APPEND_ROWS + '''
+local ids = redis.call('ZRANGEBYSCORE', KEYS[5], '(' .. ARGV[1], '+inf')
+local result = {redis.call('ZCARD', KEYS[1]), redis.call('GET', KEYS[3]) or '0',
+                redis.call('GET', KEYS[4]) or '0', #ids}
+append_rows(result, KEYS[2], ids)
+for _, user in ipairs(redis.call('ZRANGEBYSCORE', KEYS[6], '(' .. ARGV[1], '+inf')) do
+    result[#result + 1] = user
+end
+return result
+'''
+
+_client = None
+_scripts = {}
+
+
+def _get_client():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.BKDNOJ_SCOREBOARD_REDIS, decode_responses=True)
+        _scripts['replace'] = _client.register_script(_REPLACE)
+        _scripts['remove'] = _client.register_script(_REMOVE)
+        _scripts['page'] = _client.register_script(_PAGE)
+        _scripts['delta'] = _client.register_script(_DELTA)
+    return _client
+
+
+def _member(participation, cumtime, tiebreaker):
+    # Members of equal score are ordered as strings, so every field is zero-padded to a fixed width.
+    return '%012d:%026.6f:%012d:%d' % (getattr(participation, cumtime), getattr(participation, tiebreaker) + 1e12,
+                                       participation.user_id, participation.id)
+
+
+def _modified(participation):
+    return participation.modified.timestamp() if participation.modified else 0
+
+
+def _start_version():
+    return int(time.time() * 1e6)
+
+
+def _keys(contest_id, mode):
+    """
+    Returns the keys of one view of a contest's scoreboard: rank, members, rows, modified, version, start,
+    changes and removed, in the order the scripts take them.
+    """
+    prefix = 'scoreboard:%d:' % contest_id
+    return [prefix + name + ':' + mode
+            for name in ('rank', 'members', 'rows', 'modified', 'version', 'start', 'changes', 'removed')]
+
+
+class Scoreboard(object):
+    def __init__(self, contest):
+        self.contest = contest
+        self.client = _get_client()
+        self.prefix = 'scoreboard:%d:' % contest.id
+
+    def _all_keys(self):
+        return [key for mode in MODES for key in _keys(self.contest.id, mode)] + [self.prefix + 'built']
+
+    @property
+    def meta_cache_key(self):
+        return 'contest-%s-scoreboard-meta' % self.contest.key
+
+    def _participations(self, ids=None):
+        queryset = ContestParticipation.objects.filter(contest_id=self.contest.id, virtual=ContestParticipation.LIVE)
+        if ids is not None:
+            queryset = queryset.filter(id__in=ids)
+        return queryset.select_related('user__user', 'organization')
+
+    def _write(self, participations, pipe):
+        start = _start_version()
+        for mode, (serializer, score, cumtime, tiebreaker) in MODES.items():
+            keys = _keys(self.contest.id, mode)
+            rows = serializer(participations, many=True).data
+            for participation, row in zip(participations, rows):
+                _scripts['replace'](keys=keys, args=[
+                    participation.id, -getattr(participation, score), _member(participation, cumtime, tiebreaker),
+                    json.dumps(row, cls=JSONEncoder), _modified(participation), start, row['user'],
+                ], client=pipe)
+        for key in self._all_keys():
+            pipe.expire(key, SCOREBOARD_TTL)
+
+    def update(self, ids):
+        participations = list(self._participations(ids))
+        if not participations:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        self._write(participations, pipe)
+        pipe.execute()
+
+        meta = cache.get(self.meta_cache_key)
+        if meta is not None and any(participation.organization_id not in meta['organization_ids']
+                                    for participation in participations if participation.organization_id):
+            cache.delete(self.meta_cache_key)
+
+    def build(self):
+        """
+        Writes every live participation of the contest. Only one caller builds at a time.
+
+        :return: Whether the scoreboard was built.
+        """
+        lock = self.prefix + 'building'
+        if not self.client.set(lock, 1, nx=True, ex=BUILD_LOCK_TIMEOUT):
+            return False
+        try:
+            start = time.monotonic()
+            participations = list(self._participations())
+            pipe = self.client.pipeline(transaction=False)
+            self._write(participations, pipe)
+            pipe.set(self.prefix + 'built', 1, ex=SCOREBOARD_TTL)
+            pipe.execute()
+            logger.info('Built scoreboard of contest %s with %d participation(s) in %.2fs', self.contest.key,
+                        len(participations), time.monotonic() - start)
+            return True
+        finally:
+            self.client.delete(lock)
+
+    def _meta(self):
+        meta = cache.get(self.meta_cache_key)
+        if meta is None:
+            contest = self.contest
+            problems = [{
+                'id': p.id,
+                'label': p.label,
+                'shortname': p.problem.shortname,
+                'points': p.points,
+                'partial': p.partial,
+            } for p in contest.contest_problems.prefetch_related('problem').all()]
+            organizations = Organization.objects.filter(id__in=contest.users
+                                                        .annotate(org=F('organization'))
+                                                        .exclude(org=None)
+                                                        .values_list('org', flat=True).order_by('org').distinct())
+            meta = {
+                'problems': problems,
+                'organizations': OrganizationBasicSerializer(organizations, many=True).data,
+                'organization_ids': [organization.id for organization in organizations],
+                # Tells apart responses built from different problems or organizations
+                'stamp': _start_version(),
+            }
+            cache.set(self.meta_cache_key, meta, SCOREBOARD_TTL)
+        return meta
+
+    def read(self, mode, offset=0, limit=None):
+        """
+        Returns one page of the scoreboard in the shape of the standing view's response, with the
+        scoreboard's version, or None if the scoreboard isn't built and someone else is building it,
+        or Redis can't be reached.
+        """
+        try:
+            if not self._ensure_built():
+                return None
+            keys = _keys(self.contest.id, mode)
+            stop = -1 if limit is None else offset + limit - 1
+            total, version, *rows = _scripts['page'](keys=[keys[0], keys[2], keys[4]], args=[offset, stop])
+        except redis.RedisError:
+            logger.exception('Failed to read scoreboard of contest %s', self.contest.key)
+            return None
+        return self._response(mode, total, int(version), rows)
+
+    def delta(self, mode, since):
+        """
+        Returns the rows changed since version `since`, and the users removed since then, or None
+        like read(). When the scoreboard was built again after `since`, all of its rows are returned
+        and `full` is set, as what was removed before is no longer known.
+        """
+        try:
+            if not self._ensure_built():
+                return None
+            keys = _keys(self.contest.id, mode)
+            total, version, start, changed, *rest = _scripts['delta'](
+                keys=[keys[0], keys[2], keys[4], keys[5], keys[6], keys[7]], args=[since])
+        except redis.RedisError:
+            logger.exception('Failed to read scoreboard changes of contest %s', self.contest.key)
+            return None
+        data = self._response(mode, total, int(version), rest[:changed])
+        data['since'] = since
+        data['full'] = since < int(start)
+        data['removed'] = [] if data['full'] else rest[changed:]
+        return data
+
+    def version(self, mode):
+        """
+        Returns the current version of a scoreboard view, without building it.
+        """
+        try:
+            version = self.client.get(_keys(self.contest.id, mode)[4])
+        except redis.RedisError:
+            logger.exception('Failed to read scoreboard version of contest %s', self.contest.key)
+            return None
+        return None if version is None else int(version)
+
+    def etag(self, mode, version, *extra):
+        """
+        Returns an ETag for a response built from this version of a scoreboard view, the current
+        problems and organizations, and anything else the response depends on.
+        """
+        parts = [self.contest.id, mode, version, self._meta()['stamp'], self.contest.is_frozen] + list(extra)
+        return '"%s"' % '-'.join(map(str, parts))
+
+    def _ensure_built(self):
+        return self.client.exists(self.prefix + 'built') or self.build()
+
+    def _response(self, mode, total, version, rows):
+        is_frozen = self.contest.is_frozen
+        results = []
+        for row in rows:
+            if row is None:
+                continue
+            row = json.loads(row)
+            # The contest freezes while rows stay the same.
+            row['is_frozen'] = is_frozen
+            results.append(row)
+
+        meta = self._meta()
+        return {
+            'organizations': meta['organizations'],
+            'problems': meta['problems'],
+            'results': results,
+            'count': total,
+            'version': version,
+            'is_frozen': mode == 'froze',
+            'is_frozen_enabled': self.contest.enable_frozen,
+            'frozen_time': DateTimeField().to_representation(self.contest.frozen_time),
+            'scoreboard_cache_duration': self.contest.scoreboard_cache_duration,
+        }
+
+    def clear(self):
+        cache.delete(self.meta_cache_key)
+        self.client.delete(*self._all_keys())
+
+
+def get_scoreboard(contest):
+    """
+    Returns the materialized scoreboard of a contest, or None when BKDNOJ_SCOREBOARD_REDIS is not set.
+    """
+    if not settings.BKDNOJ_SCOREBOARD_REDIS:
+        return None
+    return Scoreboard(contest)
+
+
+def update_scoreboard(contest, participation_ids):
+    """
+    Rewrites the rows of the given participations, after their results changed. Never raises: a failed
+    write is logged, and the scoreboard is dropped so that its next read builds it again.
+    """
+    if not settings.BKDNOJ_SCOREBOARD_REDIS:
+        return
+    scoreboard = Scoreboard(contest)
+    try:
+        scoreboard.update(participation_ids)
+    except Exception:
+        logger.exception('Failed to update scoreboard of contest %s', contest.key)
+        try:
+            scoreboard.clear()
+        except redis.RedisError:
+            pass
+
+
+def remove_from_scoreboard(contest_id, participation_ids):
+    # Takes an id, as the contest itself may be gone.
+    if not settings.BKDNOJ_SCOREBOARD_REDIS:
+        return
+    try:
+        _get_client()
+        pipe = _client.pipeline(transaction=False)
+        for mode in MODES:
+            for id in participation_ids:
+                _scripts['remove'](keys=_keys(contest_id, mode), args=[id, _start_version()], client=pipe)
+        pipe.execute()
+    except redis.RedisError:
+        logger.exception('Failed to remove participation(s) from scoreboard of contest %d', contest_id)
@@ -1,4 +1,7 @@
-from django.db.models.signals import post_save, pre_delete
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
 
 import shutil
@@ -7,6 +10,18 @@ import logging
 logger = logging.getLogger(__name__)
 
 from compete.models import Contest, ContestProblem, ContestParticipation
+from compete.scoreboard import remove_from_scoreboard, update_scoreboard
+
+
+@receiver(post_save, sender=ContestParticipation)
+def participation_update(sender, instance, **kwargs):
+    transaction.on_commit(partial(update_scoreboard, instance.contest, [instance.id]))
+
+
+@receiver(post_delete, sender=ContestParticipation)
+def participation_delete(sender, instance, **kwargs):
+    transaction.on_commit(partial(remove_from_scoreboard, instance.contest_id, [instance.id]))
+
 
 # @receiver(post_save, sender=Problem)
 # def create_profile(sender, instance, created, **kwargs):
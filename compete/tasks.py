@@ -1,11 +1,17 @@
-from celery import shared_task
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from celery import chord, shared_task
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import cache
+from django.db import transaction
 from django.utils import timezone
 from django.utils.translation import gettext as _
 
-from compete.models import Contest
+from compete.models import Contest, ContestProblem
+from compete.scoreboard import update_scoreboard
 
 from judger.utils.celery import Progress
 
@@ -14,29 +20,101 @@ logger = logging.getLogger('judger.tasks')
 
 __all__ = ('recompute_standing')
 
+# Seconds the count of recomputed participations of a running recompute_standing is kept
+RECOMPUTE_PROGRESS_TIMEOUT = 60 * 60
+
+
+def _recompute_participations(contest_id, participation_ids):
+  contest = Contest.objects.get(id=contest_id)
+  with transaction.atomic():
+    contest.format.update_participations(contest.users.filter(id__in=participation_ids).order_by('id'))
+  # Bulk updates send no post_save, so the scoreboard rows are rewritten here.
+  update_scoreboard(contest, participation_ids)
+  return len(participation_ids)
+
+
+def _recompute_problem_stats(contest_problem_id):
+  ContestProblem.objects.get(id=contest_problem_id).expensive_recompute_stats(force_update=True, clear_cache=False)
+  return 0
+
+
+def _progress_key(task_id):
+  return 'recompute-standing-progress:%s' % task_id
+
+
 @shared_task(bind=True)
 def recompute_standing(self, contest_id):
+  """
+  Recomputes a contest's standings and problem stats. Participations are split into chunks that, along with
+  the stats of every problem, run as one Celery chord; the scoreboard cache is cleared once they all finish.
+  When tasks run eagerly, the same jobs run on a local process pool instead.
+  """
   contest = Contest.objects.get(id=contest_id)
-  users = contest.users.filter(virtual=0, is_disqualified=False)
-  logger.info("Job: Recomputing standing for contest %s.." % contest.key)
+  ids = list(contest.users.filter(virtual=0, is_disqualified=False).order_by('id').values_list('id', flat=True))
+  size = contest.format.BULK_CHUNK_SIZE
+  chunks = [ids[i:i + size] for i in range(0, len(ids), size)]
+  problems = list(contest.contest_problems.values_list('id', flat=True))
+  logger.info("Job: Recomputing standing for contest %s in %d chunk(s).." % (contest.key, len(chunks)))
+
+  if self.app.conf.task_always_eager or not chunks + problems:
+    return _recompute_locally(self, contest, chunks, problems, len(ids))
+
+  cache.set(_progress_key(self.request.id), 0, RECOMPUTE_PROGRESS_TIMEOUT)
+  # The chord's result replaces this task's, so its status keeps being tracked by this task's id.
+  raise self.replace(chord(
+    [recompute_participations.s(contest_id, chunk, self.request.id, len(ids)) for chunk in chunks] +
+    [recompute_problem_stats.s(problem_id) for problem_id in problems],
+    finish_recompute_standing.s(contest_id),
+  ))
+
+
+def _recompute_locally(task, contest, chunks, problems, total):
+  jobs = [(_recompute_participations, contest.id, chunk) for chunk in chunks] + \
+         [(_recompute_problem_stats, problem_id) for problem_id in problems]
+  workers = min(settings.BKDNOJ_STANDING_RECOMPUTE_WORKERS, len(jobs))
 
   recompute = 0
-  with Progress(self, users.count()) as p:
-    for user in users:
-      user.recompute_results()
-      recompute += 1
-      if recompute % 10 == 0:
+  with Progress(task, total) as p:
+    if workers > 1:
+      # Spawned rather than forked, so that no process shares the database connections of this one.
+      context = multiprocessing.get_context('spawn')
+      with ProcessPoolExecutor(workers, mp_context=context, initializer=django.setup) as pool:
+        for future in as_completed([pool.submit(*job) for job in jobs]):
+          recompute += future.result()
+          p.done = recompute
+    else:
+      for job in jobs:
+        recompute += job[0](*job[1:])
         p.done = recompute
-    contest.clear_scoreboard_cache()
+  return finish_recompute_standing([recompute], contest.id)
 
-  logger.info("Job: Recomputing stats for ContestProblem(s) %s.." % contest.key)
-  for p in contest.contest_problems.all():
-    p.expensive_recompute_stats(force_update=True)
 
-  logger.info("Finished: Recomputing standing for contest %s." % contest.key)
+@shared_task(bind=True)
+def recompute_participations(self, contest_id, participation_ids, parent_id=None, total=None):
+  recompute = _recompute_participations(contest_id, participation_ids)
+  if parent_id is not None:
+    try:
+      done = cache.incr(_progress_key(parent_id), recompute)
+    except ValueError:
+      pass
+    else:
+      Progress(self, total, task_id=parent_id).done = done
   return recompute
 
 
+@shared_task
+def recompute_problem_stats(contest_problem_id):
+  return _recompute_problem_stats(contest_problem_id)
+
+
+@shared_task
+def finish_recompute_standing(counts, contest_id):
+  contest = Contest.objects.get(id=contest_id)
+  contest.clear_scoreboard_cache()
+  logger.info("Finished: Recomputing standing for contest %s." % contest.key)
+  return sum(counts)
+
+
 @shared_task(bind=True)
 def rescore_problem(self, problem_id, publicy_changed=False):
   raise NotImplementedError
@@ -1,3 +1,288 @@
-from django.test import TestCase
+from datetime import timedelta
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from compete.models import Contest, ContestParticipation, ContestProblem, ContestSubmission
+from judger.models import Language
+from problem.models import Problem
+from submission.models import Submission
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES, BKDNOJ_SCOREBOARD_REDIS=None)
+class ICPCTestCase(TestCase):
+    """
+    A running ICPC contest that froze an hour ago, four hours after it started, with a
+    problem A worth 1 point and a partial problem B worth 100.
+    """
+    format_config = None
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.language = Language.objects.create(key='ICPCT', name='Test', common_name='Test', ace='text',
+                                               pygments='text', extension='txt')
+        now = timezone.now()
+        cls.contest = Contest.objects.create(
+            key='icpctest', name='ICPC test', format_name='icpc', format_config=cls.format_config,
+            start_time=now - timedelta(hours=5), end_time=now + timedelta(hours=1),
+            enable_frozen=True, frozen_time=now - timedelta(hours=1),
+        )
+        Problem.objects.bulk_create([Problem(shortname='ICPCTEST_%s' % label, title=label) for label in 'AB'])
+        cls.problems = {}
+        problems = Problem.objects.filter(shortname__startswith='ICPCTEST_').order_by('shortname')
+        for label, problem in zip('AB', problems):
+            cls.problems[label] = ContestProblem.objects.create(
+                contest=cls.contest, problem=problem, points=1 if label == 'A' else 100, partial=label == 'B',
+                order=len(cls.problems),
+            )
+
+        user = get_user_model().objects.create(username='icpctest')
+        cls.profile = user.profile
+        cls.participation = ContestParticipation.objects.create(contest=cls.contest, user=cls.profile,
+                                                                real_start=cls.contest.start_time)
+
+    def queue(self, label, minutes, participation=None):
+        """
+        Creates a submission `minutes` into the contest, not graded yet.
+        """
+        participation = participation or self.participation
+        contest_problem = self.problems[label]
+        submission = Submission.objects.create(
+            user_id=participation.user_id, problem_id=contest_problem.problem_id, language=self.language,
+            contest_object=self.contest,
+        )
+        date = self.contest.start_time + timedelta(minutes=minutes)
+        Submission.objects.filter(id=submission.id).update(date=date)
+        return ContestSubmission.objects.create(submission=submission, problem=contest_problem,
+                                                participation=participation)
+
+    def grade(self, contest_submission, result, percent=None, rejudge=False):
+        """
+        Sets a submission's result, `percent` of its test cases passing (all of them for AC and none
+        otherwise by default), and updates the participation as the bridge does once grading ends.
+        The stored results must then be those a full recompute gives.
+        """
+        if percent is None:
+            percent = 100 if result == 'AC' else 0
+        submission = Submission.objects.get(id=contest_submission.submission_id)
+        submission.status = 'CE' if result == 'CE' else 'IE' if result == 'IE' else 'D'
+        submission.result = result
+        submission.case_points = percent
+        submission.case_total = 100
+        if rejudge:
+            submission.rejudged_date = timezone.now()
+        submission.save()
+        submission.update_contest()
+        self.assertMatchesRecompute()
+        return contest_submission
+
+    def submit(self, label, result, minutes, percent=None):
+        return self.grade(self.queue(label, minutes), result, percent)
+
+    def results(self):
+        fields = self.contest.format.RESULT_FIELDS
+        return {
+            participation.id: [getattr(participation, field) for field in fields]
+            for participation in ContestParticipation.objects.filter(contest=self.contest)
+        }
+
+    def assertMatchesRecompute(self):
+        stored = ContestParticipation.objects.get(id=self.participation.id)
+        expected = ContestParticipation.objects.get(id=self.participation.id)
+        format = expected.contest.format
+        format._compute_participation(expected, expected.submissions.values_list(*format.SUBMISSION_FIELDS))
+        for field in format.RESULT_FIELDS:
+            self.assertEqual(getattr(stored, field), getattr(expected, field), field)
+
+
+class ICPCApplySubmissionTestCase(ICPCTestCase):
+    def test_before_freeze(self):
+        self.submit('A', 'WA', 10)
+        self.submit('A', 'CE', 20)
+        self.submit('B', 'TLE', 25)
+        self.submit('A', 'WA', 30)
+        self.submit('A', 'AC', 40)
+        self.submit('A', 'WA', 50)
+        self.submit('A', 'AC', 60)
+        self.submit('B', 'AC', 70)
+        participation = ContestParticipation.objects.get(id=self.participation.id)
+        self.assertEqual(participation.score, 101)
+        tries = participation.format_data[str(self.problems['A'].id)]['tries']
+        self.assertEqual(tries, 3 if participation.contest.format.config['penalty'] else 0)
+
+    def test_after_freeze(self):
+        self.submit('A', 'WA', 230)
+        self.submit('A', 'WA', 250)
+        self.submit('A', 'CE', 255)
+        self.submit('A', 'AC', 260)
+        self.submit('A', 'WA', 270)
+        self.submit('A', 'AC', 275)
+        participation = ContestParticipation.objects.get(id=self.participation.id)
+        self.assertEqual((participation.score, participation.frozen_score), (1, 0))
+
+    def test_solved_before_freeze(self):
+        self.submit('A', 'WA', 200)
+        self.submit('A', 'AC', 210)
+        self.submit('A', 'WA', 250)
+        self.submit('A', 'AC', 260)
+        self.submit('B', 'WA', 265)
+
+    def test_compile_errors_only(self):
+        self.submit('A', 'CE', 10)
+        self.submit('A', 'IE', 20)
+        self.submit('A', 'CE', 250)
+        self.submit('A', 'WA', 255)
+
+    def test_queued_earlier_submission(self):
+        # A submission still in the queue only moves the time of an unsolved problem.
+        queued = self.queue('A', 5)
+        self.submit('A', 'WA', 10)
+        self.submit('A', 'AC', 20)
+        self.grade(queued, 'WA')
+
+    def test_graded_out_of_order(self):
+        earlier = self.queue('A', 30)
+        self.submit('A', 'AC', 40)
+        self.grade(earlier, 'WA')
+        self.submit('A', 'WA', 50)
+        self.submit('B', 'WA', 20)
+
+    def test_rejudge(self):
+        first = self.submit('A', 'WA', 10)
+        second = self.submit('A', 'AC', 20)
+        self.submit('A', 'WA', 250)
+        self.grade(first, 'AC', rejudge=True)
+        self.grade(first, 'CE', rejudge=True)
+        self.grade(second, 'WA', rejudge=True)
+        self.submit('A', 'AC', 260)
+        self.submit('A', 'WA', 270)
+
+    def test_graded_twice(self):
+        # A requeued submission, or one that ended in an internal error, is graded again.
+        first = self.submit('A', 'WA', 10)
+        self.grade(first, 'WA')
+        second = self.submit('B', 'WA', 20, percent=40)
+        self.grade(second, 'IE')
+        self.grade(second, 'WA', percent=50)
+        accepted = self.submit('A', 'AC', 30)
+        self.grade(accepted, 'AC')
+        after = self.submit('A', 'WA', 250)
+        self.grade(after, 'WA')
+        participation = ContestParticipation.objects.get(id=self.participation.id)
+        tries = participation.format_data[str(self.problems['A'].id)]['tries']
+        self.assertEqual(tries, 2 if participation.contest.format.config['penalty'] else 0)
+
+    def test_graded_again_after_later_requeued(self):
+        first = self.submit('A', 'WA', 10)
+        second = self.submit('A', 'WA', 20)
+        Submission.objects.filter(id=second.submission_id).update(status='QU', result=None)
+        self.grade(first, 'WA')
+        self.grade(second, 'WA')
+
+    def test_partial_then_accepted(self):
+        self.submit('B', 'WA', 10, percent=40)
+        self.submit('B', 'WA', 20, percent=30)
+        self.submit('B', 'WA', 30, percent=60)
+        self.submit('B', 'WA', 40, percent=60)
+        self.submit('B', 'AC', 50)
+        self.submit('B', 'WA', 60, percent=90)
+        participation = ContestParticipation.objects.get(id=self.participation.id)
+        self.assertEqual(participation.score, 100)
+
+    def test_partial_after_freeze(self):
+        self.submit('B', 'WA', 200, percent=40)
+        self.submit('B', 'WA', 250, percent=70)
+        self.submit('B', 'WA', 255, percent=20)
+        self.submit('B', 'AC', 260)
+
+    def test_frozen_time_changed(self):
+        self.submit('A', 'WA', 200)
+        self.submit('A', 'AC', 220)
+        frozen_time = self.contest.start_time + timedelta(minutes=210)
+        Contest.objects.filter(id=self.contest.id).update(frozen_time=frozen_time)
+        self.submit('B', 'WA', 230)
+
+    def test_disqualified(self):
+        self.submit('A', 'AC', 10)
+        ContestParticipation.objects.filter(id=self.participation.id).update(is_disqualified=True)
+        contest_submission = self.queue('B', 20)
+        submission = Submission.objects.get(id=contest_submission.submission_id)
+        submission.result = 'AC'
+        submission.case_points = submission.case_total = 100
+        submission.save()
+        submission.update_contest()
+        self.assertEqual(ContestParticipation.objects.get(id=self.participation.id).score, -9999)
+
+
+class ICPCNoPenaltyApplySubmissionTestCase(ICPCApplySubmissionTestCase):
+    format_config = {'penalty': 0}
+
+
+class ICPCUpdateParticipationsTestCase(ICPCTestCase):
+    # (problem, result, minutes, percent passed) of each participant's submissions
+    HISTORIES = [
+        [('A', 'WA', 10, 0), ('A', 'CE', 20, 0), ('A', 'AC', 30, 100), ('B', 'WA', 40, 30), ('B', 'WA', 50, 70)],
+        [('A', 'WA', 230, 0), ('A', 'AC', 250, 100), ('A', 'WA', 260, 0), ('B', 'AC', 100, 100)],
+        [('A', 'IE', 5, 0), ('A', 'WA', 245, 0), ('B', 'WA', 200, 40), ('B', 'AC', 255, 100), ('B', None, 270, 0)],
+        [('B', 'CE', 250, 0)],
+        [],
+    ]
+
+    def setUp(self):
+        self.participations = [self.participation]
+        for i in range(1, len(self.HISTORIES)):
+            user = get_user_model().objects.create(username='icpctest%d' % i)
+            self.participations.append(ContestParticipation.objects.create(
+                contest=self.contest, user=user.profile, real_start=self.contest.start_time,
+            ))
+
+        for participation, history in zip(self.participations, self.HISTORIES):
+            for label, result, minutes, percent in history:
+                contest_submission = self.queue(label, minutes, participation)
+                contest_problem = self.problems[label]
+                points = contest_problem.points * percent / 100
+                if not contest_problem.partial and points != contest_problem.points:
+                    points = 0
+                Submission.objects.filter(id=contest_submission.submission_id).update(result=result)
+                ContestSubmission.objects.filter(id=contest_submission.id).update(points=points)
+
+    def reset(self):
+        ContestParticipation.objects.filter(contest=self.contest).update(
+            score=0, cumtime=0, tiebreaker=0, format_data=None,
+            frozen_score=0, frozen_cumtime=0, frozen_tiebreaker=0, frozen_format_data=None, frozen_time=None,
+        )
+
+    def test_matches_update_participation(self):
+        format = self.contest.format
+        for participation in ContestParticipation.objects.filter(contest=self.contest):
+            format.update_participation(participation)
+        expected = self.results()
+        self.assertTrue(any(result[0] for result in expected.values()))
+
+        self.reset()
+        format.update_participations(ContestParticipation.objects.filter(contest=self.contest))
+        self.assertEqual(self.results(), expected)
+
+    def test_chunks(self):
+        format = self.contest.format
+        for participation in ContestParticipation.objects.filter(contest=self.contest):
+            format.update_participation(participation)
+        expected = self.results()
+
+        self.reset()
+        # As compete.tasks.recompute_standing does, in chunks of ids
+        ids = list(ContestParticipation.objects.filter(contest=self.contest).order_by('id')
+                   .values_list('id', flat=True))
+        for chunk in (ids[:2], ids[2:]):
+            format.update_participations(self.contest.users.filter(id__in=chunk).order_by('id'))
+        self.assertEqual(self.results(), expected)
+
+    def test_query_count(self):
+        format = self.contest.format
+        # One query for the submissions, one bulk UPDATE for the participations
+        participations = list(ContestParticipation.objects.filter(contest=self.contest))
+        with self.assertNumQueries(2):
+            format.update_participations(participations)
@@ -35,6 +35,10 @@ urlpatterns = [
         contest_standing_view,
         name='contest-standing',
     ),
+    path('contest/<str:key>/standing/delta/',
+        contest_standing_delta_view,
+        name='contest-standing-delta',
+    ),
     path('contest/<str:key>/standing/recompute/',
         ContestRecomputeStandingView.as_view(),
         name='contest-standing-recompute',
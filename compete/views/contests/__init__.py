@@ -24,4 +24,5 @@ __all__ = [
     'ContestParticipationActView',
     'contest_participation_add_many',
     'contest_participate_view', 'contest_leave_view', 'contest_standing_view',
+    'contest_standing_delta_view',
 ]
\ No newline at end of file
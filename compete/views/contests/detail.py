@@ -29,6 +29,7 @@ from userprofile.models import UserProfile as Profile
 from compete.serializers import *
 from compete.models import Contest, ContestProblem, ContestSubmission, ContestParticipation, Rating
 from compete.ratings import rate_contest
+from compete.scoreboard import update_scoreboard
 from compete.exceptions import *
 from compete.tasks import recompute_standing
 
@@ -698,6 +699,7 @@ class ContestParticipationActView(views.APIView):
             else:
                 org = org.first()
             parts.update(organization=org)
+            update_scoreboard(self.contest, part_ids)
         elif act == ContestParticipationActView.ACTION_DISQUALIFY:
             with transaction.atomic():
                 for part in parts: part.set_disqualified(True)
@@ -5,6 +5,7 @@ from django.db.models import Case, Count, F, FloatField, IntegerField, Max, Min,
 from django.db import IntegrityError
 from django.utils.functional import cached_property
 from django.utils import timezone
+from django.utils.http import parse_etags
 from django.utils.translation import gettext_lazy as _
 from django.core.exceptions import PermissionDenied, ViewDoesNotExist, ValidationError
 
@@ -26,6 +27,7 @@ from userprofile.models import UserProfile as Profile
 from compete.serializers import *
 from compete.models import Contest, ContestProblem, ContestSubmission, ContestParticipation, Rating
 from compete.exceptions import *
+from compete.scoreboard import get_scoreboard
 
 from helpers.custom_pagination import Page100Pagination, Page10Pagination
 
@@ -34,6 +36,7 @@ logger = logging.getLogger(__name__)
 
 __all__ = [
     'contest_standing_view',
+    'contest_standing_delta_view',
 ]
 
 # from collections import defaultdict, namedtuple
@@ -42,11 +45,11 @@ from django.core.cache import cache
 from django.utils import timezone
 from judger.utils.ranker import ranker
 
-@api_view(['GET'])
-def contest_standing_view(request, key):
-    # now = timezone.now()
-    # logger.info('Received request')
-
+def _get_standing_contest(request, key):
+    """
+    Returns the contest, whether the user may see its unfrozen scoreboard, and the scoreboard
+    view mode and serializer to use.
+    """
     user = request.user
     contest = get_object_or_404(Contest, key=key)
 
@@ -55,27 +58,59 @@ def contest_standing_view(request, key):
             raise ContestNotStarted
 
     if not contest.is_accessible_by(user):
+        raise PermissionDenied
+
+    ## TODO: Scoreboard visibility
+    can_break_ice = (contest.is_frozen and contest.can_see_full_scoreboard(user))
+    if contest.is_frozen and \
+        ((not can_break_ice) or (not (request.GET.get('view_full')=='1'))):
+            return contest, can_break_ice, 'froze', ContestStandingFrozenSerializer
+    return contest, can_break_ice, 'full', ContestStandingSerializer
+
+
+@api_view(['GET'])
+def contest_standing_view(request, key):
+    # now = timezone.now()
+    # logger.info('Received request')
+
+    try:
+        contest, can_break_ice, scoreboard_view_mode, scoreboard_serializer = _get_standing_contest(request, key)
+    except PermissionDenied:
         return Response({
             'detail': "Contest is not public to view."
         }, status=status.HTTP_403_FORBIDDEN)
 
-
     cache_duration = contest.scoreboard_cache_duration
     cache_disabled = (cache_duration == 0)
 
-    ## TODO: Scoreboard visibility
-    can_break_ice = (contest.is_frozen and contest.can_see_full_scoreboard(user))
-    if contest.is_frozen and \
-        ((not can_break_ice) or (not (request.GET.get('view_full')=='1'))):
-            scoreboard_view_mode = 'froze'
-            scoreboard_serializer = ContestStandingFrozenSerializer
-    else:
-        scoreboard_view_mode = 'full'
-        scoreboard_serializer = ContestStandingSerializer
-
     # logger.info("Done permission checking -- %.4fs" % (timezone.now()-now).total_seconds())
     # now = timezone.now()
 
+    # Optional paging of the results, by `offset` and `limit`
+    try:
+        offset = max(int(request.GET.get('offset', 0)), 0)
+        limit = request.GET.get('limit')
+        limit = None if limit is None else max(int(limit), 1)
+    except ValueError:
+        return Response({'detail': "'offset' and 'limit' must be integers."}, status=status.HTTP_400_BAD_REQUEST)
+
+    # The materialized scoreboard serves one page without touching the database, unless it is being built.
+    scoreboard = get_scoreboard(contest)
+    if scoreboard is not None:
+        # A client polling an unchanged scoreboard gets 304 Not Modified.
+        version = scoreboard.version(scoreboard_view_mode)
+        if version is not None:
+            etag = scoreboard.etag(scoreboard_view_mode, version, can_break_ice, offset, limit)
+            if etag in parse_etags(request.headers.get('If-None-Match', '')):
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        dat = scoreboard.read(scoreboard_view_mode, offset, limit)
+        if dat is not None:
+            if can_break_ice:
+                dat['can_break_ice'] = True
+            etag = scoreboard.etag(scoreboard_view_mode, dat['version'], can_break_ice, offset, limit)
+            return Response(dat, status=status.HTTP_200_OK, headers={'ETag': etag})
+
     cache_key = f"contest-{contest.key}-scoreboard-{scoreboard_view_mode}"
 
     if cache_disabled or cache.get(cache_key) == None:
@@ -131,6 +166,38 @@ def contest_standing_view(request, key):
     # logger.info("Done serializing data -- %.4fs" % (timezone.now()-now).total_seconds())
     # now = timezone.now()
 
+    dat = dict(dat, count=len(dat['results']),
+               results=dat['results'][offset:None if limit is None else offset + limit])
+    if can_break_ice:
+        dat['can_break_ice'] = True
+    return Response(dat, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+def contest_standing_delta_view(request, key):
+    """
+    Returns the scoreboard rows changed since version `since`, and the usernames of participants
+    removed since then, for clients that keep a copy of the scoreboard up to date. When the
+    scoreboard was rebuilt after `since`, every row is returned and `full` is set.
+    """
+    try:
+        contest, can_break_ice, scoreboard_view_mode, _unused = _get_standing_contest(request, key)
+    except PermissionDenied:
+        return Response({
+            'detail': "Contest is not public to view."
+        }, status=status.HTTP_403_FORBIDDEN)
+
+    try:
+        since = max(int(request.GET.get('since', 0)), 0)
+    except ValueError:
+        return Response({'detail': "'since' must be an integer."}, status=status.HTTP_400_BAD_REQUEST)
+
+    scoreboard = get_scoreboard(contest)
+    dat = scoreboard.delta(scoreboard_view_mode, since) if scoreboard is not None else None
+    if dat is None:
+        return Response({
+            'detail': "Scoreboard changes are not available, use the full standing instead."
+        }, status=status.HTTP_404_NOT_FOUND)
     if can_break_ice:
         dat['can_break_ice'] = True
     return Response(dat, status=status.HTTP_200_OK)
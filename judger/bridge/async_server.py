@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from judger.bridge.base_handler import Disconnect, size_pack
+
+logger = logging.getLogger('judge.bridge')
+
+# Max line length for PROXY protocol is 107.
+MAX_PROXY_HEADER_SIZE = 107
+
+
+class AsyncRequest:
+    """
+    Stands in for the socket object that packet handlers normally receive as `request`.
+
+    Handlers run their packet callbacks on executor threads, so every write is handed
+    back to the event loop instead of touching the transport directly.
+    """
+
+    def __init__(self, loop, writer):
+        self._loop = loop
+        self._writer = writer
+        self._timeout = None
+
+    def gettimeout(self):
+        return self._timeout
+
+    def settimeout(self, timeout):
+        self._timeout = timeout
+
+    def sendall(self, data):
+        self._loop.call_soon_threadsafe(self._write, data)
+
+    def shutdown(self, how):
+        self._loop.call_soon_threadsafe(self._writer.close)
+
+    def _write(self, data):
+        if not self._writer.is_closing():
+            self._writer.write(data)
+
+
+class AsyncListener:
+    def __init__(self, bridge, address, handler_class, handler_kwargs):
+        self.bridge = bridge
+        self.server_address = address
+        self.handler_class = handler_class
+        self.handler_kwargs = handler_kwargs
+        self._server = None
+
+    async def start(self):
+        host, port = self.server_address
+        self._server = await asyncio.start_server(self._on_client, host, port, reuse_address=True)
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+
+    async def _on_client(self, reader, writer):
+        handler = self.handler_class.instantiate(
+            AsyncRequest(self.bridge.loop, writer), writer.get_extra_info('peername'), self, **self.handler_kwargs,
+        )
+        handler.on_connect()
+        try:
+            await self._handle(handler, reader)
+        except BaseException:
+            logger.exception('Error in base packet handling')
+        finally:
+            try:
+                await self.bridge.run_blocking(handler.on_disconnect)
+            except Exception:
+                logger.exception('Error in disconnect handling')
+            writer.close()
+
+    async def _read(self, handler, awaitable):
+        return await asyncio.wait_for(awaitable, handler.request.gettimeout())
+
+    async def _handle(self, handler, reader):
+        try:
+            tag = await self._read(handler, reader.readexactly(size_pack.size))
+            handler._initial_tag = tag
+            if handler.client_address[0] in handler.proxies and tag == b'PROX':
+                line = await self._read(handler, reader.readuntil(b'\r\n'))
+                if len(line) > MAX_PROXY_HEADER_SIZE:
+                    raise Disconnect()
+                handler.parse_proxy_protocol(tag + line[:-2])
+                header = size_pack.unpack(await self._read(handler, reader.readexactly(size_pack.size)))[0]
+            else:
+                header = size_pack.unpack(tag)[0]
+
+            while True:
+                size, raw = handler.check_frame(header)
+                data = await self._read(handler, reader.readexactly(size))
+                await self.bridge.run_blocking(handler._on_packet, data, raw)
+                header = size_pack.unpack(await self._read(handler, reader.readexactly(size_pack.size)))[0]
+        except (Disconnect, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            return
+        except zlib.error:
+            if handler._got_packet:
+                logger.warning('Encountered zlib error during packet handling, disconnecting client: %s',
+                               handler.client_address, exc_info=True)
+            else:
+                logger.info('Potentially wrong protocol (zlib error): %s: %r', handler.client_address,
+                            handler._initial_tag, exc_info=True)
+        except asyncio.TimeoutError:
+            if handler._got_packet:
+                logger.info('Socket timed out: %s', handler.client_address)
+                await self.bridge.run_blocking(handler.on_timeout)
+            else:
+                logger.info('Potentially wrong protocol: %s: %r', handler.client_address, handler._initial_tag)
+
+
+class AsyncBridge:
+    """
+    Serves every bridge listener from one event loop thread.
+
+    Packet framing and socket I/O happen on the loop; handler callbacks, which talk to
+    the ORM, run on a bounded thread pool so the number of threads (and database
+    connections) no longer grows with the number of judges and Django clients.
+    Packets from one connection are still handled strictly in order.
+    """
+
+    def __init__(self, workers):
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bridge-worker')
+        self.listeners = []
+        self._stopped = threading.Event()
+
+    def add_server(self, addresses, handler_class, **handler_kwargs):
+        for address in addresses:
+            self.listeners.append(AsyncListener(self, address, handler_class, handler_kwargs))
+
+    def run_blocking(self, func, *args):
+        return self.loop.run_in_executor(self.executor, func, *args)
+
+    def serve_forever(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(asyncio.gather(*(listener.start() for listener in self.listeners)))
+            self.loop.run_forever()
+        finally:
+            for listener in self.listeners:
+                listener.close()
+            self.executor.shutdown(wait=False)
+            self.loop.close()
+            self._stopped.set()
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._stopped.wait()
@@ -6,6 +6,7 @@ from itertools import chain
 
 from netaddr import IPGlob, IPSet
 
+from judger.bridge.codec import JSON, UNCOMPRESSED_FLAG
 from judger.utils.unicode import utf8text
 
 logger = logging.getLogger('judge.bridge')
@@ -14,6 +15,12 @@ size_pack = struct.Struct('!I')
 assert size_pack.size == 4
 
 MAX_ALLOWED_PACKET_SIZE = 8 * 1024 * 1024
+# Packets decompress to at most this much; anything larger is treated as a broken or hostile client.
+MAX_DECOMPRESSED_PACKET_SIZE = 64 * 1024 * 1024
+# zlib expands data at most ~1000 times, so packets up to this size are decompressed without a bound.
+SMALL_PACKET_SIZE = 4096
+# Connections keep a receive buffer of this size for reuse; larger packets get a buffer of their own.
+RECEIVE_BUFFER_SIZE = 1024 * 1024
 
 
 def proxy_list(human_readable):
@@ -38,7 +45,7 @@ class Disconnect(Exception):
 # calling the methods that handles the request.
 class RequestHandlerMeta(type):
     def __call__(cls, *args, **kwargs):
-        handler = super().__call__(*args, **kwargs)
+        handler = cls.instantiate(*args, **kwargs)
         handler.on_connect()
         try:
             handler.handle()
@@ -48,6 +55,10 @@ class RequestHandlerMeta(type):
         finally:
             handler.on_disconnect()
 
+    def instantiate(cls, *args, **kwargs):
+        # Construct the handler without driving the connection, for servers that run handle() themselves.
+        return super().__call__(*args, **kwargs)
+
 
 class ZlibPacketHandler(metaclass=RequestHandlerMeta):
     proxies = []
@@ -59,6 +70,10 @@ class ZlibPacketHandler(metaclass=RequestHandlerMeta):
         self.server_address = server.server_address
         self._initial_tag = None
         self._got_packet = False
+        self._buffer = None
+        # Replaced after a successful negotiation in the handshake; until then the peer may be an old one.
+        self.codec = JSON
+        self.compression_threshold = None
 
     @property
     def timeout(self):
@@ -68,25 +83,54 @@ class ZlibPacketHandler(metaclass=RequestHandlerMeta):
     def timeout(self, timeout):
         self.request.settimeout(timeout or None)
 
-    def read_sized_packet(self, size, initial=None):
+    def check_packet_size(self, size):
         if size > MAX_ALLOWED_PACKET_SIZE:
             logger.log(logging.WARNING if self._got_packet else logging.INFO,
                        'Disconnecting client due to too-large message size (%d bytes): %s', size, self.client_address)
             raise Disconnect()
 
-        buffer = []
-        remainder = size
+    def check_frame(self, header):
+        """
+        :return: The payload size from a frame's size header, and whether the payload was sent uncompressed.
+        """
+        raw = bool(header & UNCOMPRESSED_FLAG)
+        size = header & ~UNCOMPRESSED_FLAG
+        if raw and self.compression_threshold is None:
+            logger.log(logging.WARNING if self._got_packet else logging.INFO,
+                       'Disconnecting client due to uncompressed packet before negotiation: %s', self.client_address)
+            raise Disconnect()
+        self.check_packet_size(size)
+        return size, raw
+
+    def _receive_buffer(self, size):
+        if size > RECEIVE_BUFFER_SIZE:
+            return memoryview(bytearray(size))
+        if self._buffer is None:
+            self._buffer = memoryview(bytearray(RECEIVE_BUFFER_SIZE))
+        return self._buffer[:size]
+
+    def read_sized_packet(self, header, initial=None):
+        size, raw = self.check_frame(header)
+
+        # Receive straight into a buffer that is reused across packets, and decompress from a view of it.
+        view = self._receive_buffer(size)
+        received = 0
 
         if initial:
-            buffer.append(initial)
-            remainder -= len(initial)
-            assert remainder >= 0
+            received = len(initial)
+            assert received <= size
+            view[:received] = initial
 
-        while remainder:
-            data = self.request.recv(remainder)
-            remainder -= len(data)
-            buffer.append(data)
-        self._on_packet(b''.join(buffer))
+        while received < size:
+            count = self.request.recv_into(view[received:], size - received)
+            if not count:
+                raise Disconnect()
+            received += count
+
+        text = self._decompress(view, raw)
+        # Let go of a one-off buffer for a large packet before the packet is parsed.
+        del view
+        self._dispatch(text)
 
     def parse_proxy_protocol(self, line):
         words = line.split()
@@ -124,10 +168,33 @@ class ZlibPacketHandler(metaclass=RequestHandlerMeta):
             buffer += data
         return buffer
 
-    def _on_packet(self, data):
-        decompressed = zlib.decompress(data).decode('utf-8')
+    def _decompress(self, data, raw=False):
+        if raw:
+            payload = data
+        elif len(data) <= SMALL_PACKET_SIZE:
+            # Can't inflate past a few MiB, so skip the bounded (and slower) decompressor.
+            payload = zlib.decompress(data)
+        else:
+            decompressor = zlib.decompressobj()
+            payload = decompressor.decompress(data, MAX_DECOMPRESSED_PACKET_SIZE)
+            if decompressor.unconsumed_tail:
+                logger.warning('Disconnecting client due to packet decompressing to over %d bytes: %s',
+                               MAX_DECOMPRESSED_PACKET_SIZE, self.client_address)
+                raise Disconnect()
+            if not decompressor.eof:
+                raise zlib.error('incomplete or truncated stream')
+        if self.codec.text:
+            # Decoding here rather than handing bytes to json.loads (which decodes internally anyway)
+            # frees the decompressed bytes before parsing starts.
+            return str(payload, 'utf-8')
+        return payload
+
+    def _dispatch(self, text):
         self._got_packet = True
-        self.on_packet(decompressed)
+        self.on_packet(text)
+
+    def _on_packet(self, data, raw=False):
+        self._dispatch(self._decompress(data, raw))
 
     def on_packet(self, data):
         raise NotImplementedError()
@@ -154,13 +221,14 @@ class ZlibPacketHandler(metaclass=RequestHandlerMeta):
                         self.read_sized_packet(self.read_size(remainder))
                         break
 
-                    size = size_pack.unpack(remainder[:size_pack.size])[0]
+                    header = size_pack.unpack(remainder[:size_pack.size])[0]
+                    size, raw = self.check_frame(header)
                     remainder = remainder[size_pack.size:]
                     if len(remainder) <= size:
-                        self.read_sized_packet(size, remainder)
+                        self.read_sized_packet(header, remainder)
                         break
 
-                    self._on_packet(remainder[:size])
+                    self._on_packet(remainder[:size], raw)
                     remainder = remainder[size:]
             else:
                 self.read_sized_packet(tag)
@@ -189,8 +257,18 @@ class ZlibPacketHandler(metaclass=RequestHandlerMeta):
             raise
 
     def send(self, data):
-        compressed = zlib.compress(data.encode('utf-8'))
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if self.compression_threshold is not None and len(data) < self.compression_threshold:
+            # Small packets barely shrink, so they are cheaper to send as they are.
+            self.request.sendall(size_pack.pack(len(data) | UNCOMPRESSED_FLAG) + data)
+            return
+        compressed = zlib.compress(data)
         self.request.sendall(size_pack.pack(len(compressed)) + compressed)
 
+    def use_codec(self, codec, compression_threshold):
+        self.codec = codec
+        self.compression_threshold = compression_threshold
+
     def close(self):
         self.request.shutdown(socket.SHUT_RDWR)
@@ -0,0 +1,124 @@
+import logging
+import threading
+import time
+from itertools import chain
+
+from django.db import transaction
+from django.db.models import Case, IntegerField, Value, When
+
+from judger.bridge.db_pool import pooled_connection
+from judger.bridge.metrics import Histogram
+from submission.models import Submission, SubmissionTestCase
+
+logger = logging.getLogger('judge.bridge')
+
+
+class TestCaseBuffer(object):
+    """
+    Write-behind buffer for SubmissionTestCase rows and Submission.current_testcase.
+
+    Test-case packets from every judge are accumulated and written in one UPDATE plus one
+    bulk INSERT, once `max_rows` rows are pending or every `interval` seconds, whichever
+    comes first. Handlers must call flush() before anything reads the rows back, i.e.
+    before grading-end is processed.
+
+    Without a running flusher thread (start() not called) every add() is flushed inline.
+    """
+
+    def __init__(self, max_rows=500, interval=0.5):
+        self.max_rows = max_rows
+        self.interval = interval
+        self.lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._cases = {}
+        self._current = {}
+        self._pending = 0
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.flush_latency = Histogram()
+        self.flushed_rows = 0
+        self.flush_errors = 0
+
+    @property
+    def queue_depth(self):
+        return self._pending
+
+    def add(self, submission, cases, current_testcase):
+        with self.lock:
+            self._cases.setdefault(submission, []).extend(cases)
+            self._current[submission] = max(current_testcase, self._current.get(submission, 0))
+            self._pending += len(cases)
+            pending = self._pending
+
+        if self._thread is None:
+            self.flush()
+        elif pending >= self.max_rows:
+            self._wakeup.set()
+
+    def discard(self, submission):
+        with self.lock:
+            self._pending -= len(self._cases.pop(submission, ()))
+            self._current.pop(submission, None)
+
+    def flush(self):
+        with self._flush_lock:
+            with self.lock:
+                cases, current = self._cases, self._current
+                self._cases, self._current, self._pending = {}, {}, 0
+            if not current:
+                return
+
+            start = time.monotonic()
+            try:
+                self._write(cases, current)
+            except Exception:
+                self.flush_errors += 1
+                logger.exception('Failed to write %d buffered test case(s)', sum(map(len, cases.values())))
+            self.flush_latency.observe(time.monotonic() - start)
+
+    def _write(self, cases, current):
+        with transaction.atomic():
+            updated = Submission.objects.filter(id__in=list(current)).update(current_testcase=Case(
+                *[When(id=id, then=Value(position)) for id, position in current.items()],
+                output_field=IntegerField(),
+            ))
+            if updated != len(current):
+                known = set(Submission.objects.filter(id__in=list(current)).values_list('id', flat=True))
+                for id in current.keys() - known:
+                    logger.warning('Unknown submission: %s', id)
+                    cases.pop(id, None)
+
+            rows = list(chain.from_iterable(cases.values()))
+            SubmissionTestCase.objects.bulk_create(rows, batch_size=self.max_rows)
+        self.flushed_rows += len(rows)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._current:
+                # Take the connection before the flush lock, like handlers flushing inline do.
+                with pooled_connection():
+                    self.flush()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='test-case-buffer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue_depth,
+            'flushed_rows': self.flushed_rows,
+            'flush_errors': self.flush_errors,
+            'flush_latency': self.flush_latency.snapshot(),
+        }
@@ -0,0 +1,256 @@
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+from itertools import count
+
+from judger.bridge.codec import CODECS, JSON, UNCOMPRESSED_FLAG, available_codecs
+
+logger = logging.getLogger('judge.judgeapi')
+size_pack = struct.Struct('!I')
+
+
+class BridgeUnavailable(Exception):
+    """
+    The request could not be sent. It is safe to retry it over another connection.
+    """
+
+
+class BridgeTimeout(Exception):
+    """
+    The request was sent but no reply arrived in time. It must not be blindly resent.
+    """
+
+
+def encode_packet(packet, codec=JSON, compression_threshold=None):
+    data = codec.dumps(packet)
+    if compression_threshold is not None and len(data) < compression_threshold:
+        return size_pack.pack(len(data) | UNCOMPRESSED_FLAG) + data
+    data = zlib.compress(data)
+    return size_pack.pack(len(data)) + data
+
+
+def read_packet(reader, codec=JSON):
+    header = reader.read(size_pack.size)
+    if len(header) < size_pack.size:
+        raise EOFError()
+    length = size_pack.unpack(header)[0]
+    raw = bool(length & UNCOMPRESSED_FLAG)
+    length &= ~UNCOMPRESSED_FLAG
+    data = reader.read(length)
+    if len(data) < length:
+        raise EOFError()
+    if not raw:
+        data = zlib.decompress(data)
+    return codec.loads(data)
+
+
+class _PendingReply(object):
+    __slots__ = ('event', 'packet', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.packet = None
+        self.error = None
+
+
+class BridgeConnection(object):
+    """
+    A long-lived connection to the bridge's Django-facing server.
+
+    Requests carry a `request-id` that the bridge echoes back, so several threads can have
+    requests in flight on the same connection; a reader thread routes each reply to its waiter.
+    """
+
+    def __init__(self, address, timeout):
+        self.timeout = timeout
+        self._ids = count(1)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self.closed = False
+        self.last_used = time.monotonic()
+        self.codec = JSON
+        self.compression_threshold = None
+
+        try:
+            self._sock = socket.create_connection(address, timeout)
+            self._reader = self._sock.makefile('rb')
+            self._sock.sendall(encode_packet({'name': 'persistent-connection', 'codecs': available_codecs()}))
+            reply = read_packet(self._reader)
+        except (OSError, EOFError, ValueError, zlib.error) as e:
+            self._close_socket()
+            raise BridgeUnavailable(e)
+
+        if reply.get('name') != 'persistent-connection-accepted':
+            self._close_socket()
+            raise BridgeUnavailable('bridge does not support persistent connections')
+        # An older bridge ignores the offer and answers without picking a codec.
+        if reply.get('codec') in CODECS:
+            self.codec = CODECS[reply['codec']]
+            self.compression_threshold = reply.get('compression-threshold')
+
+        self._sock.settimeout(None)
+        threading.Thread(target=self._read_loop, name='bridge-client-reader', daemon=True).start()
+
+    def _close_socket(self):
+        try:
+            self._sock.close()
+        except (AttributeError, OSError):
+            pass
+
+    def _read_loop(self):
+        error = None
+        try:
+            while True:
+                packet = read_packet(self._reader, self.codec)
+                with self._lock:
+                    waiter = self._pending.pop(packet.get('request-id'), None)
+                if waiter is not None:
+                    waiter.packet = packet
+                    waiter.event.set()
+        except (OSError, EOFError, ValueError, zlib.error) as e:
+            error = e
+        finally:
+            self.close(error)
+
+    def request(self, packet, reply=True):
+        if self.closed:
+            raise BridgeUnavailable('connection closed')
+
+        request_id = next(self._ids)
+        waiter = _PendingReply()
+        if reply:
+            with self._lock:
+                self._pending[request_id] = waiter
+
+        data = encode_packet(dict(packet, **{'request-id': request_id}), self.codec, self.compression_threshold)
+        try:
+            with self._send_lock:
+                self._sock.sendall(data)
+        except OSError as e:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            self.close(e)
+            raise BridgeUnavailable(e)
+        self.last_used = time.monotonic()
+
+        if not reply:
+            return None
+        if not waiter.event.wait(self.timeout):
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise BridgeTimeout('no reply to request %d' % request_id)
+        if waiter.error is not None:
+            raise BridgeTimeout(waiter.error)
+        return waiter.packet
+
+    def ping(self):
+        try:
+            return self.request({'name': 'ping'}).get('name') == 'pong'
+        except (BridgeUnavailable, BridgeTimeout):
+            return False
+
+    def close(self, error=None):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending, self._pending = self._pending, {}
+        for waiter in pending.values():
+            waiter.error = error or 'connection closed'
+            waiter.event.set()
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._close_socket()
+
+
+class BridgeConnectionPool(object):
+    """
+    A small per-process set of BridgeConnections, used round-robin.
+
+    Connections idle for longer than `health_check_interval` are pinged before use, and
+    broken ones are replaced. After a failed connect, a slot backs off exponentially
+    (up to `max_backoff` seconds) before trying again, raising BridgeUnavailable meanwhile.
+    """
+
+    def __init__(self, address, size, timeout, health_check_interval=30, max_backoff=30):
+        self.address = address
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.max_backoff = max_backoff
+        self._connections = [None] * size
+        self._failures = [0] * size
+        self._retry_at = [0] * size
+        self._locks = [threading.Lock() for _ in range(size)]
+        self._next = count()
+
+    def _connection(self, slot):
+        with self._locks[slot]:
+            conn = self._connections[slot]
+            if conn is not None and not conn.closed:
+                if time.monotonic() - conn.last_used < self.health_check_interval or conn.ping():
+                    return conn
+                conn.close()
+
+            now = time.monotonic()
+            if now < self._retry_at[slot]:
+                raise BridgeUnavailable('backing off after %d failed attempt(s)' % self._failures[slot])
+
+            try:
+                conn = BridgeConnection(self.address, self.timeout)
+            except BridgeUnavailable:
+                self._connections[slot] = None
+                self._failures[slot] += 1
+                self._retry_at[slot] = now + min(self.max_backoff, 0.1 * 2 ** self._failures[slot])
+                raise
+            self._failures[slot] = 0
+            self._connections[slot] = conn
+            return conn
+
+    def request(self, packet, reply=True):
+        slot = next(self._next) % self.size
+        return self._connection(slot).request(packet, reply)
+
+    def health_check(self):
+        for slot in range(self.size):
+            try:
+                self._connection(slot)
+            except BridgeUnavailable:
+                logger.warning('Bridge connection %d is unavailable', slot)
+
+    def close(self):
+        for slot in range(self.size):
+            with self._locks[slot]:
+                if self._connections[slot] is not None:
+                    self._connections[slot].close()
+                    self._connections[slot] = None
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(address, size, timeout):
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = BridgeConnectionPool(address, size, timeout)
+    return _pool
+
+
+def _reset_pool():
+    # Sockets must not be shared between a forked worker and its parent.
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_pool)
@@ -0,0 +1,88 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Set in the size header of a packet sent without zlib compression. Only used with peers that negotiated
+# a codec; packets are capped well below 2 GiB, so the bit is never set by older peers.
+UNCOMPRESSED_FLAG = 1 << 31
+
+
+class JsonCodec(object):
+    """
+    The original wire format, and the default. `text` codecs have their payload decoded to str before `loads`.
+    """
+    name = 'json'
+    text = True
+
+    @staticmethod
+    def dumps(data):
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+
+if orjson is not None:
+    class OrjsonCodec(object):
+        # Same wire format as JsonCodec, but stricter: it rejects NaN, Infinity and lone surrogates that the json
+        # module accepts. So it only replaces it for peers that negotiated a codec, which run this code as well.
+        name = 'json'
+        text = False
+
+        @staticmethod
+        def dumps(data):
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+        @staticmethod
+        def loads(data):
+            return orjson.loads(data)
+
+    NEGOTIATED_JSON = OrjsonCodec
+else:
+    NEGOTIATED_JSON = JsonCodec
+
+# Used with peers that don't negotiate, such as older judges and clients.
+JSON = JsonCodec
+
+if msgpack is not None:
+    class MsgpackCodec(object):
+        name = 'msgpack'
+        text = False
+
+        @staticmethod
+        def dumps(data):
+            return msgpack.packb(data, use_bin_type=True)
+
+        @staticmethod
+        def loads(data):
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+    CODECS = {'json': NEGOTIATED_JSON, 'msgpack': MsgpackCodec}
+else:
+    CODECS = {'json': NEGOTIATED_JSON}
+
+
+def available_codecs():
+    return list(CODECS)
+
+
+def negotiate(offered, preferred):
+    """
+    :return: The first codec in `preferred` that the peer offered and is installed here,
+             or None if the peer did not take part in negotiation.
+    """
+    if not offered:
+        return None
+    for name in preferred:
+        if name in offered and name in CODECS:
+            return CODECS[name]
+    return CODECS['json']
@@ -5,12 +5,23 @@ from functools import partial
 
 from django.conf import settings
 
+from judger import event_poster as event
+from judger.bridge.async_server import AsyncBridge
+from judger.bridge import db_pool
+from judger.bridge.case_buffer import TestCaseBuffer
 from judger.bridge.django_handler import DjangoHandler
+from judger.bridge.heartbeat import HeartbeatBuffer
+from judger.bridge.journal import QueueJournal
 from judger.bridge.judge_handler import JudgeHandler
 from judger.bridge.judge_list import JudgeList
+from judger.bridge.metrics import MetricsServer, registry
 from judger.bridge.server import Server
+from judger.bridge.shared_queue import SharedQueue
+from judger.bridge.watchdog import Watchdog
+from judger.judge_priority import DEFAULT_PRIORITY, REJUDGE_PRIORITY
+from judger.judgeapi import SUBMISSION_META_FIELDS, annotate_submission_meta, submission_meta
 from judger.models import Judge
-from submission.models import Submission
+from submission.models import Submission, SubmissionTestCase
 
 logger = logging.getLogger('judge.bridge')
 
@@ -19,30 +30,175 @@ def reset_judges():
     Judge.objects.update(online=False, ping=None, load=None)
 
 
-def judge_daemon():
-    reset_judges()
-    Submission.objects.filter(status__in=Submission.IN_PROGRESS_GRADING_STATUS) \
-        .update(status='IE', result='IE', error=None)
-    judges = JudgeList()
+def _restart_grading(ids):
+    if ids:
+        Submission.objects.filter(id__in=ids).update(status='QU', result=None, time=None, memory=None,
+                                                     points=None, case_points=0, case_total=0,
+                                                     current_testcase=0, error=None)
+        SubmissionTestCase.objects.filter(submission_id__in=ids).delete()
 
-    judge_server = Server(settings.BRIDGED_JUDGE_ADDRESS, partial(JudgeHandler, judges=judges))
-    django_server = Server(settings.BRIDGED_DJANGO_ADDRESS, partial(DjangoHandler, judges=judges))
 
-    threading.Thread(target=django_server.serve_forever).start()
-    threading.Thread(target=judge_server.serve_forever).start()
+def requeue_submissions(judges, journal):
+    """
+    Queues every submission left unfinished by the previous bridge run again, with the priority
+    and judge recorded in the journal. Submissions that were being graded start over.
+    """
+    rows = list(
+        annotate_submission_meta(Submission.objects.filter(status__in=Submission.IN_PROGRESS_GRADING_STATUS))
+        .values('id', 'status', 'rejudged_date', 'problem__shortname', 'language__key', 'source__source',
+                *SUBMISSION_META_FIELDS),
+    )
 
-    stop = threading.Event()
+    # Graded (or deleted) while the journal could not record it.
+    for id in journal.live.keys() - {row['id'] for row in rows}:
+        journal.finished(id)
 
-    def signal_handler(signum, _):
-        logger.info('Exiting due to %s', signal.Signals(signum).name)
-        stop.set()
+    grading = [row['id'] for row in rows if row['status'] != 'QU']
+    _restart_grading(grading)
 
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGQUIT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+    # Journaled submissions in their original queue order, then anything the journal missed.
+    order = {id: index for index, id in enumerate(journal.live)}
+    rows.sort(key=lambda row: (order.get(row['id'], len(order)), row['id']))
+    for row in rows:
+        try:
+            priority, judge_id = journal.live[row['id']]
+        except KeyError:
+            priority, judge_id = REJUDGE_PRIORITY if row['rejudged_date'] else DEFAULT_PRIORITY, None
+        judges.judge(row['id'], row['problem__shortname'], row['language__key'], row['source__source'],
+                     judge_id, priority, submission_meta(row))
+
+    logger.info('Requeued %d unfinished submission(s), %d of which were being graded', len(rows), len(grading))
+
+
+def recover_shard(shared_queue):
+    """
+    Gives back the submissions a shard had claimed before it last stopped. Those that were being
+    graded start over; those that are no longer pending are dropped from the shared queue.
+    """
+    claimed = shared_queue.claimed_ids()
+    if not claimed:
+        return
+    rows = dict(Submission.objects.filter(id__in=claimed, status__in=Submission.IN_PROGRESS_GRADING_STATUS)
+                .values_list('id', 'status'))
+    _restart_grading([id for id, status in rows.items() if status != 'QU'])
+    shared_queue.release(list(rows), finished=set(claimed) - rows.keys())
+    logger.info('Gave back %d submission(s) claimed by shard %d', len(rows), shared_queue.shard)
+
+
+def _shard_settings(shard):
+    shards = settings.BRIDGED_SHARDS
+    peers = {
+        index: tuple(config.get('connect') or config['django'][0])
+        for index, config in enumerate(shards) if index != shard
+    }
+    return shards[shard], peers
+
+
+def judge_daemon(use_async=False, stop=None, shard=None):
+    """
+    Runs the bridge until SIGINT, SIGQUIT or SIGTERM, or until `stop` is set if one is given.
+
+    With a `shard` number, runs as that entry of BRIDGED_SHARDS: one of several bridges sharing
+    their submission queue through the database, each serving its own judges.
+    """
+    judge_address = settings.BRIDGED_JUDGE_ADDRESS
+    django_address = settings.BRIDGED_DJANGO_ADDRESS
+    metrics_address = settings.BRIDGED_METRICS_ADDRESS
+    shared_queue = journal = None
+    if shard is not None:
+        config, peers = _shard_settings(shard)
+        judge_address, django_address = config['judge'], config['django']
+        metrics_address = config.get('metrics')
+        shared_queue = journal = SharedQueue(shard, peers, settings.BRIDGED_SHARD_POLL_INTERVAL,
+                                             settings.BRIDGED_DJANGO_TIMEOUT)
+        # Other shards are running: judges marked online and submissions in progress may be theirs.
+    else:
+        reset_judges()
+        if settings.BRIDGED_QUEUE_JOURNAL:
+            journal = QueueJournal(settings.BRIDGED_QUEUE_JOURNAL, fsync=settings.BRIDGED_QUEUE_JOURNAL_FSYNC)
+    judges = JudgeList(
+        journal,
+        weights=settings.BRIDGED_FAIR_SHARE_WEIGHTS,
+        aging_interval=settings.BRIDGED_QUEUE_AGING_INTERVAL,
+        locality_size=settings.BRIDGED_LOCALITY_SIZE,
+        locality_tolerance=settings.BRIDGED_LOCALITY_TOLERANCE,
+    )
+    if shared_queue is not None:
+        recover_shard(shared_queue)
+    elif journal is not None:
+        requeue_submissions(judges, journal)
+    else:
+        Submission.objects.filter(status__in=Submission.IN_PROGRESS_GRADING_STATUS) \
+            .update(status='IE', result='IE', error=None)
+    # Handler threads borrow one of a few database connections for each packet, however many judges connect.
+    pool = db_pool.configure(settings.BRIDGED_DB_POOL_SIZE, settings.BRIDGED_DB_POOL_TIMEOUT,
+                             settings.BRIDGED_DB_POOL_MAX_AGE)
+    case_buffer = TestCaseBuffer(settings.BRIDGED_TEST_CASE_FLUSH_ROWS, settings.BRIDGED_TEST_CASE_FLUSH_INTERVAL)
+    case_buffer.start()
+    heartbeats = HeartbeatBuffer(settings.BRIDGED_HEARTBEAT_INTERVAL)
+    heartbeats.start()
+    # One timer thread watches acknowledgements, pings and grading progress of every judge.
+    watchdog = Watchdog(workers=settings.BRIDGED_WATCHDOG_WORKERS)
+    watchdog.start()
+
+    registry.register('bridge_queue', judges.stats)
+    registry.register('bridge_test_cases', case_buffer.stats)
+    registry.register('bridge_heartbeats', heartbeats.stats)
+    registry.register('bridge_events', event.stats)
+    registry.register('bridge_watchdog_timers', watchdog.__len__)
+    if pool is not None:
+        registry.register('bridge_db_pool', pool.stats)
+    if shared_queue is not None:
+        registry.register('bridge_shared_queue', shared_queue.stats)
+        shared_queue.start(judges)
+    metrics_server = None
+    if metrics_address:
+        try:
+            metrics_server = MetricsServer(tuple(metrics_address))
+        except OSError:
+            logger.exception('Failed to serve metrics on %s', metrics_address)
+        else:
+            metrics_server.start()
+
+    if use_async:
+        bridge = AsyncBridge(settings.BRIDGED_ASYNC_WORKERS)
+        bridge.add_server(judge_address, JudgeHandler, judges=judges, case_buffer=case_buffer,
+                          watchdog=watchdog, heartbeats=heartbeats)
+        bridge.add_server(django_address, DjangoHandler, judges=judges, shared_queue=shared_queue)
+        servers = [bridge]
+        logger.info('Running bridge on an event loop with %d workers', settings.BRIDGED_ASYNC_WORKERS)
+    else:
+        judge_server = Server(judge_address,
+                              partial(JudgeHandler, judges=judges, case_buffer=case_buffer, watchdog=watchdog,
+                                      heartbeats=heartbeats))
+        django_server = Server(django_address, partial(DjangoHandler, judges=judges, shared_queue=shared_queue))
+        servers = [django_server, judge_server]
+
+    for server in servers:
+        threading.Thread(target=server.serve_forever).start()
+
+    if stop is None:
+        stop = threading.Event()
+
+        def signal_handler(signum, _):
+            logger.info('Exiting due to %s', signal.Signals(signum).name)
+            stop.set()
+
+        signal.signal(signal.SIGINT, signal_handler)
+        signal.signal(signal.SIGQUIT, signal_handler)
+        signal.signal(signal.SIGTERM, signal_handler)
 
     try:
         stop.wait()
     finally:
-        django_server.shutdown()
-        judge_server.shutdown()
+        for server in servers:
+            server.shutdown()
+        if metrics_server is not None:
+            metrics_server.stop()
+        watchdog.stop()
+        case_buffer.stop()
+        heartbeats.stop()
+        if journal is not None:
+            journal.close()
+        if pool is not None:
+            pool.close()
@@ -0,0 +1,143 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from queue import Empty, LifoQueue
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from judger.bridge.metrics import Histogram
+
+logger = logging.getLogger('judge.bridge')
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    A fixed number of database connections shared by the bridge's handler threads.
+
+    `connection()` lends one to the calling thread for the duration of a block, as that thread's
+    connection for `alias`, so the ORM code inside is unchanged. Connections stay open between
+    blocks. One that saw an error, or was opened more than `max_age` seconds ago, is closed when
+    it is returned and reconnects on its next use, instead of every use being preceded by a
+    `SELECT 1`. CONN_MAX_AGE is ignored, as its default of 0 would close every connection on
+    return. Blocks nest: a thread that holds a connection keeps it.
+
+    Code holding a connection must not wait for a lock that a thread may hold while waiting for a
+    connection, or the pool can run dry; take the connection first.
+    """
+
+    def __init__(self, size, timeout=30, max_age=None, alias=DEFAULT_DB_ALIAS):
+        self.size = size
+        self.timeout = timeout
+        self.max_age = max_age
+        self.alias = alias
+        # connection: when it was first returned connected, roughly when it connected
+        self._connected_at = {}
+        self._idle = LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._local = threading.local()
+
+        self.checkout_wait = Histogram()
+        self.timeouts = 0
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                connection = connections.create_connection(self.alias)
+                # Connections move between threads, which Django only allows when told to.
+                connection.inc_thread_sharing()
+                return connection
+
+        start = time.perf_counter()
+        try:
+            connection = self._idle.get(timeout=self.timeout)
+        except Empty:
+            self.timeouts += 1
+            raise PoolTimeout('no database connection free after %s seconds' % self.timeout)
+        self.checkout_wait.observe(time.perf_counter() - start)
+        return connection
+
+    def _is_obsolete(self, connection):
+        # Errors on a broken connection set `errors_occurred` too, so it is closed without testing it.
+        if connection.errors_occurred or connection.get_autocommit() != connection.settings_dict['AUTOCOMMIT']:
+            return True
+        connected_at = self._connected_at.setdefault(connection, time.monotonic())
+        return self.max_age is not None and time.monotonic() - connected_at >= self.max_age
+
+    def _checkin(self, connection):
+        try:
+            if connection.connection is not None and self._is_obsolete(connection):
+                connection.close()
+        except Exception:
+            logger.exception('Failed to check pooled database connection, closing it')
+            connection.close()
+        if connection.connection is None:
+            self._connected_at.pop(connection, None)
+        self._idle.put(connection)
+
+    @contextmanager
+    def connection(self):
+        if getattr(self._local, 'held', False):
+            yield connections[self.alias]
+            return
+
+        connection = self._checkout()
+        previous = getattr(connections._connections, self.alias, None)
+        connections[self.alias] = connection
+        self._local.held = True
+        try:
+            yield connection
+        finally:
+            self._local.held = False
+            if previous is None:
+                del connections[self.alias]
+            else:
+                connections[self.alias] = previous
+            self._checkin(connection)
+
+    def close(self):
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except Empty:
+                break
+            connection.close()
+            self._connected_at.pop(connection, None)
+
+    def stats(self):
+        idle = self._idle.qsize()
+        return {
+            'size': self.size,
+            'open': self._opened,
+            'in_use': self._opened - idle,
+            'idle': idle,
+            'timeouts': self.timeouts,
+            'checkout_wait': self.checkout_wait.snapshot(),
+        }
+
+
+_pool = None
+
+
+def configure(size, timeout=30, max_age=None):
+    """
+    Sets up the pool used by `pooled_connection`. With a size of 0 every thread keeps its own connection.
+    """
+    global _pool
+    _pool = ConnectionPool(size, timeout, max_age) if size else None
+    return _pool
+
+
+def pooled_connection():
+    return _pool.connection() if _pool is not None else nullcontext()
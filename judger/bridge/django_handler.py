@@ -1,36 +1,67 @@
-import json
 import logging
 import struct
+import time
+
+from django import db
+from django.conf import settings
 
 from judger.bridge.base_handler import Disconnect, ZlibPacketHandler
+from judger.bridge.codec import negotiate
+from judger.bridge.db_pool import pooled_connection
+from judger.bridge.metrics import QueryTimer, observe_packet, registry
 
 logger = logging.getLogger('judge.bridge')
 size_pack = struct.Struct('!I')
 
 
 class DjangoHandler(ZlibPacketHandler):
-    def __init__(self, request, client_address, server, judges):
+    def __init__(self, request, client_address, server, judges, shared_queue=None):
         super().__init__(request, client_address, server)
 
         self.handlers = {
             'submission-request': self.on_submission,
+            'submission-batch-request': self.on_submission_batch,
             'terminate-submission': self.on_termination,
             'disconnect-judge': self.on_disconnect_request,
+            'persistent-connection': self.on_persistent_connection,
+            'ping': self.on_ping,
+            'get-metrics': self.on_get_metrics,
         }
         self.judges = judges
+        self.shared_queue = shared_queue
+        # Persistent clients keep the connection open and tag every request with a `request-id`,
+        # which is echoed back in the reply.
+        self._persistent = False
+        self._codec = None
 
     def send(self, data):
-        super().send(json.dumps(data, separators=(',', ':')))
+        super().send(self.codec.dumps(data))
 
     def on_packet(self, packet):
-        packet = json.loads(packet)
+        packet = self.codec.loads(packet)
+        name = packet.get('name', None)
+        queries = QueryTimer()
+        start = time.perf_counter()
         try:
-            result = self.handlers.get(packet.get('name', None), self.on_malformed)(packet)
+            with pooled_connection(), db.connection.execute_wrapper(queries):
+                result = self.handlers.get(name, self.on_malformed)(packet)
         except Exception:
             logger.exception('Error in packet handling (Django-facing)')
             result = {'name': 'bad-request'}
+        observe_packet('django', name if isinstance(name, str) and name in self.handlers else 'malformed',
+                       time.perf_counter() - start, queries)
+
+        if not self._persistent:
+            self.send(result)
+            raise Disconnect()
+
+        result = dict(result or {'name': 'ok'})
+        result['request-id'] = packet.get('request-id')
         self.send(result)
-        raise Disconnect()
+        if self._codec is not None:
+            # Switch only once the reply is out, so it still reaches the client in the format it asked in.
+            self.use_codec(self._codec, settings.BRIDGED_COMPRESSION_THRESHOLD)
+            self._codec = None
 
     def on_submission(self, data):
         id = data['submission-id']
@@ -41,19 +72,59 @@ class DjangoHandler(ZlibPacketHandler):
         priority = data['priority']
         if not self.judges.check_priority(priority):
             return {'name': 'bad-request'}
-        self.judges.judge(id, problem, language, source, judge_id, priority)
+        if self.shared_queue is not None:
+            self.shared_queue.submit([(id, problem, language, source, data.get('meta'))], judge_id, priority)
+        else:
+            self.judges.judge(id, problem, language, source, judge_id, priority, data.get('meta'))
         return {'name': 'submission-received', 'submission-id': id}
 
+    def on_submission_batch(self, data):
+        judge_id = data['judge-id']
+        priority = data['priority']
+        if not self.judges.check_priority(priority):
+            return {'name': 'bad-request'}
+        submissions = [
+            (sub['submission-id'], sub['problem-id'], sub['language'], sub['source'], sub.get('meta'))
+            for sub in data['submissions']
+        ]
+        if self.shared_queue is not None:
+            self.shared_queue.submit(submissions, judge_id, priority)
+        else:
+            self.judges.judge_many(submissions, judge_id, priority)
+        return {'name': 'submission-batch-received', 'submission-ids': [sub[0] for sub in submissions]}
+
     def on_termination(self, data):
-        return {'name': 'submission-received', 'judge-aborted': self.judges.abort(data['submission-id'])}
+        id = data['submission-id']
+        aborted = self.judges.abort(id)
+        # A packet forwarded by another shard is only about this shard's judges.
+        if not aborted and self.shared_queue is not None and not data.get('shard-forwarded'):
+            aborted = self.shared_queue.abort(id)
+        return {'name': 'submission-received', 'judge-aborted': aborted}
 
     def on_disconnect_request(self, data):
         judge_id = data['judge-id']
         force = data['force']
         self.judges.disconnect(judge_id, force=force)
+        if self.shared_queue is not None and not data.get('shard-forwarded'):
+            self.shared_queue.disconnect(judge_id, force=force)
+
+    def on_persistent_connection(self, data):
+        self._persistent = True
+        self._codec = negotiate(data.get('codecs'), settings.BRIDGED_CODECS)
+        if self._codec is None:
+            return {'name': 'persistent-connection-accepted'}
+        return {'name': 'persistent-connection-accepted', 'codec': self._codec.name,
+                'compression-threshold': settings.BRIDGED_COMPRESSION_THRESHOLD}
+
+    def on_ping(self, data):
+        return {'name': 'pong'}
+
+    def on_get_metrics(self, data):
+        return {'name': 'metrics', 'metrics': registry.snapshot()}
 
     def on_malformed(self, packet):
         logger.error('Malformed packet: %s', packet)
+        return {'name': 'bad-request'}
 
     def on_close(self):
         self._to_kill = False
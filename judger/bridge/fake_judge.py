@@ -0,0 +1,123 @@
+import logging
+import socket
+import threading
+import time
+import zlib
+from queue import Queue
+
+from judger.bridge.client import encode_packet, read_packet
+from judger.bridge.codec import CODECS, JSON, available_codecs
+
+logger = logging.getLogger('judge.bridge')
+
+
+class FakeJudge(object):
+    """
+    A judge that speaks the real bridge protocol but grades nothing: every submission it is given
+    passes `cases` test cases, each taking `case_latency` seconds. Used by `loadtest_bridge`.
+    """
+
+    def __init__(self, address, name, key, problems, executors, slots=1, cases=10, case_latency=0.01):
+        self.address = address
+        self.name = name
+        self.key = key
+        self.problems = problems
+        self.executors = executors
+        self.slots = slots
+        self.cases = cases
+        self.case_latency = case_latency
+
+        self.codec = JSON
+        self.compression_threshold = None
+        self.graded = 0
+        self._sock = None
+        self._send_lock = threading.Lock()
+        self._work = Queue()
+        self._threads = []
+
+    def connect(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self._sock = socket.create_connection(self.address)
+                break
+            except OSError:
+                # The bridge may still be starting up.
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        self._reader = self._sock.makefile('rb')
+
+        self._send({
+            'name': 'handshake',
+            'problems': [[problem, 0] for problem in self.problems],
+            'executors': {executor: [[executor, [1, 0]]] for executor in self.executors},
+            'id': self.name,
+            'key': self.key,
+            'slots': self.slots,
+            'codecs': available_codecs(),
+        })
+        reply = read_packet(self._reader)
+        if reply.get('name') != 'handshake-success':
+            raise ValueError('judge %s failed to authenticate: %r' % (self.name, reply))
+        if reply.get('codec') in CODECS:
+            self.codec = CODECS[reply['codec']]
+            self.compression_threshold = reply.get('compression-threshold')
+
+        self._threads = [threading.Thread(target=self._read_loop, name='fake-judge-%s' % self.name, daemon=True)]
+        self._threads += [threading.Thread(target=self._grade_loop, name='fake-judge-%s-%d' % (self.name, slot),
+                                           daemon=True) for slot in range(self.slots)]
+        for thread in self._threads:
+            thread.start()
+
+    def close(self):
+        for _ in range(self.slots):
+            self._work.put(None)
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+            self._sock.close()
+        except (AttributeError, OSError):
+            pass
+
+    def _send(self, packet):
+        data = encode_packet(packet, self.codec, self.compression_threshold)
+        with self._send_lock:
+            self._sock.sendall(data)
+
+    def _read_loop(self):
+        try:
+            while True:
+                packet = read_packet(self._reader, self.codec)
+                name = packet.get('name')
+                if name == 'ping':
+                    self._send({'name': 'ping-response', 'when': packet['when'], 'time': time.time(), 'load': 0.0})
+                elif name == 'submission-request':
+                    self._send({'name': 'submission-acknowledged', 'submission-id': packet['submission-id']})
+                    self._work.put(packet['submission-id'])
+                elif name == 'disconnect':
+                    break
+        except (OSError, EOFError, ValueError, zlib.error):
+            pass
+        finally:
+            self.close()
+
+    def _grade_loop(self):
+        while True:
+            id = self._work.get()
+            if id is None:
+                return
+            try:
+                self._grade(id)
+            except OSError:
+                return
+
+    def _grade(self, id):
+        self._send({'name': 'grading-begin', 'submission-id': id, 'pretested': False})
+        for position in range(1, self.cases + 1):
+            time.sleep(self.case_latency)
+            self._send({'name': 'test-case-status', 'submission-id': id, 'cases': [{
+                'position': position, 'status': 0, 'time': self.case_latency, 'memory': 1024,
+                'points': 1, 'total-points': 1, 'output': '', 'feedback': '', 'extended-feedback': '',
+            }]})
+        self._send({'name': 'grading-end', 'submission-id': id})
+        self.graded += 1
@@ -0,0 +1,65 @@
+STATUS_CODES = ['SC', 'AC', 'WA', 'MLE', 'TLE', 'IR', 'RTE', 'OLE']
+STATUS_INDEX = {code: index for index, code in enumerate(STATUS_CODES)}
+
+
+class GradingAccumulator(object):
+    """
+    Running totals of a submission's test cases, enough to produce its final result
+    without reading the SubmissionTestCase rows back.
+    """
+    __slots__ = ('time', 'memory', 'points', 'total', 'status', 'batches')
+
+    def __init__(self):
+        self.time = 0
+        self.memory = 0
+        self.points = 0.0
+        self.total = 0
+        self.status = 0
+        self.batches = {}  # batch number: [min points, max total]
+
+    def add(self, status, time, memory, points, total, batch=None):
+        self.time += time
+        if not batch:
+            self.points += points
+            self.total += total
+        elif batch in self.batches:
+            current = self.batches[batch]
+            current[0] = min(current[0], points)
+            current[1] = max(current[1], total)
+        else:
+            self.batches[batch] = [points, total]
+        self.memory = max(self.memory, memory)
+        self.status = max(self.status, STATUS_INDEX[status])
+
+    @classmethod
+    def from_test_cases(cls, cases):
+        accumulator = cls()
+        for case in cases:
+            accumulator.add(case.status, case.time, case.memory, case.points, case.total, case.batch)
+        return accumulator
+
+    def result(self):
+        """
+        :return: (time, memory, case points, case total, result code)
+        """
+        points = self.points
+        total = self.total
+        for batch_points, batch_total in self.batches.values():
+            points += batch_points
+            total += batch_total
+        return self.time, self.memory, round(points, 1), round(total, 1), STATUS_CODES[self.status]
+
+
+class GradingState(object):
+    __slots__ = ('problem_points', 'partial', 'accumulator')
+
+    def __init__(self, problem_points, partial):
+        self.problem_points = problem_points
+        self.partial = partial
+        self.accumulator = GradingAccumulator()
+
+    def submission_points(self, case_points, case_total):
+        points = round(case_points / case_total * self.problem_points if case_total > 0 else 0, 3)
+        if not self.partial and points != self.problem_points:
+            points = 0
+        return points
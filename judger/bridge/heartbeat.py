@@ -0,0 +1,84 @@
+import logging
+import threading
+
+from django.db.models import Case, FloatField, Value, When
+
+from judger.bridge.db_pool import pooled_connection
+from judger.models import Judge
+
+logger = logging.getLogger('judge.bridge')
+
+
+class HeartbeatBuffer(object):
+    """
+    Collects the latest ping and load of every judge and writes them all in one UPDATE
+    every `interval` seconds, instead of one UPDATE per judge per ping.
+
+    Without a running flusher thread (start() not called) every record() is written inline.
+    """
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self._pending = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.updates = 0
+        self.flushes = 0
+        self.flush_errors = 0
+
+    def record(self, name, ping, load):
+        with self.lock:
+            self._pending[name] = (ping, load)
+        if self._thread is None:
+            self.flush()
+
+    def discard(self, name):
+        with self.lock:
+            self._pending.pop(name, None)
+
+    def flush(self):
+        with self.lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        try:
+            Judge.objects.filter(name__in=list(pending)).update(
+                ping=Case(*[When(name=name, then=Value(ping)) for name, (ping, _) in pending.items()],
+                          output_field=FloatField()),
+                load=Case(*[When(name=name, then=Value(load)) for name, (_, load) in pending.items()],
+                          output_field=FloatField()),
+            )
+        except Exception:
+            self.flush_errors += 1
+            logger.exception('Failed to write heartbeats of %d judge(s)', len(pending))
+        else:
+            self.updates += len(pending)
+            self.flushes += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if self._pending:
+                with pooled_connection():
+                    self.flush()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='judge-heartbeats', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def stats(self):
+        return {
+            'pending': len(self._pending),
+            'updates': self.updates,
+            'flushes': self.flushes,
+            'flush_errors': self.flush_errors,
+        }
@@ -0,0 +1,97 @@
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger('judge.bridge')
+
+
+class QueueJournal(object):
+    """
+    Append-only record of the submissions JudgeList is responsible for, so a restarted bridge
+    can queue them again with the priority and judge they were sent with.
+
+    Each submission gets one line when it is queued and another once it is done with (graded,
+    aborted, or lost with its judge). Lines are flushed to the OS as they are written, which
+    survives the bridge process dying; pass `fsync=True` to also survive the machine dying,
+    at the cost of a disk sync per line. The file is rewritten with only the live entries on
+    open and whenever finished entries make up most of it.
+    """
+
+    def __init__(self, path, fsync=False, compact_threshold=10000):
+        self.path = path
+        self.fsync = fsync
+        self.compact_threshold = compact_threshold
+        self.lock = threading.Lock()
+        self.live = self._load()  # submission id: (priority, judge id), in queueing order
+        self._file = None
+        self._lines = 0
+        self._compact()
+
+    def _load(self):
+        live = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        if line.startswith('+'):
+                            id, priority, judge_id = line[1:].split(' ', 2)
+                            live[int(id)] = (int(priority), json.loads(judge_id))
+                        elif line.startswith('-'):
+                            live.pop(int(line[1:]), None)
+                    except ValueError:
+                        # Most likely a line cut short by a crash; everything before it is still good.
+                        logger.warning('Ignoring malformed queue journal line: %r', line)
+        except FileNotFoundError:
+            pass
+        return live
+
+    def _compact(self):
+        if self._file is not None:
+            self._file.close()
+        temp = self.path + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as f:
+            f.writelines(self._format_queued(id, *entry) for id, entry in self.live.items())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._lines = len(self.live)
+
+    @staticmethod
+    def _format_queued(id, priority, judge_id):
+        return '+%d %d %s\n' % (id, priority, json.dumps(judge_id))
+
+    def _write(self, line):
+        self._file.write(line)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._lines += 1
+        if self._lines > self.compact_threshold and self._lines > 4 * len(self.live):
+            self._compact()
+
+    def queued(self, id, priority, judge_id):
+        with self.lock:
+            if self.live.get(id) == (priority, judge_id):
+                return
+            self.live[id] = (priority, judge_id)
+            try:
+                self._write(self._format_queued(id, priority, judge_id))
+            except OSError:
+                logger.exception('Failed to journal queued submission %d', id)
+
+    def finished(self, id):
+        with self.lock:
+            if self.live.pop(id, None) is None:
+                return
+            try:
+                self._write('-%d\n' % id)
+            except OSError:
+                logger.exception('Failed to journal finished submission %d', id)
+
+    def close(self):
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
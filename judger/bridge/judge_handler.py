@@ -13,47 +13,49 @@ from django.utils import timezone
 
 from judger import event_poster as event
 from judger.bridge.base_handler import ZlibPacketHandler, proxy_list
+from judger.bridge.case_buffer import TestCaseBuffer
+from judger.bridge.codec import negotiate
+from judger.bridge.db_pool import pooled_connection
+from judger.bridge.grading import GradingAccumulator, GradingState
+from judger.bridge.heartbeat import HeartbeatBuffer
+from judger.bridge.metrics import QueryTimer, observe_packet, registry
+from judger.bridge.watchdog import Watchdog
 from judger.caching import finished_submission
-from problem.models import Problem, LanguageLimit
+from judger.judgeapi import forget_attempt, get_submission_meta
+from problem.models import Problem
 from judger.models import Judge, RuntimeVersion, Language
 from submission.models import Submission, SubmissionTestCase
 
 logger = logging.getLogger('judge.bridge')
 json_log = logging.getLogger('judge.json.bridge')
 
-## Hotfix to https://github.com/BKDN-University/bkdnOJ-v2/issues/37
-## Prod server is running with 1000 Connections
-SUBMISSIONS_COUNT_TO_CLEAR_IDLE = 330
-
+PING_INTERVAL = 10
+# Seconds a judge gets to answer a ping, acknowledge a submission, or report progress on one it is grading
+PING_TIMEOUT = 30
+ACK_TIMEOUT = 20
+GRADING_STALL_TIMEOUT = 300
 UPDATE_RATE_LIMIT = 5
 UPDATE_RATE_TIME = 0.5
+# From the submission request reaching the bridge to the judge starting to grade it.
+START_LATENCY = registry.histogram('bridge_submission_start_seconds', unit=1e-3)
 SubmissionData = namedtuple('SubmissionData',
-  'time memory short_circuit pretests_only contest_no attempt_no user_id')
-
-def _clean_up_idle_conn_on_submission_finished(id: int):
-    if id % SUBMISSIONS_COUNT_TO_CLEAR_IDLE == 0:
-        logger.info('>> Reached %d subs, clearing idle connections...', SUBMISSIONS_COUNT_TO_CLEAR_IDLE)
-        db.close_old_connections()
-        with db.connection.cursor() as cursor:
-            sql = "SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE state = 'idle'"
-            cursor.execute(sql)
-            row = cursor.fetchall()
-            logger.info('>> Cleared %d idle connections.', len(row))
-
-def _ensure_connection():
-    try:
-        db.connection.cursor().execute('SELECT 1').fetchall()
-    except Exception:
-        db.connection.close()
+  'time memory short_circuit pretests_only contest_no attempt_no user_id problem_points partial')
 
 
 class JudgeHandler(ZlibPacketHandler):
     proxies = proxy_list(settings.BRIDGED_JUDGE_PROXIES or [])
 
-    def __init__(self, request, client_address, server, judges):
+    # (judge id, relation): keys of the objects linked through that relation, while the judge is connected.
+    _persisted_relations = {}
+    _persisted_lock = threading.Lock()
+
+    def __init__(self, request, client_address, server, judges, case_buffer=None, watchdog=None, heartbeats=None):
         super().__init__(request, client_address, server)
 
         self.judges = judges
+        self.case_buffer = case_buffer or TestCaseBuffer()
+        self.heartbeats = heartbeats or HeartbeatBuffer()
+        self.watchdog = watchdog or Watchdog()
         self.handlers = {
             'grading-begin': self.on_grading_begin,
             'grading-end': self.on_grading_end,
@@ -69,8 +71,9 @@ class JudgeHandler(ZlibPacketHandler):
             'supported-problems': self.on_supported_problems,
             'handshake': self.on_handshake,
         }
-        self._working = False
-        self._no_response_job = None
+        # Submissions being graded; a judge advertising N slots in its handshake grades up to N at once.
+        self._working = set()
+        self.slots = 1
         self._problems = []
         self.executors = {}
         self.problems = {}
@@ -78,9 +81,8 @@ class JudgeHandler(ZlibPacketHandler):
         self.time_delta = None
         self.load = 1e100
         self.name = None
-        self.batch_id = None
-        self.in_batch = False
-        self._stop_ping = threading.Event()
+        # submission id: [current batch number or None, whether inside a batch]
+        self._batches = {}
         self._ping_average = deque(maxlen=6)  # 1 minute average, just like load
         self._time_delta = deque(maxlen=6)
 
@@ -91,6 +93,8 @@ class JudgeHandler(ZlibPacketHandler):
 
         self._submission_cache_id = None
         self._submission_cache = {}
+        # submission id: GradingState, filled in as test cases arrive
+        self._grading = {}
 
     def on_connect(self):
         self.timeout = 15
@@ -98,18 +102,24 @@ class JudgeHandler(ZlibPacketHandler):
         json_log.info(self._make_json_log(action='connect'))
 
     def on_disconnect(self):
-        self._stop_ping.set()
-        if self._working:
-            logger.error('Judge %s disconnected while handling submission %s', self.name, self._working)
+        with pooled_connection():
+            self._on_disconnect()
+
+    def _on_disconnect(self):
+        self.watchdog.cancel_all(self)
+        working = sorted(self._working)
+        if working:
+            logger.error('Judge %s disconnected while handling submission(s) %s', self.name, working)
         self.judges.remove(self)
         if self.name is not None:
             self._disconnected()
         logger.info('Judge disconnected from: %s with name %s', self.client_address, self.name)
 
         json_log.info(self._make_json_log(action='disconnect', info='judge disconnected'))
-        if self._working:
-            Submission.objects.filter(id=self._working).update(status='IE', result='IE', error='')
-            json_log.error(self._make_json_log(sub=self._working, action='close', info='IE due to shutdown on grading'))
+        if working:
+            Submission.objects.filter(id__in=working).update(status='IE', result='IE', error='')
+            for id in working:
+                json_log.error(self._make_json_log(sub=id, action='close', info='IE due to shutdown on grading'))
 
     def _authenticate(self, id, key):
         try:
@@ -128,12 +138,8 @@ class JudgeHandler(ZlibPacketHandler):
         judge.start_time = timezone.now()
         judge.online = True
         # bkdnOJ uses shortname instead of code
-        judge.problems.set(
-            Problem.objects.filter(shortname__in=list(self.problems.keys()))
-        )
-
-        judge.runtimes.set(
-            Language.objects.filter(key__in=list(self.executors.keys())))
+        self._sync_relation('problems', Problem, 'shortname', self.problems.keys())
+        self._sync_relation('runtimes', Language, 'key', self.executors.keys())
 
         # Delete now in case we somehow crashed and left some over from the last connection
         RuntimeVersion.objects.filter(judge=judge).delete()
@@ -150,22 +156,46 @@ class JudgeHandler(ZlibPacketHandler):
         json_log.info(self._make_json_log(action='auth', info='judge successfully authenticated',
                                           executors=list(self.executors.keys())))
 
+    def _sync_relation(self, relation, model, key_field, keys):
+        """
+        Links the judge to the `model` objects whose `key_field` is in `keys`, writing only what changed
+        since the last time this connection wrote the relation, which is nothing when a judge sends the
+        same problems again. Keys with no object yet are looked up again on the next call.
+        """
+        manager = getattr(self.judge, relation)
+        keys = frozenset(keys)
+        with self._persisted_lock:
+            persisted = self._persisted_relations.get((self.judge.id, relation))
+        if persisted is None:
+            persisted = frozenset(manager.values_list(key_field, flat=True))
+
+        removed = persisted - keys
+        if removed:
+            manager.remove(*manager.filter(**{key_field + '__in': removed}).values_list('pk', flat=True))
+        linked = persisted & keys
+        added = keys - persisted
+        if added:
+            found = dict(model.objects.filter(**{key_field + '__in': added}).values_list('pk', key_field))
+            manager.add(*found)
+            linked |= frozenset(found.values())
+
+        with self._persisted_lock:
+            self._persisted_relations[self.judge.id, relation] = linked
+
     def _disconnected(self):
+        self.heartbeats.discard(self.name)
+        # The relations can be edited while the judge is away, so read them again when it reconnects.
+        with self._persisted_lock:
+            for relation in ('problems', 'runtimes'):
+                self._persisted_relations.pop((self.judge.id, relation), None)
         Judge.objects.filter(id=self.judge.id).update(online=False)
         RuntimeVersion.objects.filter(judge=self.judge).delete()
 
     def _update_ping(self):
-        try:
-            Judge.objects.filter(name=self.name).update(ping=self.latency, load=self.load)
-        except Exception as e:
-            ## TODO: Maybe this causes https://github.com/BKDN-University/bkdnOJ-v2/issues/37?
-            ##       DMOJ dev might implem solutions that are tied to MySQL only, but we are using Postgres
-            # What can I do? I don't want to tie this to MySQL.
-            if e.__class__.__name__ == 'OperationalError' and e.__module__ == '_mysql_exceptions' and e.args[0] == 2006:
-                db.connection.close()
+        self.heartbeats.record(self.name, self.latency, self.load)
 
     def send(self, data):
-        super().send(json.dumps(data, separators=(',', ':')))
+        super().send(self.codec.dumps(data))
 
     def on_handshake(self, packet):
         if 'id' not in packet or 'key' not in packet:
@@ -179,15 +209,23 @@ class JudgeHandler(ZlibPacketHandler):
             return
 
         self.timeout = 60
+        self.slots = max(1, int(packet.get('slots', 1)))
         self._problems = packet['problems']
         self.problems = dict(self._problems)
         self.executors = packet['executors']
         self.name = packet['id']
 
-        self.send({'name': 'handshake-success'})
-        logger.info('Judge authenticated: %s (%s)', self.client_address, packet['id'])
+        # Judges that don't offer codecs get the original handshake reply, and keep compressed JSON throughout.
+        codec = negotiate(packet.get('codecs'), settings.BRIDGED_CODECS)
+        if codec is None:
+            self.send({'name': 'handshake-success'})
+        else:
+            self.send({'name': 'handshake-success', 'codec': codec.name,
+                       'compression-threshold': settings.BRIDGED_COMPRESSION_THRESHOLD})
+            self.use_codec(codec, settings.BRIDGED_COMPRESSION_THRESHOLD)
+        logger.info('Judge authenticated: %s (%s) with %d slot(s)', self.client_address, packet['id'], self.slots)
         self.judges.register(self)
-        threading.Thread(target=self._ping_thread).start()
+        self._start_ping()
         self._connected()
 
     def can_judge(self, problem, executor, judge_id=None):
@@ -197,52 +235,36 @@ class JudgeHandler(ZlibPacketHandler):
     def working(self):
         return bool(self._working)
 
-    def get_related_submission_data(self, submission):
-        _ensure_connection()
-
-        try:
-            # ppk, time, memory, short_circuit, lid, is_pretested, sub_date, uid, part_virtual, part_id = (
-            #     Submission.objects.filter(id=submission)
-            #               .values_list('problem__shortname', 'problem__time_limit', 'problem__memory_limit',
-            #                            'problem__short_circuit', 'language__id', 'is_pretested', 'date', 'user__id',
-            #                            'contest__participation__virtual', 'contest__participation__id')).get()
-
-            ppk, time, memory, short_circuit, lid, is_pretested, sub_date, uid = (
-                Submission.objects.filter(id=submission)
-                          .values_list('problem__shortname', 'problem__time_limit', 'problem__memory_limit',
-                                       'problem__short_circuit', 'language__id', 'is_pretested', 'date', 'user__id')).get()
-
-        except Submission.DoesNotExist:
-            logger.error('Submission vanished: %s', submission)
-            json_log.error(self._make_json_log(
-                sub=self._working, action='request',
-                info='submission vanished when fetching info',
-            ))
-            return
-
-        # attempt_no = Submission.objects.filter(
-        #     problem__shortname=ppk, contest__participation__id=part_id, user__id=uid,
-        #     date__lt=sub_date).exclude(status__in=('CE', 'IE')).count() + 1
-        attempt_no = Submission.objects.filter(
-            problem__shortname=ppk, user__id=uid,
-            date__lt=sub_date).exclude(status__in=('CE', 'IE')).count() + 1
+    @property
+    def free_slots(self):
+        return self.slots - len(self._working)
 
-        try:
-            time, memory = (
-                LanguageLimit.objects.filter(problem__shortname=ppk, language__id=lid)
-                .values_list('time_limit', 'memory_limit').get()
-            )
-        except LanguageLimit.DoesNotExist:
-            pass
+    @property
+    def occupancy(self):
+        return len(self._working) / self.slots
+
+    def get_related_submission_data(self, submission, meta=None):
+        # The meta is normally resolved by Django when the submission is requested; only look it up if it wasn't.
+        if meta is None:
+            meta = get_submission_meta(submission)
+            if meta is None:
+                logger.error('Submission vanished: %s', submission)
+                json_log.error(self._make_json_log(
+                    sub=submission, action='request',
+                    info='submission vanished when fetching info',
+                ))
+                return
 
         return SubmissionData(
-            time=time,
-            memory=memory,
-            short_circuit=short_circuit,
-            pretests_only=is_pretested,
-            contest_no=None, #part_virtual,
-            attempt_no=attempt_no,
-            user_id=uid,
+            time=meta['time-limit'],
+            memory=meta['memory-limit'],
+            short_circuit=meta['short-circuit'],
+            pretests_only=meta['pretests-only'],
+            contest_no=meta['in-contest'],
+            attempt_no=meta['attempt-no'],
+            user_id=meta['user'],
+            problem_points=meta['problem-points'],
+            partial=meta['partial'],
         )
 
     def disconnect(self, force=False):
@@ -252,10 +274,12 @@ class JudgeHandler(ZlibPacketHandler):
         else:
             self.send({'name': 'disconnect'})
 
-    def submit(self, id, problem, language, source):
-        data = self.get_related_submission_data(id)
-        self._working = id
-        self._no_response_job = threading.Timer(20, self._kill_if_no_response)
+    def submit(self, id, problem, language, source, meta=None):
+        data = self.get_related_submission_data(id, meta)
+        self._working.add(id)
+        self._batches[id] = [None, False]
+        self._grading[id] = GradingState(data.problem_points, data.partial)
+        self.watchdog.schedule((self, 'ack', id), ACK_TIMEOUT, lambda: self._kill_if_no_response(id))
         self.send({
             'name': 'submission-request',
             'submission-id': id,
@@ -273,17 +297,42 @@ class JudgeHandler(ZlibPacketHandler):
             },
         })
 
-    def _kill_if_no_response(self):
-        logger.error('Judge failed to acknowledge submission: %s: %s', self.name, self._working)
+    def _kill_if_no_response(self, id):
+        if id not in self._working:
+            return
+        logger.error('Judge failed to acknowledge submission: %s: %s', self.name, id)
+        self._requeue_and_close()
+
+    def _kill_if_stalled(self, id):
+        if id not in self._working:
+            return
+        logger.error('Judge stopped reporting progress on submission: %s: %s', self.name, id)
+        self._requeue_and_close()
+
+    def _kill_if_no_pong(self):
+        logger.warning('Judge stopped answering pings: %s: %s', self.name, sorted(self._working))
+        self._requeue_and_close()
+
+    def _requeue_and_close(self):
+        # Everything the judge holds goes back in the queue, not just the submission that timed out.
+        # Hold the queue lock so the judge can't finish a submission while it is being taken away.
+        with pooled_connection(), self.judges.lock:
+            for id in [id for id in self._working if self.judges.submission_map.get(id) is self]:
+                self.case_buffer.discard(id)
+                Submission.objects.filter(id=id).update(status='QU', result=None, current_testcase=0, error=None)
+                SubmissionTestCase.objects.filter(submission_id=id).delete()
+                if self.judges.requeue(self, id):
+                    self._grading.pop(id, None)
+                    self._batches.pop(id, None)
+                    self._working.discard(id)
+                    json_log.error(self._make_json_log(sub=id, action='requeue', info='judge unresponsive'))
         self.close()
 
     def on_timeout(self):
         if self.name:
-            logger.warning('Judge seems dead: %s: %s', self.name, self._working)
+            logger.warning('Judge seems dead: %s: %s', self.name, sorted(self._working))
 
     def on_submission_processing(self, packet):
-        _ensure_connection()
-
         id = packet['submission-id']
         if Submission.objects.filter(id=id).update(status='P', judged_on=self.judge):
             event.post('sub_%s' % Submission.get_id_secret(id), {'type': 'processing'})
@@ -295,41 +344,61 @@ class JudgeHandler(ZlibPacketHandler):
 
     def on_submission_wrong_acknowledge(self, packet, expected, got):
         json_log.error(self._make_json_log(packet, action='processing', info='wrong-acknowledge', expected=expected))
-        Submission.objects.filter(id=expected).update(status='IE', result='IE', error=None)
+        Submission.objects.filter(id__in=expected).update(status='IE', result='IE', error=None)
         Submission.objects.filter(id=got, status='QU').update(status='IE', result='IE', error=None)
 
     def on_submission_acknowledged(self, packet):
-        if not packet.get('submission-id', None) == self._working:
-            logger.error('Wrong acknowledgement: %s: %s, expected: %s', self.name, packet.get('submission-id', None),
-                         self._working)
-            self.on_submission_wrong_acknowledge(packet, self._working, packet.get('submission-id', None))
+        id = packet.get('submission-id', None)
+        if id not in self._working:
+            # Anything not yet acknowledged could be what the judge meant.
+            expected = [id for id in self._working if self.watchdog.pending((self, 'ack', id))]
+            logger.error('Wrong acknowledgement: %s: %s, expected: %s', self.name, id, expected)
+            self.on_submission_wrong_acknowledge(packet, expected, id)
             self.close()
-        logger.info('Submission acknowledged: %d', self._working)
-        if self._no_response_job:
-            self._no_response_job.cancel()
-            self._no_response_job = None
+            return
+        logger.info('Submission acknowledged: %d', id)
+        self.watchdog.cancel((self, 'ack', id))
         self.on_submission_processing(packet)
 
-    def abort(self):
-        self.send({'name': 'terminate-submission'})
+    def abort(self, submission):
+        # Single-slot judges ignore the id; multi-slot judges need it to know which one to stop.
+        self.send({'name': 'terminate-submission', 'submission-id': submission})
 
-    def get_current_submission(self):
-        return self._working or None
+    def get_current_submissions(self):
+        return list(self._working)
+
+    def release(self, submission):
+        # Frees the slot of a submission the judge is done with.
+        self._working.discard(submission)
 
     def ping(self):
         self.send({'name': 'ping', 'when': time.time()})
+        if not self.watchdog.pending((self, 'pong')):
+            self.watchdog.schedule((self, 'pong'), PING_TIMEOUT, self._kill_if_no_pong)
 
     def on_packet(self, data):
         try:
             try:
-                data = json.loads(data)
+                data = self.codec.loads(data)
                 if 'name' not in data:
                     raise ValueError
             except ValueError:
                 self.on_malformed(data)
             else:
+                name = data['name'] if data['name'] in self.handlers else 'malformed'
                 handler = self.handlers.get(data['name'], self.on_malformed)
-                handler(data)
+                queries = QueryTimer()
+                start = time.perf_counter()
+                try:
+                    with pooled_connection(), db.connection.execute_wrapper(queries):
+                        handler(data)
+                finally:
+                    observe_packet('judge', name, time.perf_counter() - start, queries)
+                # Any packet about the submission still being graded shows the judge is making progress on it.
+                id = data.get('submission-id')
+                if id in self._working:
+                    self.watchdog.schedule((self, 'stall', id), GRADING_STALL_TIMEOUT,
+                                           lambda: self._kill_if_stalled(id))
         except Exception:
             logger.exception('Error in packet handling (Judge-side): %s', self.name)
             self._packet_exception()
@@ -337,7 +406,7 @@ class JudgeHandler(ZlibPacketHandler):
             # not being malicious or simply malforms. THIS IS A SERVER!
 
     def _packet_exception(self):
-        json_log.exception(self._make_json_log(sub=self._working, info='packet processing exception'))
+        json_log.exception(self._make_json_log(info='packet processing exception'))
 
     def _submission_is_batch(self, id):
         if not Submission.objects.filter(id=id).update(batch=True):
@@ -347,22 +416,28 @@ class JudgeHandler(ZlibPacketHandler):
         logger.info('%s: Updated problem list', self.name)
         self._problems = packet['problems']
         self.problems = dict(self._problems)
-        if not self.working:
+        if self.free_slots > 0:
             self.judges.update_problems(self)
 
         # BKDNOJ uses 'shortname' for problem keys
-        self.judge.problems.set(
-            Problem.objects.filter(shortname__in=list(self.problems.keys())))
+        self._sync_relation('problems', Problem, 'shortname', self.problems.keys())
 
         json_log.info(self._make_json_log(action='update-problems', count=len(self.problems)))
 
     def on_grading_begin(self, packet):
         logger.info('%s: Grading has begun on: %s', self.name, packet['submission-id'])
-        self.batch_id = None
+        self._batches[packet['submission-id']] = [None, False]
+        entry = self.judges.in_flight.get(packet['submission-id'])
+        if entry is not None:
+            START_LATENCY.observe(time.monotonic() - entry.queued_at)
 
         if Submission.objects.filter(id=packet['submission-id']).update(
                 status='G', is_pretested=packet['pretested'], current_testcase=1,
                 batch=False, judged_date=timezone.now()):
+            self.case_buffer.discard(packet['submission-id'])
+            state = self._grading.get(packet['submission-id'])
+            if state is not None:
+                state.accumulator = GradingAccumulator()
             SubmissionTestCase.objects.filter(submission_id=packet['submission-id']).delete()
             event.post('sub_%s' % Submission.get_id_secret(packet['submission-id']), {'type': 'grading-begin'})
             self._post_update_submission(packet['submission-id'], 'grading-begin')
@@ -372,61 +447,33 @@ class JudgeHandler(ZlibPacketHandler):
             json_log.error(self._make_json_log(packet, action='grading-begin', info='unknown submission'))
 
     def on_grading_end(self, packet):
-        logger.info('%s: Grading has ended on: %s', self.name, packet['submission-id'])
+        id = packet['submission-id']
+        logger.info('%s: Grading has ended on: %s', self.name, id)
+        state = self._grading.pop(id, None)
         self._free_self(packet)
-        self.batch_id = None
-
-        try:
-            submission = Submission.objects.get(id=packet['submission-id'])
-        except Submission.DoesNotExist:
-            logger.warning('Unknown submission: %s', packet['submission-id'])
+        self.case_buffer.flush()
+
+        if state is None:
+            # We did not see this submission being dispatched (e.g. the bridge restarted mid-grading),
+            # so rebuild the result from the stored test cases.
+            state = self._load_grading_state(id)
+            if state is None:
+                logger.warning('Unknown submission: %s', id)
+                json_log.error(self._make_json_log(packet, action='grading-end', info='unknown submission'))
+                return
+
+        time, memory, points, total, result = state.accumulator.result()
+        sub_points = state.submission_points(points, total)
+
+        if not Submission.objects.filter(id=id).update(
+                status='D', time=time, memory=memory, points=sub_points, result=result,
+                case_points=points, case_total=total):
+            logger.warning('Unknown submission: %s', id)
             json_log.error(self._make_json_log(packet, action='grading-end', info='unknown submission'))
             return
 
-        time = 0
-        memory = 0
-        points = 0.0
-        total = 0
-        status = 0
-        status_codes = ['SC', 'AC', 'WA', 'MLE', 'TLE', 'IR', 'RTE', 'OLE']
-        batches = {}  # batch number: (points, total)
-
-        for case in SubmissionTestCase.objects.filter(submission=submission):
-            time += case.time
-            if not case.batch:
-                points += case.points
-                total += case.total
-            else:
-                if case.batch in batches:
-                    batches[case.batch][0] = min(batches[case.batch][0], case.points)
-                    batches[case.batch][1] = max(batches[case.batch][1], case.total)
-                else:
-                    batches[case.batch] = [case.points, case.total]
-            memory = max(memory, case.memory)
-            i = status_codes.index(case.status)
-            if i > status:
-                status = i
-
-        for i in batches:
-            points += batches[i][0]
-            total += batches[i][1]
-
-        points = round(points, 1)
-        total = round(total, 1)
-        submission.case_points = points
-        submission.case_total = total
-
+        submission = Submission.objects.select_related('problem', 'user', 'contest').get(id=id)
         problem = submission.problem
-        sub_points = round(points / total * problem.points if total > 0 else 0, 3)
-        if not problem.partial and sub_points != problem.points:
-            sub_points = 0
-
-        submission.status = 'D'
-        submission.time = time
-        submission.memory = memory
-        submission.points = sub_points
-        submission.result = status_codes[status]
-        submission.save()
 
         json_log.info(self._make_json_log(
             packet, action='grading-end', time=time, memory=memory,
@@ -457,7 +504,17 @@ class JudgeHandler(ZlibPacketHandler):
             participation = submission.contest.participation
             event.post('contest_%d' % participation.contest_id, {'type': 'update'})
         self._post_update_submission(submission.id, 'grading-end', done=True)
-        _clean_up_idle_conn_on_submission_finished(id=submission.id)
+
+    def _load_grading_state(self, id):
+        try:
+            problem_points, partial = Submission.objects.filter(id=id) \
+                .values_list('problem__points', 'problem__partial').get()
+        except Submission.DoesNotExist:
+            return None
+
+        state = GradingState(problem_points, partial)
+        state.accumulator = GradingAccumulator.from_test_cases(SubmissionTestCase.objects.filter(submission_id=id))
+        return state
 
     def on_compile_error(self, packet):
         logger.info('%s: Submission failed to compile: %s', self.name, packet['submission-id'])
@@ -469,13 +526,13 @@ class JudgeHandler(ZlibPacketHandler):
                 'log': packet['log'],
             })
             self._post_update_submission(packet['submission-id'], 'compile-error', done=True)
+            self._forget_attempt(packet['submission-id'])
             json_log.info(self._make_json_log(packet, action='compile-error', log=packet['log'],
                                               finish=True, result='CE'))
         else:
             logger.warning('Unknown submission: %s', packet['submission-id'])
             json_log.error(self._make_json_log(packet, action='compile-error', info='unknown submission',
                                                log=packet['log'], finish=True, result='CE'))
-        _clean_up_idle_conn_on_submission_finished(id=packet['submission-id'])
 
     def on_compile_message(self, packet):
         logger.info('%s: Submission generated compiler messages: %s', self.name, packet['submission-id'])
@@ -499,6 +556,7 @@ class JudgeHandler(ZlibPacketHandler):
         if Submission.objects.filter(id=id).update(status='IE', result='IE', error=packet['message']):
             event.post('sub_%s' % Submission.get_id_secret(id), {'type': 'internal-error'})
             self._post_update_submission(id, 'internal-error', done=True)
+            self._forget_attempt(id)
             json_log.info(self._make_json_log(packet, action='internal-error', message=packet['message'],
                                               finish=True, result='IE'))
         else:
@@ -521,18 +579,20 @@ class JudgeHandler(ZlibPacketHandler):
 
     def on_batch_begin(self, packet):
         logger.info('%s: Batch began on: %s', self.name, packet['submission-id'])
-        self.in_batch = True
-        if self.batch_id is None:
-            self.batch_id = 0
+        batch = self._batches.setdefault(packet['submission-id'], [None, False])
+        batch[1] = True
+        if batch[0] is None:
+            batch[0] = 0
             self._submission_is_batch(packet['submission-id'])
-        self.batch_id += 1
+        batch[0] += 1
 
-        json_log.info(self._make_json_log(packet, action='batch-begin', batch=self.batch_id))
+        json_log.info(self._make_json_log(packet, action='batch-begin', batch=batch[0]))
 
     def on_batch_end(self, packet):
-        self.in_batch = False
+        batch = self._batches.setdefault(packet['submission-id'], [None, False])
+        batch[1] = False
         logger.info('%s: Batch ended on: %s', self.name, packet['submission-id'])
-        json_log.info(self._make_json_log(packet, action='batch-end', batch=self.batch_id))
+        json_log.info(self._make_json_log(packet, action='batch-end', batch=batch[0]))
 
     def on_test_case(self, packet, max_feedback=SubmissionTestCase._meta.get_field('feedback').max_length):
         logger.info('%s: %d test case(s) completed on: %s', self.name, len(packet['cases']), packet['submission-id'])
@@ -540,11 +600,8 @@ class JudgeHandler(ZlibPacketHandler):
         id = packet['submission-id']
         updates = packet['cases']
         max_position = max(map(itemgetter('position'), updates))
-
-        if not Submission.objects.filter(id=id).update(current_testcase=max_position + 1):
-            logger.warning('Unknown submission: %s', id)
-            json_log.error(self._make_json_log(packet, action='test-case', info='unknown submission'))
-            return
+        state = self._grading.get(id)
+        batch = self._batches.get(id, [None, False])
 
         bulk_test_case_updates = []
         for result in updates:
@@ -570,16 +627,19 @@ class JudgeHandler(ZlibPacketHandler):
             test_case.memory = result['memory']
             test_case.points = result['points']
             test_case.total = result['total-points']
-            test_case.batch = self.batch_id if self.in_batch else None
+            test_case.batch = batch[0] if batch[1] else None
             test_case.feedback = (result.get('feedback') or '')[:max_feedback]
             test_case.extended_feedback = result.get('extended-feedback') or ''
             test_case.output = result['output'].replace("\x00", "")
             bulk_test_case_updates.append(test_case)
+            if state is not None:
+                state.accumulator.add(test_case.status, test_case.time, test_case.memory,
+                                      test_case.points, test_case.total, test_case.batch)
 
             json_log.info(self._make_json_log(
                 packet, action='test-case', case=test_case.case, batch=test_case.batch,
                 time=test_case.time, memory=test_case.memory, feedback=test_case.feedback,
-                extended_feedback=test_case.extended_feedback, output=test_case.output,
+                extended_feedback=test_case.extended_feedback, output_length=len(test_case.output),
                 points=test_case.points, total=test_case.total, status=test_case.status,
                 voluntary_context_switches=result.get('voluntary-context-switches', 0),
                 involuntary_context_switches=result.get('involuntary-context-switches', 0),
@@ -607,14 +667,15 @@ class JudgeHandler(ZlibPacketHandler):
             })
             self._post_update_submission(id, state='test-case')
 
-        SubmissionTestCase.objects.bulk_create(bulk_test_case_updates)
+        self.case_buffer.add(id, bulk_test_case_updates, max_position + 1)
 
     def on_malformed(self, packet):
         logger.error('%s: Malformed packet: %s', self.name, packet)
-        json_log.exception(self._make_json_log(sub=self._working, info='malformed json packet'))
+        json_log.exception(self._make_json_log(info='malformed json packet'))
 
     def on_ping_response(self, packet):
         end = time.time()
+        self.watchdog.cancel((self, 'pong'))
         self._ping_average.append(end - packet['when'])
         self._time_delta.append((end + packet['when']) / 2 - packet['time'])
         self.latency = sum(self._ping_average) / len(self._ping_average)
@@ -623,18 +684,24 @@ class JudgeHandler(ZlibPacketHandler):
         self._update_ping()
 
     def _free_self(self, packet):
+        id = packet['submission-id']
+        self._grading.pop(id, None)
+        self._batches.pop(id, None)
+        self.watchdog.cancel((self, 'ack', id))
+        self.watchdog.cancel((self, 'stall', id))
         self.judges.on_judge_free(self, packet['submission-id'])
 
-    def _ping_thread(self):
+    def _start_ping(self):
+        self._ping_periodically()
+
+    def _ping_periodically(self):
         try:
-            while True:
-                self.ping()
-                if self._stop_ping.wait(10):
-                    break
+            self.ping()
         except Exception:
             logger.exception('Ping error in %s', self.name)
             self.close()
-            raise
+        else:
+            self.watchdog.schedule((self, 'ping'), PING_INTERVAL, self._ping_periodically)
 
     def _make_json_log(self, packet=None, sub=None, **kwargs):
         data = {
@@ -648,15 +715,21 @@ class JudgeHandler(ZlibPacketHandler):
         data.update(kwargs)
         return json.dumps(data)
 
-    def _post_update_submission(self, id, state, done=False):
-        if self._submission_cache_id == id:
-            data = self._submission_cache
-        else:
-            self._submission_cache = data = Submission.objects.filter(id=id).values(
+    def _get_submission_info(self, id):
+        if self._submission_cache_id != id:
+            self._submission_cache = Submission.objects.filter(id=id).values(
                 'problem__is_public', 'contest_object_id',
-                'user_id', 'problem_id', 'status', 'language__key',
+                'user_id', 'problem_id', 'status', 'language__key', 'rejudged_date',
             ).get()
             self._submission_cache_id = id
+        return self._submission_cache
+
+    def _forget_attempt(self, id):
+        data = self._get_submission_info(id)
+        forget_attempt(id, data['user_id'], data['problem_id'], data['rejudged_date'])
+
+    def _post_update_submission(self, id, state, done=False):
+        data = self._get_submission_info(id)
 
         if data['problem__is_public']:
             event.post('submissions', {
@@ -1,62 +1,296 @@
+import heapq
 import logging
-from collections import namedtuple
+import time
+from collections import OrderedDict, defaultdict, namedtuple
+from itertools import count
 from random import random
 from threading import RLock
 
-from judger.judge_priority import REJUDGE_PRIORITY
-
-try:
-    from llist import dllist
-except ImportError:
-    from pyllist import dllist
+from judger.bridge.metrics import Histogram
+from judger.judge_priority import BATCH_REJUDGE_PRIORITY, CONTEST_SUBMISSION_PRIORITY, DEFAULT_PRIORITY, \
+    REJUDGE_PRIORITY
 
 logger = logging.getLogger('judge.bridge')
 
-PriorityMarker = namedtuple('PriorityMarker', 'priority')
+QueueEntry = namedtuple('QueueEntry', 'sequence id problem language source judge_id priority meta '
+                                      'start queued_at wait_class')
+
+# Share of judging capacity each flow is entitled to relative to the others, see JudgeList.
+DEFAULT_FAIR_SHARE_WEIGHTS = {'contest': 16, 'contest-user': 4, 'user': 1}
+# Number of flows per priority past which those that no longer matter are dropped.
+FLOW_CLEANUP_SIZE = 4096
+
+WAIT_CLASSES = {
+    CONTEST_SUBMISSION_PRIORITY: 'contest',
+    DEFAULT_PRIORITY: 'default',
+    REJUDGE_PRIORITY: 'rejudge',
+    BATCH_REJUDGE_PRIORITY: 'batch-rejudge',
+}
+
+
+class _Bucket(object):
+    """
+    Queued entries that need the same thing from a judge, ordered by start tag.
+    Removal is lazy: entries are dropped from the heap when they reach the top.
+    """
+    __slots__ = ('entries', 'heap')
+
+    def __init__(self):
+        self.entries = {}
+        self.heap = []
+
+    def add(self, entry):
+        self.entries[entry.id] = entry
+        heapq.heappush(self.heap, (entry.start, entry.sequence, entry.id))
+
+    def remove(self, id):
+        del self.entries[id]
+
+    def head(self):
+        heap = self.heap
+        while heap:
+            start, sequence, id = heap[0]
+            entry = self.entries.get(id)
+            if entry is not None and entry.sequence == sequence and entry.start == start:
+                return entry
+            heapq.heappop(heap)
+        return None
+
+    def __len__(self):
+        return len(self.entries)
 
 
 class JudgeList(object):
+    """
+    Within each priority, submissions are scheduled by start-time fair queueing. Every submission
+    belongs to a user flow, and contest submissions also to their contest's flow; a flow of weight
+    w advances its virtual time by 1/w per submission. A contest user spamming submissions only
+    delays their own, and a contest as a whole can outpace a practice user 16 to 1 by default.
+
+    Rejudges waiting longer than `aging_interval` seconds move up a priority, until they reach
+    DEFAULT_PRIORITY, so a busy site still makes progress on them.
+
+    Each judge remembers the last `locality_size` problems it was given. A new submission goes to
+    a judge that has its problem warm unless that judge is busier than the least busy candidate by
+    more than `locality_tolerance` (occupancy plus load per slot).
+    """
     priorities = 4
 
-    def __init__(self):
-        self.queue = dllist()
-        self.priority = [self.queue.append(PriorityMarker(i)) for i in range(self.priorities)]
+    def __init__(self, journal=None, weights=None, aging_interval=300, locality_size=32, locality_tolerance=0.5):
+        # One bucket per priority and per what a judge needs to take the entry: (problem, language, judge_id).
+        self.queues = [{} for _ in range(self.priorities)]
         self.judges = set()
+        # Judges with at least one free slot, in total and indexed by the executors they support.
+        self.idle = set()
+        self.idle_by_executor = defaultdict(set)
         self.node_map = {}
         self.submission_map = {}
+        # Entries of dispatched submissions, kept so they can be queued again if their judge stops responding.
+        self.in_flight = {}
         self.lock = RLock()
+        self._sequence = count()
+        # Optional QueueJournal recording every submission from being queued until it is done with.
+        self.journal = journal
+
+        self.weights = dict(DEFAULT_FAIR_SHARE_WEIGHTS, **(weights or {}))
+        self.aging_interval = aging_interval
+        # Per priority: the virtual time, the virtual finish time of each flow, the number of flows above
+        # which those behind the virtual time are dropped, and, for priorities that age, the time each
+        # queued entry arrived at that priority, in order.
+        self._virtual_time = [0.0] * self.priorities
+        self._flow_finish = [{} for _ in range(self.priorities)]
+        self._flow_limit = [FLOW_CLEANUP_SIZE] * self.priorities
+        self._arrivals = [OrderedDict() for _ in range(self.priorities)]
+
+        self.wait_times = {wait_class: Histogram(unit=1e-3) for wait_class in WAIT_CLASSES.values()}
+        # Time taken to hand a submission to a judge, including looking up its limits if needed.
+        self.dispatch_latency = Histogram()
+        self.dispatch_failures = 0
+
+        self.locality_size = locality_size
+        self.locality_tolerance = locality_tolerance
+        # judge: OrderedDict of recently dispatched problems, most recent last
+        self._recent_problems = {}
+        self.locality_hits = 0
+        self.locality_misses = 0
+
+    def _mark_idle(self, judge):
+        self.idle.add(judge)
+        for executor in judge.executors:
+            self.idle_by_executor[executor].add(judge)
+
+    def _mark_busy(self, judge):
+        self.idle.discard(judge)
+        for executor in judge.executors:
+            judges = self.idle_by_executor.get(executor)
+            if judges is not None:
+                judges.discard(judge)
+                if not judges:
+                    del self.idle_by_executor[executor]
+
+    def _forget(self, judge):
+        self._mark_busy(judge)
+        self.judges.discard(judge)
+        self._recent_problems.pop(judge, None)
+
+    def _free_slots(self, judges):
+        return sum(judge.free_slots for judge in judges)
+
+    def _flows(self, meta):
+        meta = meta or {}
+        if meta.get('contest') is not None:
+            return [(('contest', meta['contest']), self.weights['contest']),
+                    (('user', meta.get('user')), self.weights['contest-user'])]
+        return [(('user', meta.get('user')), self.weights['user'])]
+
+    def _start_tag(self, priority, meta):
+        virtual_time = self._virtual_time[priority]
+        finish = self._flow_finish[priority]
+        start = virtual_time
+        for flow, weight in self._flows(meta):
+            flow_start = max(virtual_time, finish.get(flow, virtual_time))
+            finish[flow] = flow_start + 1 / weight
+            start = max(start, flow_start)
+
+        if len(finish) > self._flow_limit[priority]:
+            # Flows that are behind the virtual time no longer affect anything. The next cleanup waits until
+            # the flows left double, so that many active flows don't make every insert scan them all.
+            finish = self._flow_finish[priority] = {flow: tag for flow, tag in finish.items() if tag > virtual_time}
+            self._flow_limit[priority] = max(FLOW_CLEANUP_SIZE, 2 * len(finish))
+        return start
+
+    def _make_entry(self, id, problem, language, source, judge_id, priority, meta):
+        wait_class = 'contest' if meta and meta.get('contest') is not None else WAIT_CLASSES[priority]
+        return QueueEntry(next(self._sequence), id, problem, language, source, judge_id, priority, meta,
+                          self._start_tag(priority, meta), time.monotonic(), wait_class)
+
+    def _insert(self, entry):
+        bucket = self.queues[entry.priority].get((entry.problem, entry.language, entry.judge_id))
+        if bucket is None:
+            bucket = self.queues[entry.priority][entry.problem, entry.language, entry.judge_id] = _Bucket()
+        bucket.add(entry)
+        self.node_map[entry.id] = entry
+        if self.aging_interval and entry.priority > DEFAULT_PRIORITY:
+            self._arrivals[entry.priority][entry.id] = time.monotonic()
+
+    def _dequeue(self, entry):
+        key = (entry.problem, entry.language, entry.judge_id)
+        bucket = self.queues[entry.priority][key]
+        bucket.remove(entry.id)
+        if not bucket:
+            del self.queues[entry.priority][key]
+        del self.node_map[entry.id]
+        self._arrivals[entry.priority].pop(entry.id, None)
+
+    def _age(self):
+        if not self.aging_interval:
+            return
+        deadline = time.monotonic() - self.aging_interval
+        for priority in range(DEFAULT_PRIORITY + 1, self.priorities):
+            arrivals = self._arrivals[priority]
+            while arrivals:
+                id, arrived = next(iter(arrivals.items()))
+                if arrived > deadline:
+                    break
+                entry = self.node_map[id]
+                self._dequeue(entry)
+                promoted = priority - 1
+                self._insert(entry._replace(priority=promoted, start=self._start_tag(promoted, entry.meta)))
+                logger.info('Promoted submission %d to priority %d after waiting', id, promoted)
+
+    def _next_entry(self, judge, priority):
+        best = None
+        for key, bucket in self.queues[priority].items():
+            if judge.can_judge(*key):
+                head = bucket.head()
+                if best is None or (head.start, head.sequence) < (best.start, best.sequence):
+                    best = head
+        return best
+
+    def _is_warm(self, judge, problem):
+        recent = self._recent_problems.get(judge)
+        return recent is not None and problem in recent
+
+    def _pick_judge(self, candidates, problem):
+        def busyness(judge):
+            return judge.occupancy + judge.load / judge.slots
+
+        least_busy = min(candidates, key=lambda judge: (busyness(judge), random()))
+        if not self.locality_size or self._is_warm(least_busy, problem):
+            return least_busy
+
+        limit = busyness(least_busy) + self.locality_tolerance
+        warm = [judge for judge in candidates if busyness(judge) <= limit and self._is_warm(judge, problem)]
+        if warm:
+            return min(warm, key=lambda judge: (busyness(judge), random()))
+        return least_busy
+
+    def _dispatched(self, entry, judge):
+        if self.locality_size:
+            recent = self._recent_problems.get(judge)
+            if recent is None:
+                recent = self._recent_problems[judge] = OrderedDict()
+            if entry.problem in recent:
+                self.locality_hits += 1
+                recent.move_to_end(entry.problem)
+            else:
+                self.locality_misses += 1
+                recent[entry.problem] = None
+                if len(recent) > self.locality_size:
+                    recent.popitem(last=False)
+
+        self.in_flight[entry.id] = entry
+        self._virtual_time[entry.priority] = max(self._virtual_time[entry.priority], entry.start)
+        self.wait_times[entry.wait_class].observe(time.monotonic() - entry.queued_at)
+
+    def _submit(self, judge, entry):
+        start = time.perf_counter()
+        judge.submit(entry.id, entry.problem, entry.language, entry.source, entry.meta)
+        self.dispatch_latency.observe(time.perf_counter() - start)
 
     def _handle_free_judge(self, judge):
         with self.lock:
-            node = self.queue.first
-            priority = 0
-            while node:
-                if isinstance(node.value, PriorityMarker):
-                    priority = node.value.priority + 1
-                elif priority >= REJUDGE_PRIORITY and len(self.judges) > 1 and sum(
-                        not judge.working for judge in self.judges) <= 1:
-                    return
-                else:
-                    id, problem, language, source, judge_id = node.value
-                    if judge.can_judge(problem, language, judge_id):
-                        self.submission_map[id] = judge
-                        try:
-                            judge.submit(id, problem, language, source)
-                        except Exception:
-                            logger.exception('Failed to dispatch %d (%s, %s) to %s', id, problem, language, judge.name)
-                            self.judges.remove(judge)
-                            return
-                        logger.info('Dispatched queued submission %d: %s', id, judge.name)
-                        self.queue.remove(node)
-                        del self.node_map[id]
-                        break
-                node = node.next
+            self._age()
+            while judge in self.judges and judge.free_slots > 0 and self._dispatch_queued(judge):
+                pass
+
+    def _dispatch_queued(self, judge):
+        for priority in range(self.priorities):
+            if not self.queues[priority]:
+                continue
+            # Keep a judge slot in reserve for non-rejudge submissions when there is more than one judge.
+            if priority >= REJUDGE_PRIORITY and len(self.judges) > 1 and self._free_slots(self.idle) <= 1:
+                return False
+
+            entry = self._next_entry(judge, priority)
+            if entry is None:
+                continue
+
+            self.submission_map[entry.id] = judge
+            try:
+                self._submit(judge, entry)
+            except Exception:
+                logger.exception('Failed to dispatch %d (%s, %s) to %s', entry.id, entry.problem,
+                                 entry.language, judge.name)
+                self.dispatch_failures += 1
+                del self.submission_map[entry.id]
+                self._forget(judge)
+                return False
+            logger.info('Dispatched queued submission %d: %s', entry.id, judge.name)
+            if judge.free_slots <= 0:
+                self._mark_busy(judge)
+            self._dequeue(entry)
+            self._dispatched(entry, judge)
+            return True
+        return False
 
     def register(self, judge):
         with self.lock:
             # Disconnect all judges with the same name, see <https://github.com/DMOJ/online-judge/issues/828>
             self.disconnect(judge, force=True)
             self.judges.add(judge)
+            if judge.free_slots > 0:
+                self._mark_idle(judge)
             self._handle_free_judge(judge)
 
     def disconnect(self, judge_id, force=False):
@@ -71,19 +305,22 @@ class JudgeList(object):
 
     def remove(self, judge):
         with self.lock:
-            sub = judge.get_current_submission()
-            if sub is not None:
+            for sub in judge.get_current_submissions():
                 try:
                     del self.submission_map[sub]
                 except KeyError:
                     pass
-            self.judges.discard(judge)
+                self.in_flight.pop(sub, None)
+                # The handler marks the submission IE, there is nothing left to restore.
+                if self.journal is not None:
+                    self.journal.finished(sub)
+            self._forget(judge)
 
             # Since we reserve a judge for high priority submissions when there are more than one,
             # we'll need to start judging if there is exactly one judge and it's free.
             if len(self.judges) == 1:
                 judge = next(iter(self.judges))
-                if not judge.working:
+                if judge.free_slots > 0:
                     self._handle_free_judge(judge)
 
     def __iter__(self):
@@ -93,60 +330,136 @@ class JudgeList(object):
         logger.info('Judge available after grading %d: %s', submission, judge.name)
         with self.lock:
             del self.submission_map[submission]
-            judge._working = False
+            self.in_flight.pop(submission, None)
+            if self.journal is not None:
+                self.journal.finished(submission)
+            judge.release(submission)
+            if judge in self.judges:
+                self._mark_idle(judge)
             self._handle_free_judge(judge)
 
     def abort(self, submission):
         logger.info('Abort request: %d', submission)
         with self.lock:
             try:
-                self.submission_map[submission].abort()
+                self.submission_map[submission].abort(submission)
                 return True
             except KeyError:
                 try:
-                    node = self.node_map[submission]
+                    entry = self.node_map[submission]
                 except KeyError:
                     pass
                 else:
-                    self.queue.remove(node)
-                    del self.node_map[submission]
+                    self._dequeue(entry)
+                    if self.journal is not None:
+                        self.journal.finished(submission)
                 return False
 
+    def release(self, ids):
+        """
+        Drops queued submissions without recording them as finished, for a shared queue to hand to another bridge.
+        """
+        with self.lock:
+            for id in ids:
+                entry = self.node_map.get(id)
+                if entry is not None:
+                    self._dequeue(entry)
+
     def check_priority(self, priority):
         return 0 <= priority < self.priorities
 
-    def judge(self, id, problem, language, source, judge_id, priority):
+    def _place(self, entry):
+        candidates = [
+            judge for judge in self.idle_by_executor.get(entry.language, ())
+            if judge.can_judge(entry.problem, entry.language, entry.judge_id)
+        ]
+        if entry.judge_id:
+            logger.info('Specified judge %s is%savailable', entry.judge_id, ' ' if candidates else ' not ')
+        else:
+            logger.info('Free judges: %d', len(candidates))
+
+        if len(self.judges) > 1 and self._free_slots(candidates) == 1 and entry.priority >= REJUDGE_PRIORITY:
+            candidates = []
+
+        while candidates:
+            judge = self._pick_judge(candidates, entry.problem)
+            logger.info('Dispatched submission %d to: %s', entry.id, judge.name)
+            self.submission_map[entry.id] = judge
+            try:
+                self._submit(judge, entry)
+            except Exception:
+                logger.exception('Failed to dispatch %d (%s, %s) to %s', entry.id, entry.problem, entry.language,
+                                 judge.name)
+                self.dispatch_failures += 1
+                del self.submission_map[entry.id]
+                self._forget(judge)
+                candidates.remove(judge)
+            else:
+                if judge.free_slots <= 0:
+                    self._mark_busy(judge)
+                self._dispatched(entry, judge)
+                return
+
+        self._insert(entry)
+        logger.info('Queued submission: %d', entry.id)
+
+    def judge(self, id, problem, language, source, judge_id, priority, meta=None):
         with self.lock:
             if id in self.submission_map or id in self.node_map:
                 # Already judging, don't queue again. This can happen during batch rejudges, rejudges should be
                 # idempotent.
                 return
 
-            candidates = [
-                judge for judge in self.judges if not judge.working and judge.can_judge(problem, language, judge_id)
-            ]
-            if judge_id:
-                logger.info('Specified judge %s is%savailable', judge_id, ' ' if candidates else ' not ')
-            else:
-                logger.info('Free judges: %d', len(candidates))
+            if self.journal is not None:
+                self.journal.queued(id, priority, judge_id)
 
-            if len(self.judges) > 1 and len(candidates) == 1 and priority >= REJUDGE_PRIORITY:
-                candidates = []
+            self._place(self._make_entry(id, problem, language, source, judge_id, priority, meta))
 
-            if candidates:
-                # Schedule the submission on the judge reporting least load.
-                judge = min(candidates, key=lambda judge: (judge.load, random()))
-                logger.info('Dispatched submission %d to: %s', id, judge.name)
-                self.submission_map[id] = judge
-                try:
-                    judge.submit(id, problem, language, source)
-                except Exception:
-                    logger.exception('Failed to dispatch %d (%s, %s) to %s', id, problem, language, judge.name)
-                    self.judges.discard(judge)
-                    return self.judge(id, problem, language, source, judge_id, priority)
-            else:
-                self.node_map[id] = self.queue.insert(
-                    (id, problem, language, source, judge_id),
-                    self.priority[priority],
-                )
-                logger.info('Queued submission: %d', id)
+    def requeue(self, judge, submission):
+        """
+        Takes a submission back from a judge that stopped responding and queues it again with its original
+        tags, so it keeps its place in line. The judge is no longer offered work; the caller is expected to
+        close it.
+
+        :return: Whether the submission was requeued.
+        """
+        with self.lock:
+            self._forget(judge)
+            if self.submission_map.get(submission) is not judge:
+                return False
+            del self.submission_map[submission]
+            entry = self.in_flight.pop(submission, None)
+            if entry is None:
+                return False
+
+            logger.info('Requeueing submission %d taken from %s', submission, judge.name)
+            self._place(entry)
+            return True
+
+    def judge_many(self, submissions, judge_id, priority):
+        # Queue a whole batch under one lock acquisition; judge() re-enters the lock for free.
+        with self.lock:
+            for id, problem, language, source, meta in submissions:
+                self.judge(id, problem, language, source, judge_id, priority, meta)
+
+    def stats(self):
+        with self.lock:
+            queued = dict.fromkeys(self.wait_times, 0)
+            for entry in self.node_map.values():
+                queued[entry.wait_class] += 1
+            judges = {
+                'connected': len(self.judges),
+                'slots': sum(judge.slots for judge in self.judges),
+                'free_slots': self._free_slots(self.judges),
+            }
+            by_priority = {priority: sum(map(len, buckets.values())) for priority, buckets in enumerate(self.queues)}
+        return {
+            'queued': queued,
+            'queued_by_priority': by_priority,
+            'in_flight': len(self.in_flight),
+            'judges': judges,
+            'wait_times': {wait_class: histogram.snapshot() for wait_class, histogram in self.wait_times.items()},
+            'dispatch_latency': self.dispatch_latency.snapshot(),
+            'dispatch_failures': self.dispatch_failures,
+            'locality': {'hits': self.locality_hits, 'misses': self.locality_misses},
+        }
@@ -0,0 +1,235 @@
+import json
+import logging
+import math
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('judge.bridge')
+
+
+class Histogram(object):
+    """
+    Log-bucketed histogram: each power of two is split into `precision` linear sub-buckets,
+    so relative error stays bounded regardless of magnitude. Recording is O(1).
+    """
+
+    def __init__(self, precision=8, unit=1e-6):
+        self.precision = precision
+        self.unit = unit
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.buckets = {}
+            self.count = 0
+            self.sum = 0.0
+            self.max = 0.0
+
+    def _bucket(self, value):
+        scaled = value / self.unit
+        if scaled < 1:
+            return 0
+        exponent = int(math.log2(scaled))
+        base = 1 << exponent
+        return exponent * self.precision + int((scaled - base) * self.precision / base) + 1
+
+    def _bucket_upper(self, bucket):
+        if bucket == 0:
+            return self.unit
+        exponent, sub = divmod(bucket - 1, self.precision)
+        base = 1 << exponent
+        return (base + base * (sub + 1) / self.precision) * self.unit
+
+    def observe(self, value):
+        bucket = self._bucket(value)
+        with self.lock:
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, q):
+        with self.lock:
+            if not self.count:
+                return 0.0
+            target = q / 100 * self.count
+            seen = 0
+            for bucket in sorted(self.buckets):
+                seen += self.buckets[bucket]
+                if seen >= target:
+                    return min(self._bucket_upper(bucket), self.max)
+            return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+class Counter(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class QueryTimer(object):
+    """
+    A database execute wrapper (see `connection.execute_wrapper`) counting queries and adding up their time.
+    """
+    __slots__ = ('queries', 'elapsed')
+
+    def __init__(self):
+        self.queries = 0
+        self.elapsed = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+
+_unsafe_name = re.compile(r'[^a-zA-Z0-9_]')
+
+
+def _flatten(name, value):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from _flatten('%s_%s' % (name, _unsafe_name.sub('_', str(key))), item)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield name, value
+
+
+class Registry(object):
+    """
+    Process-wide metrics: counters and histograms are created on first use and identified by
+    name and labels; collectors are callables (usually a component's `stats`) read at export time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = {}
+
+    def _get(self, cls, name, labels, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = cls(**kwargs)
+        return metric
+
+    def counter(self, name, **labels):
+        return self._get(Counter, name, labels)
+
+    def histogram(self, name, unit=1e-6, **labels):
+        return self._get(Histogram, name, labels, unit=unit)
+
+    def register(self, name, collector):
+        self._collectors[name] = collector
+
+    def unregister(self, name):
+        self._collectors.pop(name, None)
+
+    def _collect(self):
+        for (name, labels), metric in sorted(self._metrics.items(), key=lambda item: item[0]):
+            yield name, labels, metric.snapshot()
+        for name, collector in sorted(self._collectors.items()):
+            try:
+                yield name, (), collector()
+            except Exception:
+                logger.exception('Failed to collect metric %s', name)
+
+    def snapshot(self):
+        """
+        :return: {name: value}, or {name: {'label=value,...': value}} for labelled metrics.
+        """
+        result = {}
+        for name, labels, value in self._collect():
+            if labels:
+                result.setdefault(name, {})[','.join('%s=%s' % label for label in labels)] = value
+            else:
+                result[name] = value
+        return result
+
+    def render_text(self):
+        """
+        Renders every metric in the Prometheus text format, with nested values flattened into the name.
+        """
+        lines = []
+        for name, labels, value in self._collect():
+            suffix = '{%s}' % ','.join('%s=%s' % (key, json.dumps(str(label))) for key, label in labels) \
+                if labels else ''
+            for flat_name, number in _flatten(_unsafe_name.sub('_', name), value):
+                lines.append('%s%s %s' % (flat_name, suffix, number))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def observe_packet(side, name, elapsed, queries):
+    registry.histogram('bridge_packet_seconds', side=side, packet=name).observe(elapsed)
+    registry.histogram('bridge_packet_db_seconds', side=side, packet=name).observe(queries.elapsed)
+    registry.counter('bridge_packet_queries', side=side, packet=name).inc(queries.queries)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        if path != '/metrics':
+            self.send_error(404)
+            return
+        if query == 'format=json':
+            body, content_type = json.dumps(registry.snapshot()).encode('utf-8'), 'application/json'
+        else:
+            body, content_type = registry.render_text().encode('utf-8'), 'text/plain; version=0.0.4'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('Metrics request from %s: ' + format, self.client_address[0], *args)
+
+
+class MetricsServer(object):
+    """
+    Serves the registry over HTTP at /metrics (text), or /metrics?format=json, from a background thread.
+    """
+
+    def __init__(self, address):
+        self.server = ThreadingHTTPServer(address, _MetricsRequestHandler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='bridge-metrics', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
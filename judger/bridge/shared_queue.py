@@ -0,0 +1,211 @@
+import logging
+import threading
+
+from django.db import transaction
+from django.db.models import Q
+
+from judger.bridge.client import BridgeConnectionPool, BridgeTimeout, BridgeUnavailable
+from judger.bridge.db_pool import pooled_connection
+from judger.judgeapi import SUBMISSION_META_FIELDS, annotate_submission_meta, submission_meta
+from judger.models import Judge, SharedQueueEntry
+from submission.models import Submission
+
+logger = logging.getLogger('judge.bridge')
+
+
+class SharedQueue(object):
+    """
+    The submission queue of a sharded bridge, kept in the SharedQueueEntry table and shared by
+    several bridge processes (shards), each serving its own judges.
+
+    Any shard takes submissions from Django and adds them to the table. Each shard claims rows
+    with `SELECT ... FOR UPDATE SKIP LOCKED`, only as many as its judges have free slots and only
+    ones those judges can grade, and hands them to its own JudgeList. Within a shard, claimed
+    submissions are scheduled as usual; across shards, rows are claimed by priority, then age.
+
+    It stands in for the QueueJournal of the shard's JudgeList: rows of finished submissions are
+    deleted in batches, and a restarted shard gives back whatever it had claimed.
+
+    Aborts and judge disconnects for work held by another shard are forwarded to that shard
+    over its Django-facing port.
+    """
+
+    def __init__(self, shard, peers, poll_interval=0.2, timeout=30):
+        self.shard = shard
+        # shard number: address of its Django-facing server
+        self.peers = peers
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.judges = None
+        self.lock = threading.Lock()
+        self._finished = []
+        self._peer_pools = {}
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.claimed = 0
+        self.released = 0
+        self.forwarded = 0
+        self.errors = 0
+
+    # The QueueJournal interface used by JudgeList.
+
+    def queued(self, id, priority, judge_id):
+        # Claimed submissions already have their row.
+        pass
+
+    def finished(self, id):
+        with self.lock:
+            self._finished.append(id)
+        self._wakeup.set()
+
+    def close(self):
+        self.stop()
+
+    def submit(self, submissions, judge_id, priority):
+        """
+        Adds (id, problem, language, source, meta) submissions to the shared queue. Submissions that
+        are already queued or claimed are left alone, which keeps rejudges idempotent.
+        """
+        SharedQueueEntry.objects.bulk_create([
+            SharedQueueEntry(submission_id=submission[0], priority=priority, judge_name=judge_id)
+            for submission in submissions
+        ], ignore_conflicts=True)
+        self._wakeup.set()
+
+    def claimed_ids(self):
+        return list(SharedQueueEntry.objects.filter(shard=self.shard).values_list('submission_id', flat=True))
+
+    def release(self, ids, finished=()):
+        """
+        Gives submissions claimed by this shard back to the shared queue, and deletes the rows of `finished` ones.
+        """
+        if finished:
+            SharedQueueEntry.objects.filter(submission_id__in=list(finished)).delete()
+        if ids:
+            self.released += SharedQueueEntry.objects.filter(submission_id__in=list(ids), shard=self.shard) \
+                .update(shard=None)
+
+    def _free_judges(self):
+        with self.judges.lock:
+            return [(judge.judge.id, judge.name, judge.free_slots, list(judge.executors))
+                    for judge in self.judges if judge.judge is not None and judge.free_slots > 0]
+
+    def _claim(self):
+        claimed = []
+        for judge_pk, name, slots, executors in self._free_judges():
+            with transaction.atomic():
+                rows = list(
+                    SharedQueueEntry.objects.select_for_update(skip_locked=True, of=('self',))
+                    .filter(shard__isnull=True, submission__language__key__in=executors,
+                            submission__problem_id__in=Judge.problems.through.objects.filter(judge_id=judge_pk)
+                            .values('problem_id'))
+                    .filter(Q(judge_name__isnull=True) | Q(judge_name=name))
+                    .order_by('priority', 'queued_at')
+                    .values_list('submission_id', 'priority', 'judge_name')[:slots],
+                )
+                if rows:
+                    SharedQueueEntry.objects.filter(submission_id__in=[row[0] for row in rows]) \
+                        .update(shard=self.shard)
+            claimed += rows
+        if not claimed:
+            return
+
+        self.claimed += len(claimed)
+        tags = {id: (priority, judge_name) for id, priority, judge_name in claimed}
+        submissions = annotate_submission_meta(Submission.objects.filter(id__in=list(tags))).values(
+            'id', 'problem__shortname', 'language__key', 'source__source', *SUBMISSION_META_FIELDS,
+        )
+        for row in submissions:
+            priority, judge_name = tags[row['id']]
+            self.judges.judge(row['id'], row['problem__shortname'], row['language__key'], row['source__source'],
+                              judge_name, priority, submission_meta(row))
+
+    def _release_stranded(self):
+        # Claimed submissions that no judge of this shard can grade any more, e.g. after their judge disconnected.
+        with self.judges.lock:
+            stranded = [
+                id for id, entry in self.judges.node_map.items()
+                if not any(judge.can_judge(entry.problem, entry.language, entry.judge_id) for judge in self.judges)
+            ]
+            self.judges.release(stranded)
+        if stranded:
+            logger.info('Giving %d submission(s) back to the shared queue', len(stranded))
+            self.release(stranded)
+
+    def _delete_finished(self):
+        with self.lock:
+            finished, self._finished = self._finished, []
+        if finished:
+            SharedQueueEntry.objects.filter(submission_id__in=finished).delete()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                with pooled_connection():
+                    self._delete_finished()
+                    self._release_stranded()
+                    self._claim()
+            except Exception:
+                self.errors += 1
+                logger.exception('Error in shared queue of shard %d', self.shard)
+
+    def start(self, judges):
+        self.judges = judges
+        self._thread = threading.Thread(target=self._run, name='shared-queue', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._delete_finished()
+
+    def _forward(self, shard, packet, reply=True):
+        pool = self._peer_pools.get(shard)
+        if pool is None:
+            pool = self._peer_pools[shard] = BridgeConnectionPool(self.peers[shard], 1, self.timeout)
+        self.forwarded += 1
+        return pool.request(dict(packet, **{'shard-forwarded': True}), reply)
+
+    def abort(self, id):
+        """
+        Aborts a submission that this shard's JudgeList does not hold.
+
+        :return: Whether a judge was asked to abort it.
+        """
+        if SharedQueueEntry.objects.filter(submission_id=id, shard__isnull=True).delete()[0]:
+            # No shard had taken it yet.
+            return False
+        shard = SharedQueueEntry.objects.filter(submission_id=id).values_list('shard', flat=True).first()
+        if shard is None or shard == self.shard or shard not in self.peers:
+            return False
+        try:
+            reply = self._forward(shard, {'name': 'terminate-submission', 'submission-id': id})
+        except (BridgeUnavailable, BridgeTimeout):
+            logger.exception('Failed to forward abort of %d to shard %d', id, shard)
+            return False
+        return bool(reply and reply.get('judge-aborted'))
+
+    def disconnect(self, judge_id, force=False):
+        # Judges only connect to one shard, but which one isn't recorded, so ask all of them.
+        for shard in self.peers:
+            try:
+                self._forward(shard, {'name': 'disconnect-judge', 'judge-id': judge_id, 'force': force}, reply=False)
+            except BridgeUnavailable:
+                logger.exception('Failed to forward disconnect of %s to shard %d', judge_id, shard)
+
+    def stats(self):
+        return {
+            'shard': self.shard,
+            'claimed': self.claimed,
+            'released': self.released,
+            'forwarded': self.forwarded,
+            'pending_deletes': len(self._finished),
+            'errors': self.errors,
+        }
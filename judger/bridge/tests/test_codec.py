@@ -0,0 +1,31 @@
+import unittest
+
+from judger.bridge.codec import CODECS, JSON, JsonCodec, negotiate
+
+
+class CodecTestCase(unittest.TestCase):
+    def test_default_is_stdlib_json(self):
+        self.assertIs(JSON, JsonCodec)
+
+    def test_lenient_packets(self):
+        # What older judges may send, e.g. in odd program output
+        for payload in ('{"output":NaN}', '{"output":Infinity}', '{"output":"\\ud800"}'):
+            with self.subTest(payload=payload):
+                self.assertIn('output', JSON.loads(payload))
+
+    def test_round_trip(self):
+        packet = {'name': 'test-case-status', 'cases': [{'position': 1, 'output': 'café'}], 'time': 0.5}
+        for codec in set(CODECS.values()) | {JSON}:
+            with self.subTest(codec=codec.__name__):
+                data = codec.dumps(packet)
+                self.assertEqual(codec.loads(data.decode('utf-8') if codec.text else data), packet)
+
+    def test_negotiate(self):
+        self.assertIsNone(negotiate(None, ['msgpack', 'json']))
+        self.assertIsNone(negotiate([], ['msgpack', 'json']))
+        self.assertIs(negotiate(['json'], ['msgpack', 'json']), CODECS['json'])
+        self.assertIs(negotiate(['unknown'], ['msgpack', 'json']), CODECS['json'])
+
+
+if __name__ == '__main__':
+    unittest.main()
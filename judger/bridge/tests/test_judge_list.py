@@ -0,0 +1,453 @@
+import unittest
+from unittest import mock
+
+from judger.bridge.judge_list import JudgeList
+from judger.judge_priority import BATCH_REJUDGE_PRIORITY, DEFAULT_PRIORITY, REJUDGE_PRIORITY
+
+
+class FakeJudge(object):
+    """
+    Stands in for a JudgeHandler: records what JudgeList hands it instead of talking to a judge.
+    """
+
+    def __init__(self, judges, name, problems=('aplusb',), executors=('PY3',), slots=1):
+        self.judges = judges
+        self.name = name
+        self.problems = set(problems)
+        self.executors = set(executors)
+        self.slots = slots
+        self.load = 0
+        self.current = set()
+        self.submitted = []
+        self.aborted = []
+        self.disconnected = None
+
+    def __repr__(self):
+        return '<FakeJudge %s>' % self.name
+
+    @property
+    def free_slots(self):
+        return self.slots - len(self.current)
+
+    @property
+    def occupancy(self):
+        return len(self.current) / self.slots
+
+    def can_judge(self, problem, executor, judge_id=None):
+        return problem in self.problems and executor in self.executors and (not judge_id or self.name == judge_id)
+
+    def submit(self, id, problem, language, source, meta=None):
+        self.current.add(id)
+        self.submitted.append(id)
+
+    def abort(self, submission):
+        self.aborted.append(submission)
+
+    def disconnect(self, force=False):
+        # A handler only closes its socket; its own thread removes it from the list afterwards.
+        self.disconnected = force
+
+    def close(self):
+        self.judges.remove(self)
+
+    def get_current_submissions(self):
+        return list(self.current)
+
+    def release(self, submission):
+        self.current.discard(submission)
+
+    def finish(self, submission):
+        self.judges.on_judge_free(self, submission)
+
+
+class JudgeListTestCase(unittest.TestCase):
+    def setUp(self):
+        self.journal = mock.Mock()
+        self.judges = JudgeList(journal=self.journal)
+
+    def add_judge(self, name='judge', **kwargs):
+        judge = FakeJudge(self.judges, name, **kwargs)
+        self.judges.register(judge)
+        return judge
+
+    def queue(self, id, problem='aplusb', language='PY3', priority=DEFAULT_PRIORITY, judge_id=None, **meta):
+        meta.setdefault('user', id)
+        self.judges.judge(id, problem, language, '', judge_id, priority, meta)
+
+
+class DispatchTestCase(JudgeListTestCase):
+    def test_free_judge(self):
+        judge = self.add_judge()
+        self.queue(1)
+        self.assertEqual(judge.submitted, [1])
+        self.assertIs(self.judges.submission_map[1], judge)
+
+    def test_queued_until_registered(self):
+        self.queue(1)
+        self.assertIn(1, self.judges.node_map)
+        judge = self.add_judge()
+        self.assertEqual(judge.submitted, [1])
+        self.assertFalse(self.judges.node_map)
+
+    def test_priorities(self):
+        judge = self.add_judge()
+        self.queue(1)
+        self.queue(2, priority=BATCH_REJUDGE_PRIORITY)
+        self.queue(3, priority=REJUDGE_PRIORITY)
+        self.queue(4, priority=DEFAULT_PRIORITY)
+        self.queue(5, priority=0)
+        for id in (1, 5, 4, 3):
+            judge.finish(id)
+        self.assertEqual(judge.submitted, [1, 5, 4, 3, 2])
+
+    def test_problem_and_executor(self):
+        judge = self.add_judge(problems=('aplusb', 'hello'), executors=('PY3',))
+        self.queue(1)
+        self.queue(2, problem='other')
+        self.queue(3, language='CPP17')
+        self.queue(4, problem='hello')
+        judge.finish(1)
+        self.assertEqual(judge.submitted, [1, 4])
+        self.assertEqual(set(self.judges.node_map), {2, 3})
+
+    def test_specified_judge(self):
+        first = self.add_judge('first')
+        second = self.add_judge('second')
+        self.queue(1, judge_id='second')
+        self.assertEqual((first.submitted, second.submitted), ([], [1]))
+        self.queue(2, judge_id='second')
+        self.queue(3, judge_id='first')
+        self.assertEqual(first.submitted, [3])
+        second.finish(1)
+        self.assertEqual(second.submitted, [1, 2])
+
+    def test_duplicate(self):
+        judge = self.add_judge()
+        self.queue(1)
+        self.queue(2)
+        self.queue(1)
+        self.queue(2)
+        judge.finish(1)
+        judge.finish(2)
+        self.assertEqual(judge.submitted, [1, 2])
+
+    def test_reserve_slot(self):
+        # With more than one judge, the last free slot is kept for non-rejudge submissions.
+        busy = self.add_judge('busy')
+        free = self.add_judge('free')
+        self.queue(1)
+        self.queue(2, priority=REJUDGE_PRIORITY)
+        self.queue(3, priority=BATCH_REJUDGE_PRIORITY)
+        self.assertEqual(busy.submitted + free.submitted, [1])
+        self.queue(4)
+        self.assertEqual(sorted(busy.submitted + free.submitted), [1, 4])
+
+        judge = self.judges.submission_map[1]
+        judge.finish(1)
+        self.assertEqual(judge.submitted[-1], 4 if judge.submitted == [4] else 1)
+        self.assertEqual(set(self.judges.node_map), {2, 3})
+
+        # A lone judge takes rejudges too.
+        other = self.judges.submission_map[4]
+        judge.close()
+        other.finish(4)
+        self.assertEqual(other.submitted[-1], 2)
+
+    def test_abort_queued(self):
+        judge = self.add_judge()
+        self.queue(1)
+        self.queue(2)
+        self.assertFalse(self.judges.abort(2))
+        self.journal.finished.assert_called_once_with(2)
+        judge.finish(1)
+        self.assertEqual(judge.submitted, [1])
+        self.assertFalse(self.judges.node_map)
+        self.assertEqual([len(bucket) for bucket in self.judges.queues], [0] * self.judges.priorities)
+
+    def test_abort_in_flight(self):
+        judge = self.add_judge()
+        self.queue(1)
+        self.assertTrue(self.judges.abort(1))
+        self.assertEqual(judge.aborted, [1])
+
+    def test_abort_unknown(self):
+        self.assertFalse(self.judges.abort(1))
+        self.journal.finished.assert_not_called()
+
+    def test_disconnect_while_queued(self):
+        judge = self.add_judge()
+        self.queue(1)
+        self.queue(2)
+        self.judges.disconnect('judge')
+        self.assertIs(judge.disconnected, False)
+        judge.close()
+        self.assertNotIn(judge, self.judges.judges)
+        self.assertNotIn(1, self.judges.submission_map)
+        self.journal.finished.assert_called_once_with(1)
+        # The queued submission waits for the next judge.
+        self.assertIn(2, self.judges.node_map)
+
+        replacement = self.add_judge('replacement')
+        self.assertEqual(replacement.submitted, [2])
+
+    def test_requeue(self):
+        stuck = self.add_judge('stuck')
+        self.queue(1)
+        self.assertTrue(self.judges.requeue(stuck, 1))
+        self.assertIn(1, self.judges.node_map)
+        self.assertFalse(self.judges.requeue(stuck, 1))
+        other = self.add_judge('other')
+        self.assertEqual(other.submitted, [1])
+
+    def test_failed_submit(self):
+        broken = self.add_judge('broken')
+        broken.submit = mock.Mock(side_effect=OSError)
+        self.queue(1)
+        self.assertNotIn(broken, self.judges.judges)
+        self.assertIn(1, self.judges.node_map)
+        self.assertEqual(self.judges.dispatch_failures, 1)
+
+
+class FairShareTestCase(JudgeListTestCase):
+    def dispatch_all(self, judge):
+        while judge.current:
+            judge.finish(judge.submitted[-1])
+        return judge.submitted
+
+    def test_users(self):
+        judge = self.add_judge()
+        self.queue(0, user='busy')
+        for id in range(1, 5):
+            self.queue(id, user='spam')
+        self.queue(5, user='other')
+        # One user spamming submissions only delays their own.
+        self.assertEqual(self.dispatch_all(judge), [0, 1, 5, 2, 3, 4])
+
+    def test_contest_users(self):
+        judge = self.add_judge()
+        self.queue(0, user='busy')
+        for id in range(1, 4):
+            self.queue(id, user='spam', contest=1)
+        self.queue(4, user='other', contest=1)
+        self.assertEqual(self.dispatch_all(judge), [0, 1, 4, 2, 3])
+
+    def test_contest_weight(self):
+        judge = self.add_judge()
+        self.queue(0, user='busy')
+        for id in range(1, 4):
+            self.queue(id, user='practice')
+        for id in range(4, 12):
+            self.queue(id, user=id, contest=1)
+        # Each contest user's own flow is fresh, and the contest as a whole outweighs a practice user 16 to 1.
+        order = self.dispatch_all(judge)
+        self.assertEqual(order[:3], [0, 1, 4])
+        self.assertEqual(order.index(2), 1 + 1 + 8)
+
+    def test_weights(self):
+        self.judges = JudgeList(weights={'contest': 1, 'contest-user': 1})
+        judge = self.add_judge()
+        self.queue(0, user='busy')
+        self.queue(1, user='a', contest=1)
+        self.queue(2, user='b', contest=1)
+        self.queue(3, user='practice')
+        self.assertEqual(self.dispatch_all(judge), [0, 1, 3, 2])
+
+    def test_virtual_time(self):
+        # A user who waited in line doesn't get credit for the time they were idle afterwards.
+        judge = self.add_judge()
+        self.queue(0, user='a')
+        self.queue(1, user='b')
+        judge.finish(0)
+        judge.finish(1)
+        self.queue(2, user='b')
+        for id in range(3, 6):
+            self.queue(id, user='a')
+        self.assertEqual(self.dispatch_all(judge), [0, 1, 2, 3, 4, 5])
+
+    def test_many_flows(self):
+        with mock.patch('judger.bridge.judge_list.FLOW_CLEANUP_SIZE', 8):
+            self.judges = JudgeList()
+            for id in range(1, 100):
+                self.queue(id)
+            # Every flow is still ahead of the virtual time, so cleanups stop once they can't keep up.
+            self.assertEqual(len(self.judges._flow_finish[DEFAULT_PRIORITY]), 99)
+            self.assertGreaterEqual(self.judges._flow_limit[DEFAULT_PRIORITY], 99)
+
+
+class AgingTestCase(JudgeListTestCase):
+    def setUp(self):
+        super().setUp()
+        self.now = 1000.0
+        patcher = mock.patch('judger.bridge.judge_list.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_queue(self, aging_interval):
+        self.judges = JudgeList(aging_interval=aging_interval)
+        judge = self.add_judge()
+        self.queue(0)
+        self.queue(1, priority=BATCH_REJUDGE_PRIORITY)
+        self.now += 5
+        self.queue(2, priority=REJUDGE_PRIORITY)
+        self.queue(3, priority=REJUDGE_PRIORITY)
+        self.now += 6
+        judge.finish(0)
+        return judge
+
+    def test_promotion(self):
+        judge = self.run_queue(aging_interval=10)
+        # The batch rejudge moved up to a rejudge, ahead of those queued after it.
+        self.assertEqual(judge.submitted, [0, 1])
+        self.now += 10
+        self.queue(4)
+        self.queue(5, priority=REJUDGE_PRIORITY)
+        judge.finish(1)
+        # Both rejudges waited long enough to be promoted to default, in their original order.
+        self.assertEqual(judge.submitted, [0, 1, 2])
+        judge.finish(2)
+        judge.finish(3)
+        self.assertEqual(judge.submitted, [0, 1, 2, 3, 4])
+
+    def test_disabled(self):
+        judge = self.run_queue(aging_interval=None)
+        self.assertEqual(judge.submitted, [0, 2])
+        self.assertEqual([len(arrivals) for arrivals in self.judges._arrivals], [0] * self.judges.priorities)
+
+    def test_arrivals_pruned(self):
+        self.judges = JudgeList(aging_interval=10)
+        judge = self.add_judge()
+        for id in range(3):
+            self.queue(id)
+        self.queue(3, priority=REJUDGE_PRIORITY)
+        self.queue(4, priority=BATCH_REJUDGE_PRIORITY)
+        self.judges.abort(4)
+        # Only priorities that age keep arrivals, and only for entries still queued.
+        self.assertEqual([list(arrivals) for arrivals in self.judges._arrivals], [[], [], [3], []])
+        for id in range(3):
+            judge.finish(id)
+        self.assertEqual(judge.submitted, [0, 1, 2, 3])
+        self.assertEqual([len(arrivals) for arrivals in self.judges._arrivals], [0] * self.judges.priorities)
+
+
+class MultiSlotTestCase(JudgeListTestCase):
+    def test_fills_free_slots(self):
+        for id in range(4):
+            self.queue(id)
+        judge = self.add_judge(slots=3)
+        self.assertEqual(judge.submitted, [0, 1, 2])
+        self.assertNotIn(judge, self.judges.idle)
+        self.assertEqual(set(self.judges.node_map), {3})
+
+        judge.finish(1)
+        self.assertEqual(judge.submitted, [0, 1, 2, 3])
+        judge.finish(0)
+        self.assertIn(judge, self.judges.idle)
+        self.assertEqual(self.judges.stats()['judges'], {'connected': 1, 'slots': 3, 'free_slots': 1})
+
+    def test_new_submissions(self):
+        judge = self.add_judge(slots=2)
+        self.queue(0)
+        self.assertIn(judge, self.judges.idle)
+        self.queue(1)
+        self.assertNotIn(judge, self.judges.idle)
+        self.queue(2)
+        self.assertEqual(judge.submitted, [0, 1])
+
+    def test_least_busy(self):
+        self.judges = JudgeList(locality_size=0)
+        big = self.add_judge('big', slots=4)
+        small = self.add_judge('small', slots=1)
+        # Ties are broken at random, so the small judge starts out a little busier.
+        small.load = 0.1
+        for id in range(3):
+            self.queue(id)
+        # Submissions go to the judge with the lowest occupancy, so the small one only gets one.
+        self.assertEqual(len(big.submitted), 2)
+        self.assertEqual(len(small.submitted), 1)
+
+    def test_reserve_counts_slots(self):
+        first = self.add_judge('first', slots=2)
+        second = self.add_judge('second', slots=2)
+        for id in range(2):
+            self.queue(id)
+        self.queue(2, priority=REJUDGE_PRIORITY)
+        self.queue(3, priority=REJUDGE_PRIORITY)
+        # Two slots were free when the first rejudge came, only the reserved one for the second.
+        self.assertEqual(sorted(first.submitted + second.submitted), [0, 1, 2])
+
+    def test_disconnect_with_several(self):
+        judge = self.add_judge(slots=3)
+        for id in range(4):
+            self.queue(id)
+        judge.close()
+        self.assertEqual(sorted(call.args[0] for call in self.journal.finished.call_args_list), [0, 1, 2])
+        self.assertFalse(self.judges.submission_map)
+        self.assertFalse(self.judges.in_flight)
+        self.assertEqual(set(self.judges.node_map), {3})
+
+    def test_abort_one_of_several(self):
+        judge = self.add_judge(slots=2)
+        self.queue(0)
+        self.queue(1)
+        self.assertTrue(self.judges.abort(1))
+        self.assertEqual(judge.aborted, [1])
+        judge.finish(1)
+        self.queue(2)
+        self.assertEqual(judge.submitted, [0, 1, 2])
+
+
+class LocalityTestCase(JudgeListTestCase):
+    def warm_up(self, slots=2):
+        warm = self.add_judge('warm', problems=('aplusb', 'hello'), slots=slots)
+        self.queue(0, problem='hello')
+        warm.finish(0)
+        cold = self.add_judge('cold', problems=('aplusb', 'hello'), slots=slots)
+        return warm, cold
+
+    def test_prefers_warm_judge(self):
+        warm, cold = self.warm_up(slots=4)
+        self.queue(1, problem='hello')
+        self.assertEqual(warm.submitted, [0, 1])
+        self.assertEqual(self.judges.locality_hits, 1)
+
+        # Within the tolerance, the warm judge is preferred even if it is busier: 1/4 + 0.4/4 <= 0.5.
+        warm.load = 0.4
+        self.queue(2, problem='hello')
+        self.assertEqual(warm.submitted, [0, 1, 2])
+        self.assertEqual(cold.submitted, [])
+
+    def test_busy_warm_judge(self):
+        warm, cold = self.warm_up()
+        self.queue(1, problem='hello')
+        # The warm judge is now busier than the cold one by more than the tolerance: 1/2 + 1/2 > 0.5.
+        warm.load = 1
+        self.queue(2, problem='hello')
+        self.assertEqual(warm.submitted, [0, 1])
+        self.assertEqual(cold.submitted, [2])
+        self.assertEqual(self.judges.locality_misses, 2)
+
+    def test_other_problem(self):
+        warm, cold = self.warm_up()
+        cold.load = 0.1
+        self.queue(1, problem='aplusb')
+        # Nobody has it warm, so the least busy judge takes it.
+        self.assertEqual(warm.submitted, [0, 1])
+
+    def test_recent_problems_bounded(self):
+        self.judges = JudgeList(locality_size=2)
+        judge = self.add_judge(problems=('a', 'b', 'c'))
+        for id, problem in enumerate('abca'):
+            self.queue(id, problem=problem)
+            judge.finish(id)
+        self.assertEqual(list(self.judges._recent_problems[judge]), ['c', 'a'])
+        self.assertEqual((self.judges.locality_hits, self.judges.locality_misses), (0, 4))
+
+    def test_disabled(self):
+        self.judges = JudgeList(locality_size=0)
+        judge = self.add_judge()
+        self.queue(0)
+        self.assertNotIn(judge, self.judges._recent_problems)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('judge.bridge')
+
+
+class _Timer(object):
+    __slots__ = ('key', 'slot', 'rounds', 'callback')
+
+    def __init__(self, key, slot, rounds, callback):
+        self.key = key
+        self.slot = slot
+        self.rounds = rounds
+        self.callback = callback
+
+
+class Watchdog(object):
+    """
+    A hashed timer wheel driven by a single thread, shared by every judge connection.
+
+    Each timer has a key, usually (handler, kind); scheduling a key again replaces its timer,
+    and both scheduling and cancelling are O(1). Deadlines are rounded up to the next `tick`.
+    Expired callbacks run on a pool of `workers` threads, so one that blocks on the database or
+    on a stuck judge's socket doesn't hold up the deadlines of every other judge.
+    """
+
+    def __init__(self, tick=0.5, slots=512, workers=4):
+        self.tick = tick
+        self.workers = workers
+        self._executor = None
+        self._slots = [{} for _ in range(slots)]
+        self._timers = {}
+        self._position = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def schedule(self, key, delay, callback):
+        ticks = max(1, int(-(-delay // self.tick)))
+        with self._lock:
+            self._cancel(key)
+            slot = (self._position + ticks) % len(self._slots)
+            timer = _Timer(key, slot, (ticks - 1) // len(self._slots), callback)
+            self._slots[slot][key] = timer
+            self._timers[key] = timer
+            if self._thread is None:
+                self._start()
+
+    def _cancel(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            del self._slots[timer.slot][key]
+
+    def cancel(self, key):
+        with self._lock:
+            self._cancel(key)
+
+    def cancel_all(self, owner):
+        """
+        Cancels every timer whose key is a tuple starting with `owner`.
+        """
+        with self._lock:
+            for key in [key for key in self._timers if isinstance(key, tuple) and key[0] is owner]:
+                self._cancel(key)
+
+    def pending(self, key):
+        return key in self._timers
+
+    def __len__(self):
+        return len(self._timers)
+
+    def _advance(self):
+        expired = []
+        with self._lock:
+            self._position = (self._position + 1) % len(self._slots)
+            slot = self._slots[self._position]
+            for key, timer in list(slot.items()):
+                if timer.rounds:
+                    timer.rounds -= 1
+                else:
+                    del slot[key]
+                    del self._timers[key]
+                    expired.append(timer)
+
+        for timer in expired:
+            self._executor.submit(self._expire, timer)
+
+    def _expire(self, timer):
+        try:
+            timer.callback()
+        except Exception:
+            logger.exception('Error in watchdog callback for %r', timer.key)
+
+    def _run(self):
+        next_tick = time.monotonic() + self.tick
+        while not self._stop.wait(max(0, next_tick - time.monotonic())):
+            self._advance()
+            next_tick += self.tick
+
+    def _start(self):
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='bridge-watchdog-callback')
+        self._thread = threading.Thread(target=self._run, name='bridge-watchdog', daemon=True)
+        self._thread.start()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._executor.shutdown()
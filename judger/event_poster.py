@@ -1,6 +1,9 @@
+import atexit
+import os
+
 from django.conf import settings
 
-__all__ = ['last', 'post']
+__all__ = ['last', 'post', 'flush', 'stats']
 
 if not settings.EVENT_DAEMON_USE:
     real = False
@@ -10,9 +13,34 @@ if not settings.EVENT_DAEMON_USE:
 
     def last():
         return 0
-elif hasattr(settings, 'EVENT_DAEMON_AMQP'):
-    from .event_poster_amqp import last, post
-    real = True
+
+    def flush(timeout=None):
+        return True
+
+    def stats():
+        return {}
 else:
-    from .event_poster_ws import last, post
+    if hasattr(settings, 'EVENT_DAEMON_AMQP'):
+        from .event_poster_amqp import EventPoster, last
+    else:
+        from .event_poster_ws import EventPoster, last
+    from .event_poster_queue import EventQueue
     real = True
+
+    _queue = EventQueue(EventPoster, settings.EVENT_DAEMON_QUEUE_SIZE, settings.EVENT_DAEMON_BATCH_SIZE)
+    os.register_at_fork(after_in_child=_queue.reset)
+    # Give short-lived processes (management commands, scripts) a chance to deliver what they posted.
+    atexit.register(_queue.flush, 5)
+
+    def post(channel, message):
+        """
+        Queues an event for posting and returns immediately. The event id is not known yet, so this returns 0.
+        """
+        _queue.put(channel, message)
+        return 0
+
+    def flush(timeout=None):
+        return _queue.flush(timeout)
+
+    def stats():
+        return _queue.stats()
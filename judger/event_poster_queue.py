@@ -0,0 +1,144 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from itertools import count
+
+from judger.bridge.metrics import Histogram
+
+__all__ = ['EventQueue']
+
+logger = logging.getLogger('judge.event_poster')
+
+# Message types that are superseded by a later message of the same type on the same channel,
+# mapped to the message field that must also match (None if the channel and type are enough).
+COALESCED_TYPES = {
+    'test-case': None,
+    'update-submission': 'id',
+    'update': None,
+}
+
+
+class EventQueue(object):
+    """
+    Posts events from a background thread so callers never wait on the event daemon.
+
+    Messages are queued up to `max_size`; past that, new messages are dropped and counted.
+    A queued message is replaced in place by a newer one with the same coalescing key, so
+    a burst of test-case updates for one submission costs one post. The thread hands the
+    backend up to `batch_size` messages at a time through `post_many`.
+    """
+
+    def __init__(self, poster_factory, max_size=10000, batch_size=100, retry_delay=1):
+        self.poster_factory = poster_factory
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self._poster = None
+        self._pending = OrderedDict()
+        self._unique = count()
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+        self._busy = False
+        self._thread = None
+
+        self.posted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.errors = 0
+        # Time the backend takes to post one batch.
+        self.post_latency = Histogram()
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    @staticmethod
+    def _key(channel, message):
+        type = message.get('type') if isinstance(message, dict) else None
+        if type in COALESCED_TYPES:
+            field = COALESCED_TYPES[type]
+            return channel, type, message.get(field) if field else None
+        return None
+
+    def put(self, channel, message):
+        key = self._key(channel, message)
+        with self._lock:
+            if key is not None and key in self._pending:
+                self._pending[key] = (channel, message)
+                self.coalesced += 1
+                return
+            if len(self._pending) >= self.max_size:
+                self.dropped += 1
+                return
+            self._pending[key if key is not None else next(self._unique)] = (channel, message)
+            if self._thread is None:
+                self._start()
+            self._ready.notify()
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name='event-poster', daemon=True)
+        self._thread.start()
+
+    def _take(self):
+        with self._lock:
+            while not self._pending:
+                self._busy = False
+                self._idle.notify_all()
+                self._ready.wait()
+            self._busy = True
+            batch = []
+            while self._pending and len(batch) < self.batch_size:
+                batch.append(self._pending.popitem(last=False)[1])
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            try:
+                if self._poster is None:
+                    self._poster = self.poster_factory()
+                start = time.perf_counter()
+                self._poster.post_many(batch)
+                self.post_latency.observe(time.perf_counter() - start)
+            except Exception:
+                # The batch may or may not have reached the daemon; events are best-effort, so don't resend.
+                self.errors += 1
+                self.dropped += len(batch)
+                self._poster = None
+                logger.exception('Failed to post %d event(s)', len(batch))
+                time.sleep(self.retry_delay)
+            else:
+                self.posted += len(batch)
+
+    def flush(self, timeout=None):
+        """
+        Waits until everything queued so far has been handed to the backend.
+
+        :return: Whether the queue drained within `timeout` seconds.
+        """
+        with self._lock:
+            if self._thread is None:
+                return not self._pending
+            return self._idle.wait_for(lambda: not self._pending and not self._busy, timeout)
+
+    def reset(self):
+        # The background thread does not survive a fork, and the connection must not be shared with the parent.
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+        self._pending = OrderedDict()
+        self._busy = False
+        self._thread = None
+        self._poster = None
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'posted': self.posted,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'post_latency': self.post_latency.snapshot(),
+        }
@@ -39,6 +39,18 @@ class EventPoster(object):
             self._connect()
             return self.post(channel, message, tries + 1)
 
+    def post_many(self, events):
+        # Send the whole batch before reading any acknowledgement, so a batch costs one round trip.
+        for channel, message in events:
+            self._conn.send(json.dumps({'command': 'post', 'channel': channel, 'message': message}))
+        ids = []
+        for _ in events:
+            resp = json.loads(self._conn.recv())
+            if resp['status'] == 'error':
+                raise EventPostingError(resp['code'])
+            ids.append(resp['id'])
+        return ids
+
     def last(self, tries=0):
         try:
             self._conn.send('{"command": "last-msg"}')
@@ -5,14 +5,20 @@ import struct
 import zlib
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
 from django.utils import timezone
 
 from judger import event_poster as event
+from judger.bridge.client import BridgeUnavailable, get_pool
 from judger.judge_priority import BATCH_REJUDGE_PRIORITY, CONTEST_SUBMISSION_PRIORITY, DEFAULT_PRIORITY, REJUDGE_PRIORITY
 
 logger = logging.getLogger('judge.judgeapi')
 size_pack = struct.Struct('!I')
 
+ATTEMPT_COUNTER_TIMEOUT = 24 * 60 * 60
+
 
 def _post_update_submission(submission, done=False):
     if submission.problem.is_public:
@@ -23,9 +29,12 @@ def _post_update_submission(submission, done=False):
                                    'status': submission.status, 'language': submission.language.key})
 
 
-def judge_request(packet, reply=True):
-    sock = socket.create_connection(settings.BRIDGED_DJANGO_CONNECT or
-                                    settings.BRIDGED_DJANGO_ADDRESS[0])
+def _bridge_address():
+    return settings.BRIDGED_DJANGO_CONNECT or settings.BRIDGED_DJANGO_ADDRESS[0]
+
+
+def _judge_request_once(packet, reply=True):
+    sock = socket.create_connection(_bridge_address())
 
     output = json.dumps(packet, separators=(',', ':'))
     output = zlib.compress(output.encode('utf-8'))
@@ -50,6 +59,125 @@ def judge_request(packet, reply=True):
         return result
 
 
+def judge_request(packet, reply=True):
+    if settings.BRIDGED_DJANGO_POOL_SIZE:
+        pool = get_pool(_bridge_address(), settings.BRIDGED_DJANGO_POOL_SIZE, settings.BRIDGED_DJANGO_TIMEOUT)
+        try:
+            return pool.request(packet, reply)
+        except BridgeUnavailable:
+            # Nothing was sent, so a one-off connection can't cause the request to be handled twice.
+            logger.warning('Persistent bridge connection unavailable, falling back to a new connection')
+    return _judge_request_once(packet, reply)
+
+
+def _attempt_counter_key(user_id, problem_id):
+    return 'submission-attempts-%d-%d' % (user_id, problem_id)
+
+
+def next_attempt_no(submission):
+    """
+    Returns the attempt number of a freshly created submission, i.e. one plus the number of
+    earlier submissions of the user on the problem that did not end in CE or IE.
+
+    The count is kept per (user, problem) in the cache and incremented, so the database is
+    only counted once per counter lifetime.
+    """
+    from submission.models import Submission
+
+    key = _attempt_counter_key(submission.user_id, submission.problem_id)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        earlier = Submission.objects.filter(user_id=submission.user_id, problem_id=submission.problem_id,
+                                            date__lt=submission.date).exclude(status__in=('CE', 'IE')).count()
+        cache.add(key, earlier, ATTEMPT_COUNTER_TIMEOUT)
+        return cache.incr(key)
+
+
+def _forgotten_attempt_key(submission_id):
+    return 'submission-attempt-forgotten-%d' % submission_id
+
+
+def forget_attempt(submission_id, user_id, problem_id, rejudged_date=None):
+    """
+    Called once a submission ends in CE or IE, which do not count as attempts.
+
+    Only the first grading of a submission took an attempt number, so rejudges are ignored, and
+    so is a submission ending in CE or IE again after it was already forgotten.
+    """
+    if rejudged_date is not None:
+        return
+    if not cache.add(_forgotten_attempt_key(submission_id), 1, ATTEMPT_COUNTER_TIMEOUT):
+        return
+    try:
+        cache.decr(_attempt_counter_key(user_id, problem_id))
+    except ValueError:
+        pass
+
+
+SUBMISSION_META_FIELDS = ('problem__time_limit', 'problem__memory_limit', 'language_time_limit',
+                          'language_memory_limit', 'problem__short_circuit', 'is_pretested', 'user_id', 'problem_id',
+                          'problem__points', 'problem__partial', 'contest_object_id', 'earlier_attempts')
+
+
+def annotate_submission_meta(queryset, count_attempts=True):
+    from problem.models import LanguageLimit
+    from submission.models import Submission
+
+    limits = LanguageLimit.objects.filter(problem_id=OuterRef('problem_id'), language_id=OuterRef('language_id'))
+    queryset = queryset.annotate(
+        language_time_limit=Subquery(limits.values('time_limit')[:1]),
+        language_memory_limit=Subquery(limits.values('memory_limit')[:1]),
+    )
+    if count_attempts:
+        queryset = queryset.annotate(earlier_attempts=Subquery(
+            Submission.objects.filter(user_id=OuterRef('user_id'), problem_id=OuterRef('problem_id'),
+                                      date__lt=OuterRef('date'))
+            .exclude(status__in=('CE', 'IE')).order_by()
+            .values('user_id').annotate(count=Count('id')).values('count'),
+        ))
+    return queryset
+
+
+def submission_meta(data, attempt_no=None):
+    if attempt_no is None:
+        attempt_no = (data['earlier_attempts'] or 0) + 1
+
+    return {
+        'time-limit': data['problem__time_limit'] if data['language_time_limit'] is None
+        else data['language_time_limit'],
+        'memory-limit': data['problem__memory_limit'] if data['language_memory_limit'] is None
+        else data['language_memory_limit'],
+        'short-circuit': data['problem__short_circuit'],
+        'pretests-only': data['is_pretested'],
+        'in-contest': None,
+        'attempt-no': attempt_no,
+        'user': data['user_id'],
+        'problem': data['problem_id'],
+        'problem-points': data['problem__points'],
+        'partial': data['problem__partial'],
+        'contest': data['contest_object_id'],
+    }
+
+
+def get_submission_meta(submission_id, attempt_no=None):
+    """
+    Fetches everything the bridge needs to dispatch a submission in a single query.
+    The attempt number is counted in the same query unless given.
+
+    :return: A dictionary to be sent as the `meta` of a submission-request, or None if the submission is gone.
+    """
+    from submission.models import Submission
+
+    count_attempts = attempt_no is None
+    queryset = annotate_submission_meta(Submission.objects.filter(id=submission_id), count_attempts)
+    try:
+        data = queryset.values(*(SUBMISSION_META_FIELDS if count_attempts else SUBMISSION_META_FIELDS[:-1])).get()
+    except Submission.DoesNotExist:
+        return None
+    return submission_meta(data, attempt_no)
+
+
 def judge_submission(submission, rejudge=False, batch_rejudge=False, judge_id=None):
     # from .models import ContestSubmission, 
     from submission.models import Submission, SubmissionTestCase
@@ -81,6 +209,10 @@ def judge_submission(submission, rejudge=False, batch_rejudge=False, judge_id=No
     SubmissionTestCase.objects.filter(submission_id=submission.id).delete()
 
     try:
+        meta = get_submission_meta(
+            submission.id,
+            attempt_no=None if rejudge or batch_rejudge else next_attempt_no(submission),
+        )
         response = judge_request({
             'name': 'submission-request',
             'submission-id': submission.id,
@@ -89,6 +221,7 @@ def judge_submission(submission, rejudge=False, batch_rejudge=False, judge_id=No
             'source': submission.source.source,
             'judge-id': judge_id,
             'priority': BATCH_REJUDGE_PRIORITY if batch_rejudge else (REJUDGE_PRIORITY if rejudge else priority),
+            'meta': meta,
         })
     except BaseException:
         logger.exception('Failed to send request to judge')
@@ -102,10 +235,78 @@ def judge_submission(submission, rejudge=False, batch_rejudge=False, judge_id=No
     return success
 
 
+def judge_submissions(submission_ids, rejudge=False, batch_rejudge=False, judge_id=None, force_judge=False):
+    """
+    Bulk counterpart of judge_submission: resets and queues a chunk of submissions with one UPDATE,
+    one DELETE, one query for sources and metadata, and one submission-batch-request to the bridge.
+    Locked submissions are skipped unless `force_judge` is set.
+
+    :return: The number of submissions queued.
+    """
+    from submission.models import Submission, SubmissionTestCase
+
+    now = timezone.now()
+    updates = {'time': None, 'memory': None, 'points': None, 'result': None, 'case_points': 0, 'case_total': 0,
+               'error': None, 'rejudged_date': now if rejudge or batch_rejudge else None, 'status': 'QU'}
+    priority = BATCH_REJUDGE_PRIORITY if batch_rejudge else (REJUDGE_PRIORITY if rejudge else DEFAULT_PRIORITY)
+
+    # Same rule as judge_submission: only submissions that are not being graded can be (re)queued.
+    queryset = Submission.objects.filter(id__in=submission_ids).exclude(status__in=('P', 'G'))
+    if not force_judge:
+        queryset = queryset.exclude(locked_after__lt=now)
+
+    with transaction.atomic():
+        rows = list(
+            annotate_submission_meta(queryset.select_for_update(of=('self',)))
+            .order_by('id')
+            .values('id', 'problem__shortname', 'problem__is_public', 'language__key', 'source__source',
+                    'contest_object__key', *SUBMISSION_META_FIELDS),
+        )
+        if not rows:
+            return 0
+        ids = [row['id'] for row in rows]
+        Submission.objects.filter(id__in=ids).update(**updates)
+        SubmissionTestCase.objects.filter(submission_id__in=ids).delete()
+
+    try:
+        response = judge_request({
+            'name': 'submission-batch-request',
+            'submissions': [{
+                'submission-id': row['id'],
+                'problem-id': row['problem__shortname'],
+                'language': row['language__key'],
+                'source': row['source__source'],
+                'meta': submission_meta(row),
+            } for row in rows],
+            'judge-id': judge_id,
+            'priority': priority,
+        })
+    except BaseException:
+        logger.exception('Failed to send batch request to judge')
+        Submission.objects.filter(id__in=ids).update(status='IE', result='IE')
+        return 0
+
+    if response['name'] != 'submission-batch-received':
+        Submission.objects.filter(id__in=ids).update(status='IE', result='IE')
+        return 0
+
+    for row in rows:
+        if row['problem__is_public']:
+            event.post('submissions', {'type': 'update-submission', 'id': row['id'],
+                                       'contest': row['contest_object__key'],
+                                       'user': row['user_id'], 'problem': row['problem_id'],
+                                       'status': 'QU', 'language': row['language__key']})
+    return len(rows)
+
+
 def disconnect_judge(judge, force=False):
     judge_request({'name': 'disconnect-judge', 'judge-id': judge.name, 'force': force}, reply=False)
 
 
+def get_bridge_metrics():
+    return judge_request({'name': 'get-metrics'})['metrics']
+
+
 def abort_submission(submission):
     from .models import Submission
     # We only want to try to abort a submission if it's still grading, otherwise this can lead to fully graded
@@ -0,0 +1,199 @@
+import random
+import secrets
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from judger.bridge.client import get_pool
+from judger.bridge.daemon import judge_daemon
+from judger.bridge.fake_judge import FakeJudge
+from judger.bridge.metrics import Histogram, registry
+from judger.judgeapi import judge_submission
+from judger.models import Judge, Language
+from problem.models import Problem
+from submission.models import Submission, SubmissionSource
+from userprofile.models import UserProfile
+
+LANGUAGE_KEY = 'LOADT'
+FINISHED_STATUSES = ('D', 'IE', 'CE', 'AB')
+
+
+def _free_port(host):
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def _format(snapshot, scale=1e3):
+    return 'p50 %8.1fms  p90 %8.1fms  p99 %8.1fms  max %8.1fms  (n=%d)' % (
+        snapshot['p50'] * scale, snapshot['p90'] * scale, snapshot['p99'] * scale, snapshot['max'] * scale,
+        snapshot['count'],
+    )
+
+
+class Command(BaseCommand):
+    help = 'load test the judge bridge with fake judges, against a throwaway copy of the configured database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--judges', type=int, default=4, help='number of fake judges')
+        parser.add_argument('--slots', type=int, default=1, help='submissions each fake judge grades at once')
+        parser.add_argument('--submissions', type=int, default=500, help='number of submissions to judge')
+        parser.add_argument('--cases', type=int, default=10, help='test cases per submission')
+        parser.add_argument('--case-latency', type=float, default=0.01, help='seconds each test case takes')
+        parser.add_argument('--problems', type=int, default=8, help='number of problems to spread submissions over')
+        parser.add_argument('--users', type=int, default=50, help='number of users to spread submissions over')
+        parser.add_argument('--clients', type=int, default=4, help='threads sending submissions to the bridge')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='submissions per second to send at, 0 to send them as fast as possible')
+        parser.add_argument('--timeout', type=float, default=600, help='seconds to wait for all submissions')
+        parser.add_argument('--async', action='store_true', dest='use_async', help='run the bridge with --async')
+        parser.add_argument('--keepdb', action='store_true', help='keep the test database between runs')
+
+    def handle(self, *args, **options):
+        # The test database gets the usual "test_" prefix, just like the one `manage.py test` uses.
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=options['verbosity'], autoclobber=True,
+                                           keepdb=options['keepdb'])
+        host = '127.0.0.1'
+        try:
+            with override_settings(
+                BRIDGED_JUDGE_ADDRESS=[(host, _free_port(host))],
+                BRIDGED_DJANGO_ADDRESS=[(host, _free_port(host))],
+                BRIDGED_DJANGO_CONNECT=None,
+                BRIDGED_QUEUE_JOURNAL=None,
+                BRIDGED_METRICS_ADDRESS=None,
+                CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+            ):
+                self.run(options)
+        finally:
+            if connection.vendor == 'postgresql':
+                # Bridge threads may still hold connections, which would keep the database from being dropped.
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT pg_terminate_backend(pid) FROM pg_stat_activity '
+                                   'WHERE datname = current_database() AND pid <> pg_backend_pid()')
+            connection.creation.destroy_test_db(old_name, verbosity=options['verbosity'],
+                                                keepdb=options['keepdb'])
+
+    def create_fixtures(self, options):
+        Language.objects.get_or_create(key=LANGUAGE_KEY, defaults={
+            'name': 'Load test', 'common_name': 'Load test', 'ace': 'text', 'pygments': 'text', 'extension': 'txt',
+        })
+        language = Language.objects.get(key=LANGUAGE_KEY)
+
+        problems = ['LOADTEST_%04d' % i for i in range(options['problems'])]
+        Problem.objects.bulk_create([Problem(shortname=code, title=code) for code in problems],
+                                    ignore_conflicts=True)
+        problem_ids = list(Problem.objects.filter(shortname__in=problems).values_list('id', flat=True))
+
+        User = get_user_model()
+        for i in range(options['users']):
+            # Creating the user creates its profile.
+            User.objects.get_or_create(username='loadtest%d' % i)
+        users = list(UserProfile.objects.filter(user__username__startswith='loadtest').values_list('id', flat=True))
+
+        judges = [('loadtest-judge-%d' % i, secrets.token_hex(16)) for i in range(options['judges'])]
+        Judge.objects.filter(name__startswith='loadtest-judge-').delete()
+        Judge.objects.bulk_create([Judge(name=name, auth_key=key) for name, key in judges])
+
+        submissions = Submission.objects.bulk_create([
+            Submission(user_id=random.choice(users), problem_id=random.choice(problem_ids), language=language)
+            for _ in range(options['submissions'])
+        ])
+        SubmissionSource.objects.bulk_create([
+            SubmissionSource(submission=submission, source='print(%d)' % i)
+            for i, submission in enumerate(submissions)
+        ])
+        return problems, judges, submissions
+
+    def run(self, options):
+        problems, judge_keys, submissions = self.create_fixtures(options)
+
+        stop = threading.Event()
+        bridge = threading.Thread(target=judge_daemon, kwargs={'use_async': options['use_async'], 'stop': stop},
+                                  name='loadtest-bridge')
+        bridge.start()
+
+        judges = [
+            FakeJudge(settings.BRIDGED_JUDGE_ADDRESS[0], name, key, problems, [LANGUAGE_KEY], slots=options['slots'],
+                      cases=options['cases'], case_latency=options['case_latency'])
+            for name, key in judge_keys
+        ]
+        try:
+            for judge in judges:
+                judge.connect()
+            while Judge.objects.filter(name__startswith='loadtest-judge-', online=True).count() < len(judges):
+                time.sleep(0.1)
+            self.stdout.write('Bridge up with %d fake judge(s) of %d slot(s); sending %d submission(s)' % (
+                len(judges), options['slots'], len(submissions)))
+
+            sent = {}
+            interval = 1 / options['rate'] if options['rate'] else 0
+            start = time.monotonic()
+
+            def send(args):
+                index, submission = args
+                if interval:
+                    time.sleep(max(0, start + index * interval - time.monotonic()))
+                sent[submission.id] = time.monotonic()
+                judge_submission(submission)
+
+            with ThreadPoolExecutor(options['clients']) as pool:
+                sending = pool.map(send, enumerate(submissions))
+
+                finished = {}
+                ids = [submission.id for submission in submissions]
+                deadline = time.monotonic() + options['timeout']
+                while len(finished) < len(ids) and time.monotonic() < deadline:
+                    time.sleep(0.02)
+                    now = time.monotonic()
+                    for id in Submission.objects.filter(id__range=(min(ids), max(ids)),
+                                                        status__in=FINISHED_STATUSES) \
+                            .exclude(id__in=list(finished)).values_list('id', flat=True):
+                        finished[id] = now
+                list(sending)
+            elapsed = max(finished.values(), default=start) - start
+        finally:
+            for judge in judges:
+                judge.close()
+            stop.set()
+            bridge.join()
+            get_pool(settings.BRIDGED_DJANGO_ADDRESS[0], settings.BRIDGED_DJANGO_POOL_SIZE,
+                     settings.BRIDGED_DJANGO_TIMEOUT).close()
+
+        self.report(options, submissions, sent, finished, elapsed)
+
+    def report(self, options, submissions, sent, finished, elapsed):
+        latency = Histogram(unit=1e-4)
+        for id, end in finished.items():
+            latency.observe(end - sent[id])
+        metrics = registry.snapshot()
+        failed = Submission.objects.filter(id__in=list(finished)).exclude(status='D').count()
+
+        write = self.stdout.write
+        write('')
+        write('Finished %d of %d submission(s) in %.2fs (%d not done, %d with errors)' % (
+            len(finished), len(submissions), elapsed, len(submissions) - len(finished), failed))
+        write('Throughput: %.1f submissions/s' % (len(finished) / elapsed if elapsed else 0))
+        write('End-to-end:  %s' % _format(latency.snapshot()))
+        write('Queue wait:  %s' % _format(metrics['bridge_queue']['wait_times']['default']))
+        write('Until start: %s' % _format(metrics['bridge_submission_start_seconds']))
+        write('Dispatch:    %s' % _format(metrics['bridge_queue']['dispatch_latency']))
+
+        write('')
+        write('Database use by packet handlers:')
+        queries = metrics.get('bridge_packet_queries', {})
+        db_time = metrics.get('bridge_packet_db_seconds', {})
+        for labels in sorted(queries, key=queries.get, reverse=True):
+            write('  %-48s %8d queries  %8.1f/submission  %8.1fms total' % (
+                labels, queries[labels], queries[labels] / max(1, len(finished)),
+                db_time.get(labels, {}).get('sum', 0) * 1e3))
+        total = sum(queries.values())
+        write('  %-48s %8d queries  %8.1f/submission' % ('total', total, total / max(1, len(finished))))
+        write('Test case rows written behind: %d' % metrics['bridge_test_cases']['flushed_rows'])
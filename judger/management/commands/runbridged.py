@@ -4,5 +4,13 @@ from judger.bridge.daemon import judge_daemon
 
 
 class Command(BaseCommand):
+    help = 'run the judge bridge'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--async', action='store_true', dest='use_async',
+                            help='serve judges and Django on a single event loop instead of a thread per connection')
+        parser.add_argument('--shard', type=int, default=None,
+                            help='run as this entry of BRIDGED_SHARDS, sharing the queue with the other shards')
+
     def handle(self, *args, **options):
-        judge_daemon()
+        judge_daemon(use_async=options['use_async'], shard=options['shard'])
@@ -0,0 +1,31 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('submission', '0002_alter_submissiontestcase_options'),
+        ('judger', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SharedQueueEntry',
+            fields=[
+                ('submission', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to='submission.submission', verbose_name='submission')),
+                ('priority', models.IntegerField(verbose_name='priority')),
+                ('judge_name', models.CharField(blank=True, help_text='Only this judge may grade the submission.', max_length=50, null=True, verbose_name='judge name')),
+                ('shard', models.IntegerField(blank=True, help_text='The shard that claimed the submission, empty while it waits.', null=True, verbose_name='bridge shard')),
+                ('queued_at', models.DateTimeField(auto_now_add=True, verbose_name='queued at')),
+            ],
+            options={
+                'verbose_name': 'shared queue entry',
+                'verbose_name_plural': 'shared queue entries',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='sharedqueueentry',
+            index=models.Index(fields=['shard', 'priority', 'queued_at'], name='judger_shared_queue_claim'),
+        ),
+    ]
@@ -1 +1,2 @@
+from judger.models.queue import SharedQueueEntry
 from judger.models.runtime import Judge, Language, RuntimeVersion
@@ -0,0 +1,32 @@
+from django.db import models
+from django.utils.translation import gettext_lazy as _
+
+__all__ = ['SharedQueueEntry']
+
+
+class SharedQueueEntry(models.Model):
+  """
+    A submission waiting in the queue shared by the shards of a sharded bridge, or claimed from it
+    by the shard whose judges are grading it. Rows are deleted once the submission is done with.
+  """
+  submission = models.OneToOneField(
+    'submission.Submission', verbose_name=_('submission'), on_delete=models.CASCADE,
+    primary_key=True, related_name='+',
+  )
+  priority = models.IntegerField(verbose_name=_('priority'))
+  judge_name = models.CharField(
+    max_length=50, verbose_name=_('judge name'), null=True, blank=True,
+    help_text=_('Only this judge may grade the submission.'),
+  )
+  shard = models.IntegerField(
+    verbose_name=_('bridge shard'), null=True, blank=True,
+    help_text=_('The shard that claimed the submission, empty while it waits.'),
+  )
+  queued_at = models.DateTimeField(verbose_name=_('queued at'), auto_now_add=True)
+
+  class Meta:
+    verbose_name = _('shared queue entry')
+    verbose_name_plural = _('shared queue entries')
+    indexes = [
+      models.Index(fields=['shard', 'priority', 'queued_at'], name='judger_shared_queue_claim'),
+    ]
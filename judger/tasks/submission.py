@@ -9,12 +9,15 @@ from problem.models import Problem
 from userprofile.models import UserProfile as Profile
 from submission.models import Submission
 from judger.utils.celery import Progress
+from judger.utils.iterator import chunk
 
 import logging
 logger = logging.getLogger('judger.tasks')
 
 __all__ = ('apply_submission_filter', 'rejudge_problem_filter', 'rescore_problem')
 
+REJUDGE_CHUNK_SIZE = 100
+
 def apply_submission_filter(queryset, id_range, languages, results):
     if id_range:
         start, end = id_range
@@ -36,12 +39,11 @@ def rejudge_problem_filter(self, problem_id, id_range=None, languages=None, resu
   logger.info("Job: Rejudge job acknowledged.")
 
   rejudged = 0
-  with Progress(self, queryset.count()) as p:
-    for submission in queryset.reverse().iterator(): # Reverse because I want earliest sub to be judged first
-      submission.judge(rejudge=True, batch_rejudge=True, rejudge_user=user.profile)
-      rejudged += 1
-      if rejudged % 10 == 0:
-        p.done = rejudged
+  sub_ids = list(queryset.order_by('id').values_list('id', flat=True)) # Earliest sub should be judged first
+  with Progress(self, len(sub_ids)) as p:
+    for ids in chunk(sub_ids, REJUDGE_CHUNK_SIZE):
+      rejudged += Submission.judge_many(ids, rejudge=True, batch_rejudge=True, rejudge_user=user.profile)
+      p.did(len(ids))
   logger.info("Job: Rejudge job finished.")
   return rejudged
 
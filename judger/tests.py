@@ -1 +1,154 @@
-# Create your tests here.
+import threading
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import DatabaseError, connections
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from judger.bridge.db_pool import ConnectionPool
+from judger.bridge.judge_handler import JudgeHandler
+from judger.judgeapi import _attempt_counter_key, forget_attempt
+from judger.models import Judge
+from problem.models import Problem
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ForgetAttemptTestCase(SimpleTestCase):
+    user_id = 3
+    problem_id = 7
+
+    def setUp(self):
+        cache.clear()
+        cache.set(_attempt_counter_key(self.user_id, self.problem_id), 5)
+
+    def counter(self):
+        return cache.get(_attempt_counter_key(self.user_id, self.problem_id))
+
+    def end_in_compile_error(self, id, rejudged_date=None):
+        # The handler's path for a compile-error or internal-error packet
+        handler = mock.Mock(_get_submission_info=mock.Mock(return_value={
+            'user_id': self.user_id, 'problem_id': self.problem_id, 'rejudged_date': rejudged_date,
+        }))
+        JudgeHandler._forget_attempt(handler, id)
+
+    def test_first_grading(self):
+        self.end_in_compile_error(1)
+        self.assertEqual(self.counter(), 4)
+
+    def test_rejudge_ending_in_compile_error(self):
+        self.end_in_compile_error(1, rejudged_date=timezone.now())
+        self.assertEqual(self.counter(), 5)
+
+    def test_compile_error_after_rejudge_of_compile_error(self):
+        self.end_in_compile_error(1)
+        self.end_in_compile_error(1, rejudged_date=timezone.now())
+        self.assertEqual(self.counter(), 4)
+
+    def test_repeated_result(self):
+        # e.g. an internal error, then a compile error once its judge gave it back and it was graded again
+        forget_attempt(1, self.user_id, self.problem_id)
+        forget_attempt(1, self.user_id, self.problem_id)
+        forget_attempt(2, self.user_id, self.problem_id)
+        self.assertEqual(self.counter(), 3)
+
+    def test_no_counter(self):
+        cache.clear()
+        forget_attempt(1, self.user_id, self.problem_id)
+        self.assertIsNone(self.counter())
+
+
+class SyncRelationTestCase(TestCase):
+    def setUp(self):
+        Problem.objects.bulk_create([Problem(shortname='SYNCTEST_A', title='A')])
+        self.judge = Judge.objects.create(name='synctest', auth_key='key')
+        self.handler = mock.Mock(judge=self.judge, _persisted_relations={}, _persisted_lock=threading.Lock())
+
+    def sync(self, *shortnames):
+        JudgeHandler._sync_relation(self.handler, 'problems', Problem, 'shortname', shortnames)
+
+    def linked(self):
+        return set(self.judge.problems.values_list('shortname', flat=True))
+
+    def test_problem_created_later(self):
+        self.sync('SYNCTEST_A', 'SYNCTEST_B')
+        self.assertEqual(self.linked(), {'SYNCTEST_A'})
+        Problem.objects.bulk_create([Problem(shortname='SYNCTEST_B', title='B')])
+        self.sync('SYNCTEST_A', 'SYNCTEST_B')
+        self.assertEqual(self.linked(), {'SYNCTEST_A', 'SYNCTEST_B'})
+
+    def test_removed(self):
+        self.sync('SYNCTEST_A')
+        self.sync()
+        self.assertEqual(self.linked(), set())
+
+    def test_edited_while_disconnected(self):
+        self.sync('SYNCTEST_A')
+        JudgeHandler._disconnected(self.handler)
+        self.judge.problems.clear()
+        self.sync('SYNCTEST_A')
+        self.assertEqual(self.linked(), {'SYNCTEST_A'})
+
+
+class ConnectionPoolTestCase(SimpleTestCase):
+    databases = {'default'}
+
+    def make_pool(self, **kwargs):
+        pool = ConnectionPool(2, **kwargs)
+        self.addCleanup(pool.close)
+        return pool
+
+    def backend(self, pool):
+        # The DB-API connection a block ran its query on
+        with pool.connection() as connection:
+            self.assertIs(connections['default'], connection)
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return connection.connection
+
+    def watch_close(self, connection):
+        # Whether the pool discards a connection, as some backends (in-memory SQLite) never really close one
+        patcher = mock.patch.object(connection, 'close', wraps=connection.close)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_connection_reused(self):
+        pool = self.make_pool()
+        with pool.connection() as connection:
+            close = self.watch_close(connection)
+        first = self.backend(pool)
+        self.assertIsNotNone(first)
+        # Whatever CONN_MAX_AGE is, the second block gets the same open connection.
+        self.assertIs(self.backend(pool), first)
+        close.assert_not_called()
+        self.assertEqual(pool.stats()['open'], 1)
+
+    def test_closed_after_error(self):
+        pool = self.make_pool()
+        with pool.connection() as connection:
+            close = self.watch_close(connection)
+            with self.assertRaises(DatabaseError):
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT * FROM no_such_table')
+        close.assert_called_once_with()
+        # The same slot is lent again and works.
+        self.assertIsNotNone(self.backend(pool))
+        self.assertEqual(pool.stats()['open'], 1)
+
+    def test_max_age(self):
+        pool = self.make_pool(max_age=0)
+        with pool.connection() as connection:
+            close = self.watch_close(connection)
+            connection.ensure_connection()
+        close.assert_called_once_with()
+        self.assertIsNotNone(self.backend(pool))
+        self.assertEqual(close.call_count, 2)
+
+    def test_nested_blocks(self):
+        pool = self.make_pool()
+        with pool.connection() as outer:
+            with pool.connection() as inner:
+                self.assertIs(inner, outer)
+        self.assertEqual(pool.stats()['open'], 1)
@@ -5,14 +5,17 @@ from django.utils.http import urlencode
 
 
 class Progress:
-    def __init__(self, task, total, stage=None):
+    def __init__(self, task, total, stage=None, task_id=None):
         self.task = task
+        # Reports progress of another task, e.g. one that was replaced by a group of subtasks.
+        self.task_id = task_id
         self._total = total
         self._done = 0
         self._stage = stage
 
     def _update_state(self):
         self.task.update_state(
+            task_id=self.task_id,
             state='PROGRESS',
             meta={
                 'done': self._done,
@@ -10,7 +10,7 @@ from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 
 from userprofile.models import UserProfile
-from judger.judgeapi import abort_submission, judge_submission
+from judger.judgeapi import abort_submission, judge_submission, judge_submissions
 from judger.models.runtime import Language
 from judger.utils.unicode import utf8bytes
 
@@ -174,6 +174,14 @@ class Submission(models.Model):
 
   judge.alters_data = True
 
+  @classmethod
+  def judge_many(cls, ids, *args, rejudge=False, force_judge=False, rejudge_user=None, **kwargs):
+    """
+      Bulk version of judge(), for one chunk of submission ids.
+      Returns the number of submissions queued.
+    """
+    return judge_submissions(ids, *args, rejudge=rejudge, force_judge=force_judge, **kwargs)
+
   def abort(self):
     abort_submission(self)
 
@@ -272,7 +280,11 @@ class Submission(models.Model):
     if not contest_problem.partial and contest.points != contest_problem.points:
       contest.points = 0
     contest.save()
-    contest.participation.recompute_results()
+    if self.rejudged_date is None:
+      contest.participation.apply_submission(contest)
+    else:
+      # A rejudge can change any of the results the participation's scores were built from.
+      contest.participation.recompute_results()
     contest_problem.expensive_recompute_stats()
 
   update_contest.alters_data = True
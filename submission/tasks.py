@@ -8,24 +8,25 @@ from django.utils.translation import gettext as _
 from submission.models import Submission
 
 from judger.utils.celery import Progress
+from judger.utils.iterator import chunk
 
 import logging
 logger = logging.getLogger('judger.tasks')
 
 __all__ = ('recompute_standing')
 
+REJUDGE_CHUNK_SIZE = 100
+
 @shared_task(bind=True)
 def mass_rejudge(self, sub_ids, rejudge_user_id):
-  subs = Submission.objects.filter(id__in=sub_ids)
   user = User.objects.get(id=rejudge_user_id)
   logger.info(f"Job: Mass rejudging {len(sub_ids)} submission(s)..")
 
   rejudged = 0
   with Progress(self, len(sub_ids)) as p:
-    for sub in subs.reverse().iterator(): # Reverse because I want earliest sub to be judged first
-      sub.judge(rejudge=True, batch_rejudge=True, rejudge_user=user.profile)
-      rejudged += 1
-      if rejudged % 10 == 0:
-        p.done = rejudged
+    # Sorted because I want earliest sub to be judged first
+    for ids in chunk(sorted(sub_ids), REJUDGE_CHUNK_SIZE):
+      rejudged += Submission.judge_many(ids, rejudge=True, batch_rejudge=True, rejudge_user=user.profile)
+      p.did(len(ids))
   logger.info("Job: Rejudge job finished.")
   return rejudged
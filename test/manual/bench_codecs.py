@@ -0,0 +1,99 @@
+"""
+Benchmarks bridge packet throughput per codec: packets/sec for encoding, framing and sending a packet,
+then reading and parsing it back, with and without the compression threshold.
+
+Run from the repository root:
+    python test/manual/bench_codecs.py
+"""
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from judger.bridge.base_handler import ZlibPacketHandler  # noqa: E402
+from judger.bridge.codec import CODECS, JsonCodec  # noqa: E402
+
+THRESHOLD = 1024
+DURATION = 1.0
+
+PAYLOADS = {
+    'ping-response': {'name': 'ping-response', 'when': 1700000000.123, 'time': 1700000000.456, 'load': 0.5},
+    'grading-begin': {'name': 'grading-begin', 'submission-id': 123456, 'pretested': False},
+    'test-case (8 cases)': {'name': 'test-case-status', 'submission-id': 123456, 'cases': [
+        {'position': i, 'status': 0, 'time': 0.012, 'points': 1, 'total': 1, 'memory': 2048,
+         'output': '', 'extended-feedback': '', 'feedback': ''} for i in range(8)
+    ]},
+    'submission-request': {'name': 'submission-request', 'submission-id': 123456, 'problem-id': 'aplusb',
+                           'language': 'CPP17', 'source': '#include <bits/stdc++.h>\n' * 80,
+                           'judge-id': None, 'priority': 1, 'request-id': 7},
+}
+
+
+class FakeSocket(object):
+    def __init__(self):
+        self.stream = io.BytesIO()
+
+    def sendall(self, data):
+        self.stream.write(data)
+
+    def rewind(self):
+        self.stream.seek(0)
+
+    def recv(self, size):
+        return self.stream.read(size)
+
+    def recv_into(self, buffer, size=0):
+        return self.stream.readinto(buffer[:size or len(buffer)])
+
+
+class FakeServer(object):
+    server_address = ('localhost', 0)
+
+
+class Endpoint(ZlibPacketHandler):
+    def on_packet(self, data):
+        self.packet = self.codec.loads(data)
+
+
+def throughput(codec, threshold, payload):
+    sock = FakeSocket()
+    # instantiate() constructs the handler without having it start reading.
+    endpoint = Endpoint.instantiate(sock, ('127.0.0.1', 0), FakeServer())
+    endpoint.codec = codec
+    endpoint.compression_threshold = threshold
+
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < DURATION:
+        for _ in range(100):
+            sock.stream = io.BytesIO()
+            endpoint.send(codec.dumps(payload))
+            wire = sock.stream.tell()
+            sock.rewind()
+            endpoint.read_sized_packet(endpoint.read_size())
+        count += 100
+    assert endpoint.packet == payload
+    return count / (time.perf_counter() - start), wire
+
+
+def main():
+    variants = [('stdlib json', JsonCodec, None)]
+    for name, codec in CODECS.items():
+        label = '%s (%s)' % (name, codec.__name__)
+        variants.append((label, codec, None))
+        variants.append((label + ' +threshold', codec, THRESHOLD))
+    if 'msgpack' not in CODECS:
+        print('msgpack is not installed; skipping it\n')
+
+    print('%-28s %-32s %12s %8s' % ('packet', 'codec', 'packets/s', 'wire'))
+    for packet, payload in PAYLOADS.items():
+        for label, codec, threshold in variants:
+            rate, wire = throughput(codec, threshold, payload)
+            print('%-28s %-32s %12d %7dB' % (packet, label, rate, wire))
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Benchmarks the bridge packet reader: per-packet CPU time and peak allocation while reading,
+decompressing and parsing a packet, for the current ZlibPacketHandler and for the reader it replaced.
+
+Run from the repository root:
+    python test/manual/bench_packet_reader.py
+"""
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+import zlib
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from judger.bridge.base_handler import ZlibPacketHandler, size_pack  # noqa: E402
+
+CHUNK = 64 * 1024  # What a socket typically hands back per recv call
+
+PAYLOADS = {
+    'ping-response': {'name': 'ping-response', 'when': 1.0, 'time': 1.0, 'load': 0.5},
+    'test-case (1 KiB output)': {'name': 'test-case-status', 'submission-id': 1, 'cases': [
+        {'position': 1, 'status': 0, 'time': 0.1, 'points': 1, 'total': 1, 'memory': 1024,
+         'output': 'x' * 1024, 'extended-feedback': '', 'feedback': ''},
+    ]},
+    'test-case (1 MiB output)': {'name': 'test-case-status', 'submission-id': 1, 'cases': [
+        {'position': 1, 'status': 0, 'time': 0.1, 'points': 1, 'total': 1, 'memory': 1024,
+         'output': os.urandom(512 * 1024).hex(), 'extended-feedback': '', 'feedback': ''},
+    ]},
+    'compile-error (4 MiB log)': {'name': 'compile-error', 'submission-id': 1,
+                                  'log': os.urandom(2 * 1024 * 1024).hex()},
+}
+
+
+class FakeSocket(object):
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def recv(self, size):
+        return self.stream.read(min(size, CHUNK))
+
+    def recv_into(self, buffer, size=0):
+        return self.stream.readinto(buffer[:min(size or len(buffer), CHUNK)])
+
+
+class FakeServer(object):
+    server_address = ('localhost', 0)
+
+
+class CurrentReader(ZlibPacketHandler):
+    def on_packet(self, data):
+        self.packet = json.loads(data)
+
+
+class LegacyReader(CurrentReader):
+    def read_sized_packet(self, size, initial=None):
+        buffer = []
+        remainder = size
+        while remainder:
+            data = self.request.recv(remainder)
+            remainder -= len(data)
+            buffer.append(data)
+        self._on_packet(b''.join(buffer))
+
+    def _on_packet(self, data):
+        self.on_packet(zlib.decompress(data).decode('utf-8'))
+
+
+def measure(reader_class, frame, iterations):
+    # instantiate() constructs the handler without having it start reading.
+    reader = reader_class.instantiate(FakeSocket(b''), ('127.0.0.1', 0), FakeServer())
+
+    # Warm up, so the reusable buffer is already allocated when measuring.
+    reader.request = FakeSocket(frame)
+    reader.read_sized_packet(reader.read_size())
+
+    start = time.process_time()
+    for _ in range(iterations):
+        reader.request = FakeSocket(frame)
+        reader.read_sized_packet(reader.read_size())
+    cpu = (time.process_time() - start) / iterations
+
+    reader.request = FakeSocket(frame)
+    tracemalloc.start()
+    reader.read_sized_packet(reader.read_size())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cpu, peak
+
+
+def main():
+    print('%-28s %10s %14s %14s %14s %14s' % ('packet', 'wire', 'legacy cpu', 'current cpu',
+                                            'legacy peak', 'current peak'))
+    for name, payload in PAYLOADS.items():
+        data = zlib.compress(json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+        frame = size_pack.pack(len(data)) + data
+        iterations = max(5, min(20000, 200 * 1024 * 1024 // (len(frame) * 50)))
+
+        legacy_cpu, legacy_peak = measure(LegacyReader, frame, iterations)
+        current_cpu, current_peak = measure(CurrentReader, frame, iterations)
+        print('%-28s %9dK %12.1fus %12.1fus %12dK %12dK' % (
+            name, len(frame) // 1024, legacy_cpu * 1e6, current_cpu * 1e6, legacy_peak // 1024, current_peak // 1024,
+        ))
+
+
+if __name__ == '__main__':
+    main()